@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+
+# Download the input files of a dataset through a local cache.
+# Files are fetched over HTTP with resumable range requests and revalidated
+# with ETag/If-Modified-Since, so a file that did not change is not
+# downloaded again, and not even asked for while it is younger than
+# fetch_max_age. Each file is stored once, gzip-compressed and named by the
+# sha256 of its content, and linked into the data directory, where the
+# readers stream it without decompressing it to disk. A local directory or
+# file:// URL holding the files can stand in for the server (--mirror),
+# e.g. for offline runs.
+
+import argparse
+import filecmp
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import pipeline_config
+import stage_profiler
+
+# Files of an EBI Expression Atlas experiment, by input setting
+ebi_url = "https://www.ebi.ac.uk/gxa/experiments-content/{name}/resources/"
+ebi_files = {
+    "design": "ExperimentDesignFile.RnaSeq/experiment-design",
+    "raw_counts": "DifferentialSecondaryDataFiles.RnaSeq/raw-counts"
+}
+
+# Index of the cached sources, kept in the cache directory
+index_name = "sources.json"
+
+# Block size used to copy, hash and compress files
+block_size = 1 << 20
+
+# Attempts of a download, resuming after each interruption
+retries = 3
+
+# Seconds to wait for the server
+timeout = 60
+
+
+def open_text(path, newline=None):
+    """Open a text file for reading, decompressing .gz files on the fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline=newline)
+    return open(path, "r", newline=newline)
+
+
+def source_urls(settings):
+    """Return input setting -> URL of the files of a dataset.
+
+    settings["source"] is "ebi" for an Expression Atlas experiment named
+    like the dataset, or a dict with "raw_counts" and "design" URLs.
+    """
+    source = settings["source"]
+    if source is None:
+        return {}
+    if source == "ebi":
+        base = ebi_url.format(name=settings["name"])
+        return {key: base + path for key, path in ebi_files.items()}
+    return dict(source)
+
+
+def mirror_path(mirror, dest):
+    """Return the file of a local mirror standing in for dest.
+
+    The mirror holds the files under their data directory names, either
+    plain or gzip-compressed, so an old data directory can be used.
+    """
+    if mirror.startswith("file://"):
+        path = urllib.parse.urlsplit(mirror).path
+        mirror = urllib.request.url2pathname(path)
+    name = os.path.basename(dest)
+    if name.endswith(".gz"):
+        name = name[:-3]
+    for candidate in (name, name + ".gz"):
+        path = os.path.join(mirror, candidate)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"'{name}' is not in the mirror {mirror}")
+
+
+def load_index(cache_dir):
+    """Read the cached source -> object entries."""
+    try:
+        with open(os.path.join(cache_dir, index_name), "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_index(cache_dir, index):
+    """Write the cache index, replacing the file atomically."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, index_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(index, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def object_path(cache_dir, digest):
+    """Return the cached copy of the content with the given sha256."""
+    return os.path.join(cache_dir, "objects", digest[:2], digest + ".gz")
+
+
+def partial_path(cache_dir, source):
+    """Return the file an interrupted download of source is kept in."""
+    name = hashlib.sha256(source.encode()).hexdigest()[:32]
+    return os.path.join(cache_dir, "partial", name + ".part")
+
+
+def store_object(cache_dir, stream):
+    """Compress a binary stream into the cache; returns (sha256, size)."""
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+    tmp_path = os.path.join(cache_dir, "objects", f".{os.getpid()}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as file:
+            for block in iter(lambda: stream.read(block_size), b""):
+                digest.update(block)
+                size += len(block)
+                file.write(block)
+    path = object_path(cache_dir, digest.hexdigest())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return digest.hexdigest(), size
+
+
+def check_digest(dest, digest, expected=None):
+    """Raise ValueError when a file does not have the expected sha256."""
+    if expected is not None and digest != expected.lower():
+        raise ValueError(
+            f"Checksum mismatch for {dest}: expected {expected}, got {digest}")
+
+
+def link_object(path, dest):
+    """Make dest a copy of a cached object; returns False if it already is.
+
+    Objects are hard linked where possible, so they take no extra space.
+    An unchanged dest is left alone, keeping its modification time.
+    """
+    if os.path.exists(dest) and (os.path.samefile(path, dest)
+                                 or filecmp.cmp(path, dest, shallow=False)):
+        return False
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    tmp_path = f"{dest}.{os.getpid()}.tmp"
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, dest)
+    return True
+
+
+def expected_size(response):
+    """Return the full size of a download from its response, if known."""
+    if response.status == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def download(url, part, headers):
+    """Download url into part, resuming an earlier partial download.
+
+    headers are the conditional request headers. The validator of the
+    first response is kept next to part, so a resumed download only
+    appends to it while the file on the server is the same (If-Range).
+    Returns the response status and headers; 304 means not modified.
+    """
+    meta_path = part + ".json"
+    for attempt in range(retries):
+        request_headers = dict(headers)
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset and os.path.exists(meta_path):
+            with open(meta_path, "r") as file:
+                validator = json.load(file).get("validator")
+            if validator:
+                request_headers["Range"] = f"bytes={offset}-"
+                request_headers["If-Range"] = validator
+        request = urllib.request.Request(url, headers=request_headers)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                validator = (response.headers.get("ETag")
+                             or response.headers.get("Last-Modified"))
+                with open(meta_path, "w") as file:
+                    json.dump({"url": url, "validator": validator}, file)
+                mode = "ab" if response.status == 206 else "wb"
+                with open(part, mode) as file:
+                    shutil.copyfileobj(response, file, block_size)
+                size = expected_size(response)
+                if size is not None and os.path.getsize(part) != size:
+                    raise ConnectionError(
+                        f"got {os.path.getsize(part)} of {size} bytes")
+                return response.status, response.headers
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                return 304, error.headers
+            if error.code == 416 and offset:
+                # The partial file does not fit the server's any more
+                os.remove(part)
+                continue
+            raise
+        except OSError as error:
+            if attempt == retries - 1:
+                raise
+            print(f"Download of {url} interrupted ({error}), resuming")
+            time.sleep(2 ** attempt)
+    raise ConnectionError(f"Could not download {url}")
+
+
+def fetch_http(url, cache_dir, entry):
+    """Fetch a URL into the cache; returns its new entry or None if current.
+
+    entry is the cache entry of an earlier fetch, or None.
+    """
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    os.makedirs(os.path.join(cache_dir, "partial"), exist_ok=True)
+    part = partial_path(cache_dir, url)
+    status, response_headers = download(url, part, headers)
+    if status == 304:
+        return None
+    with open(part, "rb") as file:
+        digest, size = store_object(cache_dir, file)
+    os.remove(part)
+    os.remove(part + ".json")
+    return {
+        "sha256": digest,
+        "size": size,
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified")
+    }
+
+
+def fetch_local(path, cache_dir, entry):
+    """Copy a mirror file into the cache; returns None if unchanged.
+
+    The size and modification time of the file stand in for an ETag.
+    """
+    info = os.stat(path)
+    etag = f"{info.st_size}-{info.st_mtime_ns}"
+    if entry is not None and entry.get("etag") == etag:
+        return None
+    with (gzip.open if path.endswith(".gz") else open)(path, "rb") as file:
+        digest, size = store_object(cache_dir, file)
+    return {"sha256": digest, "size": size, "etag": etag}
+
+
+def fetch_file(source, dest, cache_dir, index, expected=None,
+               max_age=0, local=False):
+    """Bring dest up to date with a URL or mirror file through the cache.
+
+    index is the cache index, updated in place. A cached file checked less
+    than max_age seconds ago is used without any request. Returns
+    "cached", "not modified" or "downloaded".
+    """
+    entry = index.get(source)
+    if entry is not None and not os.path.exists(
+            object_path(cache_dir, entry["sha256"])):
+        entry = None
+    if entry is not None and time.time() - entry["checked"] < max_age:
+        result = "cached"
+    else:
+        fetch = fetch_local if local else fetch_http
+        new_entry = fetch(source, cache_dir, entry)
+        result = "not modified" if new_entry is None else "downloaded"
+        entry = new_entry or entry
+        entry["checked"] = time.time()
+        index[source] = entry
+    check_digest(dest, entry["sha256"], expected)
+    link_object(object_path(cache_dir, entry["sha256"]), dest)
+    return result
+
+
+def fetch_dataset(settings, refresh=False, mirror=None):
+    """Fetch the input files of a dataset into its data directory.
+
+    Files come from the dataset's source, or from mirror (a directory or
+    file:// URL) when given or set in the settings. refresh revalidates
+    cached files however recently they were checked. Returns input
+    setting -> result of fetch_file.
+    """
+    urls = source_urls(settings)
+    if not urls:
+        raise ValueError(f"Dataset '{settings['name']}' has no source")
+    cache_dir = settings["download_cache"] or os.path.join(
+        settings["data_dir"], "cache")
+    mirror = mirror or settings["mirror"]
+    max_age = 0 if refresh else settings["fetch_max_age"]
+    checksums = settings["checksums"] or {}
+    index = load_index(cache_dir)
+    results = {}
+    for key, url in urls.items():
+        dest = settings[key]
+        source = mirror_path(mirror, dest) if mirror else url
+        with stage_profiler.stage(f"fetch:{key}"):
+            try:
+                results[key] = fetch_file(
+                    source, dest, cache_dir, index, checksums.get(key),
+                    max_age, local=bool(mirror))
+            finally:
+                save_index(cache_dir, index)
+        print(f"{dest}: {results[key]} ({source})")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Download the input files of a dataset."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--mirror",
+        default=None,
+        help="Directory or file:// URL to read the files from instead of "
+             "the server"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ask the server for changes even if the files were checked "
+             "recently"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Download cache (default: <data_dir>/cache)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    if args.cache_dir is not None:
+        settings["download_cache"] = args.cache_dir
+    stage_profiler.context["dataset"] = settings["name"]
+    try:
+        fetch_dataset(settings, refresh=args.refresh, mirror=args.mirror)
+    finally:
+        stage_profiler.write_report()
+
+
+if __name__ == "__main__":
+    main()
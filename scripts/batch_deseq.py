@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+# Run many DESeq2 analyses concurrently on one machine.
+# Jobs are datasets of the configuration and/or resampled replicates
+# (bootstrap or subsample) of them. The count matrix of each dataset is read
+# once and placed in shared memory, which the worker processes map instead
+# of receiving a pickled copy. The cores are split between the number of
+# jobs run at once and the PyDESeq2 n_cpus of each job, and the run ends
+# with a throughput report in datasets per hour.
+
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import pipeline_config
+import run_deseq_analysis
+import stage_profiler
+
+# Ways of resampling the samples of a dataset into replicates
+replicate_modes = ["bootstrap", "subsample"]
+
+# Shared inputs of every dataset, set in each worker process
+_shared_inputs = {}
+
+# Shared memory segments attached by this process, by name
+_attached = {}
+
+
+def split_cores(n_jobs, total=None, workers=None):
+    """Split the cores between concurrent jobs and PyDESeq2 n_cpus.
+
+    Much of a fit is serial, so as many jobs as there are cores run at
+    once and the cores left over go to the inner parallelism of each job.
+    Returns (workers, n_cpus per job).
+    """
+    total = total or os.cpu_count() or 1
+    if workers is None:
+        workers = min(n_jobs, total)
+    workers = max(1, workers)
+    return workers, max(1, total // workers)
+
+
+def share_counts(counts):
+    """Copy a samples x genes counts DataFrame into shared memory.
+
+    Returns the segment, which the caller has to unlink, and a descriptor
+    workers attach to it with.
+    """
+    values = counts.to_numpy()
+    segment = shared_memory.SharedMemory(
+        create=True, size=max(1, values.nbytes))
+    shared = np.ndarray(values.shape, dtype=values.dtype, buffer=segment.buf)
+    shared[:] = values
+    descriptor = {
+        "segment": segment.name,
+        "shape": values.shape,
+        "dtype": values.dtype.str,
+        "samples": counts.index,
+        "genes": counts.columns
+    }
+    return segment, descriptor
+
+
+def attach_counts(descriptor):
+    """Return a DataFrame over a shared count matrix, without copying it."""
+    name = descriptor["segment"]
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    values = np.ndarray(descriptor["shape"], dtype=descriptor["dtype"],
+                        buffer=_attached[name].buf)
+    return pd.DataFrame(values, index=descriptor["samples"],
+                        columns=descriptor["genes"], copy=False)
+
+
+def resample(counts, metadata, factor, mode="bootstrap", fraction=0.8,
+             seed=0):
+    """Return the counts and metadata of one resampled replicate.
+
+    Samples are drawn within each level of the design factor. bootstrap
+    draws as many samples as a level has, with replacement (repeated
+    samples get a _<n> suffix); subsample keeps a fraction of them, and at
+    least two, without replacement.
+    """
+    rng = np.random.default_rng(seed)
+    chosen = []
+    for _, group in metadata.groupby(factor, sort=False):
+        samples = group.index.to_numpy()
+        if mode == "bootstrap":
+            chosen.extend(rng.choice(samples, size=len(samples)))
+        else:
+            size = min(len(samples), max(2, round(fraction * len(samples))))
+            chosen.extend(rng.choice(samples, size=size, replace=False))
+    chosen = sorted(chosen)
+
+    names = []
+    seen = {}
+    for sample in chosen:
+        seen[sample] = seen.get(sample, 0) + 1
+        names.append(sample if seen[sample] == 1
+                     else f"{sample}_{seen[sample] - 1}")
+    index = pd.Index(names, name=counts.index.name)
+    replicate_counts = counts.loc[chosen].set_axis(index, axis=0)
+    replicate_metadata = metadata.loc[chosen].set_axis(index, axis=0)
+    return replicate_counts, replicate_metadata
+
+
+def dataset_jobs(config, names=None):
+    """Return one job per dataset of a configuration."""
+    if names is None:
+        names = pipeline_config.dataset_names(config)
+    return [
+        {
+            "name": name,
+            "dataset": name,
+            "settings": pipeline_config.dataset_settings(config, name),
+            "replicate": None
+        }
+        for name in names
+    ]
+
+
+def replicate_jobs(settings, n, mode="bootstrap", fraction=0.8, seed=0):
+    """Return n resampled replicate jobs of one dataset.
+
+    Each replicate writes its results to
+    <results_dir>/replicates/<mode>_<i>/deseq_analysis.
+    """
+    jobs = []
+    for i in range(n):
+        replicate = f"{mode}_{i:03d}"
+        deseq_dir = os.path.join(
+            settings["results_dir"], "replicates", replicate,
+            "deseq_analysis")
+        jobs.append({
+            "name": f"{settings['name']}/{replicate}",
+            "dataset": settings["name"],
+            "settings": dict(settings, deseq_dir=deseq_dir),
+            "replicate": {"mode": mode, "fraction": fraction,
+                          "seed": seed + i}
+        })
+    return jobs
+
+
+def _init_worker(shared_inputs):
+    """Make the shared inputs of every dataset known to a worker."""
+    _shared_inputs.update(shared_inputs)
+
+
+def _run_job(job):
+    """Analyse one dataset or replicate in a worker and report errors."""
+    start = time.perf_counter()
+    settings = job["settings"]
+    stage_profiler.context["dataset"] = job["name"]
+    try:
+        shared = _shared_inputs[job["dataset"]]
+        counts = attach_counts(shared)
+        metadata = shared["metadata"]
+        replicate = job["replicate"]
+        if replicate is not None:
+            counts, metadata = resample(
+                counts, metadata, settings["design_factor"], **replicate)
+        with stage_profiler.stage("batch_job", rows=len(counts)):
+            run_deseq_analysis.run_analysis(
+                settings,
+                use_cache=replicate is None,
+                inputs=(counts, shared["gene_names"], metadata)
+            )
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        stage_profiler.write_report()
+    return job["name"], time.perf_counter() - start, error
+
+
+def run_batch(jobs, workers=None, total_cpus=None):
+    """Run analysis jobs concurrently with shared count matrices.
+
+    The counts of every dataset used by the jobs are loaded once. Jobs
+    run in workers processes (default: as many as fit the cores) with
+    PyDESeq2 using the remaining cores. Returns job name -> error
+    traceback (None on success).
+    """
+    workers, n_cpus = split_cores(len(jobs), total_cpus, workers)
+    print(f"Running {len(jobs)} analyses: {workers} at a time with "
+          f"{n_cpus} cores each")
+    for job in jobs:
+        job["settings"] = dict(
+            job["settings"], n_cpus=n_cpus, contrast_workers=1)
+
+    segments = []
+    shared_inputs = {}
+    errors = {}
+    try:
+        for job in jobs:
+            name = job["dataset"]
+            if name in shared_inputs:
+                continue
+            stage_profiler.context["dataset"] = name
+            counts, gene_names, metadata = run_deseq_analysis.load_inputs(
+                job["settings"])
+            segment, descriptor = share_counts(counts)
+            segments.append(segment)
+            del counts
+            shared_inputs[name] = dict(
+                descriptor, gene_names=gene_names, metadata=metadata)
+
+        start = time.perf_counter()
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(shared_inputs,)) as pool:
+            futures = [pool.submit(_run_job, job) for job in jobs]
+            for future in as_completed(futures):
+                name, elapsed, error = future.result()
+                errors[name] = error
+                status = "failed" if error else "finished"
+                print(f"Analysis '{name}' {status} in {elapsed:.2f}s")
+                if error:
+                    print(error)
+        elapsed = time.perf_counter() - start
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+    finished = sum(error is None for error in errors.values())
+    rate = finished / elapsed * 3600 if elapsed > 0 else float("inf")
+    print(f"{finished} of {len(jobs)} analyses finished in {elapsed:.1f}s: "
+          f"{rate:.1f} datasets/hour")
+    stage_profiler.context.pop("dataset", None)
+    stage_profiler.add_record({
+        "stage": "batch",
+        "wall_s": round(elapsed, 6),
+        "rows": finished,
+        "workers": workers,
+        "n_cpus": n_cpus,
+        "datasets_per_hour": round(rate, 2)
+    })
+    return errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run many DESeq2 analyses concurrently."
+    )
+    parser.add_argument(
+        "--config",
+        default=pipeline_config.default_config_path,
+        help="Pipeline configuration file "
+             f"(default: {pipeline_config.default_config_path})"
+    )
+    parser.add_argument(
+        "--dataset",
+        action="append",
+        default=None,
+        help="Dataset to analyse, can be repeated (default: all datasets)"
+    )
+    parser.add_argument(
+        "--replicates",
+        type=int,
+        default=0,
+        help="Run this many resampled replicates of each dataset instead "
+             "of the datasets themselves"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=replicate_modes,
+        default="bootstrap",
+        help="How replicates resample the samples (default: bootstrap)"
+    )
+    parser.add_argument(
+        "--fraction",
+        type=float,
+        default=0.8,
+        help="Fraction of the samples of each level kept by subsample "
+             "replicates (default: 0.8)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the first replicate (default: 0)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of analyses run at the same time "
+             "(default: one per job, up to the number of cores)"
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=None,
+        help="Total number of cores to use (default: all)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    jobs = dataset_jobs(config, args.dataset)
+    if args.replicates:
+        jobs = [
+            replicate
+            for job in jobs
+            for replicate in replicate_jobs(
+                job["settings"], args.replicates, args.mode, args.fraction,
+                args.seed)
+        ]
+    try:
+        errors = run_batch(jobs, args.workers, args.cpus)
+    finally:
+        stage_profiler.write_report()
+    if any(errors.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
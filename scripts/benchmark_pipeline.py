@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+
+# Benchmark the pipeline on synthetic datasets of increasing size.
+# For every combination of sample and gene counts a dataset is generated
+# with synthetic_counts.py and run through the analysis, SQL generation,
+# database load and plotting. The stage records of stage_profiler.py are
+# collected into one table, so runs of different sizes (and revisions)
+# can be compared as scaling curves.
+
+import argparse
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import time
+import pandas as pd
+import brca_gea
+import db_access
+import generate_insert_statements
+import normalized_schema
+import pipeline_config
+import run_deseq_analysis
+import setup_database
+import stage_profiler
+import synthetic_counts
+import visualize_results
+
+# Steps run for every dataset, in order
+all_steps = ["analyze", "sql", "load-db", "plot"]
+
+# Stages of the analysis shown next to the steps in the summary
+fit_stages = ["prefilter", "size_factors", "dispersions", "lfc",
+              "cooks_refit"]
+
+# Columns of the benchmark results table
+result_columns = ["n_samples", "n_genes", "prefilter", "repeat", "stage",
+                  "wall_s",
+                  "cpu_s", "children_cpu_s", "peak_rss_mb", "rows",
+                  "rows_per_s"]
+
+
+def benchmark_settings(work_dir, name, n_cpus=None):
+    """Return the settings of a synthetic dataset under work_dir."""
+    entry = {
+        "name": name,
+        "data_dir": os.path.join(work_dir, "data"),
+        "results_root": os.path.join(work_dir, "results"),
+        "reference_level": synthetic_counts.default_levels[0]
+    }
+    if n_cpus is not None:
+        entry["n_cpus"] = n_cpus
+    return pipeline_config.dataset_settings({"datasets": [entry]}, name)
+
+
+def load_sqlite(settings, db_path, batch_size=5000):
+    """Load a dataset into a SQLite file with the normalized layout.
+
+    The wide layout needs one column per sample, which runs into the
+    SQLite column limit for large designs, so the long tables are used.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    def insert_rows(connection, table, batches):
+        with stage_profiler.stage(f"db_load:{table}") as record:
+            record["rows"] = setup_database.bulk_insert_table(
+                connection, table, batches)
+        return record["rows"]
+
+    connection = db_access.connect({"backend": "sqlite", "path": db_path})
+    try:
+        normalized_schema.load_normalized(
+            connection, settings, insert_rows, batch_size)
+    finally:
+        connection.close()
+
+
+def run_steps(settings, steps, db="sqlite"):
+    """Run the selected pipeline steps for one dataset, timing each."""
+    if "analyze" in steps:
+        with stage_profiler.stage("analyze"):
+            run_deseq_analysis.run_analysis(settings, use_cache=False)
+    if "sql" in steps:
+        with stage_profiler.stage("sql"):
+            generate_insert_statements.generate_sql(settings)
+    if "load-db" in steps:
+        with stage_profiler.stage("load-db"):
+            if db == "sqlite":
+                load_sqlite(settings, os.path.join(
+                    settings["results_dir"], "benchmark.sqlite"))
+            else:
+                connection = setup_database.connect(settings)
+                try:
+                    setup_database.load_database(
+                        connection, settings, sync="recreate")
+                finally:
+                    connection.close()
+    if "plot" in steps:
+        # Remove earlier figures, otherwise unchanged ones are skipped
+        shutil.rmtree(settings["plots_dir"], ignore_errors=True)
+        with stage_profiler.stage("plot"):
+            visualize_results.plot_results(
+                settings, workers=settings["plot_workers"])
+
+
+def run_benchmark(samples, genes, work_dir, steps=all_steps, repeats=1,
+                  db="sqlite", n_cpus=None, seed=0, prefilter=("off",)):
+    """Benchmark every (samples, genes) size and return the stage table.
+
+    Each size is run with the low-count prefilter "off" and/or "on" (with
+    its default rules). Each row is one stage of one run, with its wall
+    and CPU time, peak RSS, row count and throughput. Peak RSS is the
+    stage's own on Linux and the maximum of the process so far elsewhere.
+    """
+    rows = []
+    for n_samples, n_genes in itertools.product(samples, genes):
+        name = f"synthetic-{n_samples}x{n_genes}"
+        settings = benchmark_settings(work_dir, name, n_cpus)
+        start = time.perf_counter()
+        synthetic_counts.write_dataset(
+            settings["data_dir"], name, n_samples, n_genes, seed=seed)
+        print(f"Generated {name} in {time.perf_counter() - start:.2f}s")
+
+        for mode, repeat in itertools.product(prefilter, range(repeats)):
+            settings["prefilter"] = True if mode == "on" else None
+            stage_profiler.context.update({
+                "dataset": name,
+                "n_samples": n_samples,
+                "n_genes": n_genes,
+                "prefilter": mode,
+                "repeat": repeat
+            })
+            try:
+                run_steps(settings, steps, db)
+            finally:
+                rows.extend(stage_profiler.records)
+                stage_profiler.write_report()
+
+    table = pd.DataFrame(rows, columns=result_columns[:-1])
+    table["rows_per_s"] = table["rows"] / table["wall_s"]
+    return table
+
+
+def startup_times(repeats=5):
+    """Time the startup of every brca_gea.py command in a fresh interpreter.
+
+    Each command is run with --help, which returns once the modules it
+    needs are imported. pipeline.py, which imports every step, and a bare
+    import of pandas and PyArrow, the cost the lazy commands avoid, are
+    timed for comparison. Returns a table of wall times.
+    """
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    runs = {
+        command: [os.path.join(scripts_dir, "brca_gea.py"), command]
+        for command in brca_gea.commands
+    }
+    runs["pipeline.py"] = [os.path.join(scripts_dir, "pipeline.py")]
+    runs["import pandas, pyarrow"] = ["-c", "import pandas, pyarrow"]
+    rows = []
+    for command, argv in runs.items():
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + argv + ["--help"], check=True,
+                           cwd=scripts_dir, stdout=subprocess.DEVNULL)
+            rows.append({
+                "command": command,
+                "repeat": repeat,
+                "wall_s": time.perf_counter() - start
+            })
+    return pd.DataFrame(rows)
+
+
+def summarize(table):
+    """Return the median wall time of each step and fit stage per run."""
+    summary = table.pivot_table(
+        index=["n_samples", "n_genes", "prefilter"], columns="stage",
+        values="wall_s", aggfunc="median")
+    return summary[[s for s in fit_stages + all_steps
+                    if s in summary.columns]]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic datasets."
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[19],
+        help="Numbers of samples to benchmark (default: 19)"
+    )
+    parser.add_argument(
+        "--genes",
+        type=int,
+        nargs="+",
+        default=[40000],
+        help="Numbers of genes to benchmark (default: 40000)"
+    )
+    parser.add_argument(
+        "--steps",
+        nargs="+",
+        choices=all_steps,
+        default=all_steps,
+        help="Pipeline steps to time (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Number of runs of each size (default: 1)"
+    )
+    parser.add_argument(
+        "--prefilter",
+        nargs="+",
+        choices=["off", "on"],
+        default=["off", "on"],
+        help="Run each size without and/or with the low-count gene "
+             "prefilter (default: off on)"
+    )
+    parser.add_argument(
+        "--db",
+        choices=["sqlite", "mysql"],
+        default="sqlite",
+        help="Database the load-db step writes to; sqlite uses a local "
+             "file, mysql the database configured for the dataset "
+             "(default: sqlite)"
+    )
+    parser.add_argument(
+        "--n-cpus",
+        type=int,
+        default=None,
+        help="CPUs used by PyDESeq2 (default: from the configuration)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the synthetic data (default: 0)"
+    )
+    parser.add_argument(
+        "--work-dir",
+        default="../results/benchmark",
+        help="Directory for the synthetic data and outputs "
+             "(default: ../results/benchmark)"
+    )
+    parser.add_argument(
+        "--startup",
+        type=int,
+        default=0,
+        metavar="REPEATS",
+        help="Only time the startup of the brca_gea.py commands, this many "
+             "times each"
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Results CSV (default: <work-dir>/benchmark_<run id>.csv)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.startup:
+        table = startup_times(args.startup)
+        output = args.output or os.path.join(
+            args.work_dir, f"startup_{stage_profiler.run_id()}.csv")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        table.to_csv(output, index=False)
+        print(table.groupby("command", sort=False)["wall_s"].median()
+              .to_string())
+        print(f"Startup times saved to {output}")
+        return
+    table = run_benchmark(
+        args.samples,
+        args.genes,
+        args.work_dir,
+        steps=args.steps,
+        repeats=args.repeats,
+        db=args.db,
+        n_cpus=args.n_cpus,
+        seed=args.seed,
+        prefilter=args.prefilter
+    )
+    output = args.output or os.path.join(
+        args.work_dir, f"benchmark_{stage_profiler.run_id()}.csv")
+    table.to_csv(output, index=False)
+    print(summarize(table).to_string())
+    print(f"Benchmark results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
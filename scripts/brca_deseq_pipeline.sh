@@ -2,27 +2,23 @@
 
 # Pipeline to run differential sequencing analyis for breast cancer types, 
 # add data into a database and also visualize results.
+#
+# The stages run through pipeline.py as a dependency graph: stages whose
+# inputs and settings are unchanged since the last run are skipped, and SQL
+# generation and plotting run at the same time. Extra arguments are passed
+# on, e.g. "--from plot", "--only sql load-db" or "--force".
 
 echo "Pipeline execution started"
 
-# Get the data required for the analysis and direct outputs
-echo "---Getting data---" > output.log
-bash get_data.sh >> output.log 2>&1
+# All scripts of this invocation add their stage timings to one run report
+export BRCA_RUN_ID="${BRCA_RUN_ID:-$(date +%Y%m%d-%H%M%S)-$$}"
 
-# Perform differential gene expression analysis using python
-echo "---Performing differential analysis---" >> output.log
-python run_deseq_analysis.py >> output.log 2>&1
-
-# Generate insert statements from data for the database
-echo "---Generating INSERT statements---" >> output.log
-python generate_insert_statements.py >> output.log 2>&1
-
-# Setup and populate the database
-echo "---Setting up the database---" >> output.log
-python setup_database.py >> output.log 2>&1
-
-# Visualize the results of differential seq analysis with plots
-echo "---Generating visualization plots---" >> output.log
-python visualize_results.py >> output.log 2>&1
+# Get the data, run the differential analysis, generate the INSERT
+# statements, populate the database and plot the results
+echo "---Running pipeline stages---" > output.log
+python pipeline.py --dataset E-GEOD-52194 --from fetch "$@" >> output.log 2>&1
+status=$?
 
 echo "Pipeline execution finished"
+echo "Run report: ../results/run_reports/${BRCA_RUN_ID}.json"
+exit $status
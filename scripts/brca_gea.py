@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# Single command line entry point for the pipeline steps:
+#   python brca_gea.py <command> [options]
+# Each command imports only the modules it needs, when it runs, so e.g. the
+# SQL step does not pay for importing PyDESeq2 or matplotlib. The options of
+# a step command are those of its script (see <command> --help). run-all
+# runs every step of a dataset in this process and hands the results
+# tables from the analysis to the later steps in memory.
+
+import argparse
+import importlib
+import sys
+import time
+
+# Command -> (module run by it, description)
+commands = {
+    "fetch": ("acquire_data", "Download the input files of a dataset"),
+    "analyze": ("run_deseq_analysis", "Run the differential analysis"),
+    "sql": ("generate_insert_statements", "Write the INSERT statements"),
+    "load-db": ("setup_database", "Load the results into the database"),
+    "plot": ("visualize_results", "Draw the volcano plots and heatmaps"),
+    "query": ("query_service", "Query the results database"),
+    "run-all": (None, "Run analyze, sql, (load-db) and plot in one process")
+}
+
+
+def run_command(command, argv):
+    """Run the main function of a step's script with the given options."""
+    module = importlib.import_module(commands[command][0])
+    sys.argv = [f"{sys.argv[0]} {command}"] + list(argv)
+    module.main()
+
+
+def run_all(settings, use_cache=True, load_db=False, db_mode="bulk"):
+    """Run every step of one dataset in this process.
+
+    The results tables returned by the analysis are passed to the SQL and
+    plotting steps instead of being read back from disk.
+    """
+    import generate_insert_statements
+    import run_deseq_analysis
+    import stage_profiler
+    import visualize_results
+
+    with stage_profiler.stage("analyze"):
+        tables = run_deseq_analysis.run_analysis(settings, use_cache=use_cache)
+    with stage_profiler.stage("sql"):
+        generate_insert_statements.generate_sql(settings, tables=tables)
+    if load_db:
+        import setup_database
+        with stage_profiler.stage("load-db"):
+            connection = setup_database.connect(
+                settings, local_infile=db_mode == "infile")
+            try:
+                setup_database.load_database(
+                    connection, settings, db_mode, sync=settings["db_sync"])
+            finally:
+                connection.close()
+    with stage_profiler.stage("plot"):
+        visualize_results.plot_results(
+            settings,
+            min_comparisons=settings["min_comparisons"],
+            significance_column=settings["significance_column"],
+            alpha=settings["alpha"],
+            lfc_threshold=settings["lfc_threshold"],
+            workers=settings["plot_workers"],
+            max_background_points=settings["max_background_points"],
+            heatmap_mode=settings["heatmap_mode"],
+            results={
+                name[:-len("_results")]: df for name, df in tables.items()
+            }
+        )
+
+
+def parse_run_all_args(argv):
+    import pipeline_config
+    parser = argparse.ArgumentParser(
+        prog=f"{sys.argv[0]} run-all",
+        description=commands["run-all"][1] + "."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always refit the model instead of using the DESeq2 fit cache"
+    )
+    parser.add_argument(
+        "--load-db",
+        action="store_true",
+        help="Also load the results into the database"
+    )
+    parser.add_argument(
+        "--db-mode",
+        choices=["sql", "bulk", "infile"],
+        default="bulk",
+        help="Load path used with --load-db (default: bulk)"
+    )
+    return parser.parse_args(argv)
+
+
+def main_run_all(argv):
+    import pipeline_config
+    import stage_profiler
+    args = parse_run_all_args(argv)
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    stage_profiler.context["dataset"] = settings["name"]
+    start = time.perf_counter()
+    try:
+        run_all(settings, use_cache=not args.no_cache,
+                load_db=args.load_db, db_mode=args.db_mode)
+    finally:
+        stage_profiler.write_report()
+    print(f"All steps finished in {time.perf_counter() - start:.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Breast cancer gene expression analysis pipeline.",
+        epilog="Commands: " + "; ".join(
+            f"{name}: {text}" for name, (_, text) in commands.items())
+    )
+    parser.add_argument("command", choices=list(commands))
+    parser.add_argument(
+        "options",
+        nargs=argparse.REMAINDER,
+        help="Options of the command (see <command> --help)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "run-all":
+        main_run_all(args.options)
+    else:
+        run_command(args.command, args.options)
+
+
+if __name__ == "__main__":
+    main()
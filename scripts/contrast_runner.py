@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+# Run several DeseqStats contrasts concurrently on one fitted DeseqDataSet.
+# Workers are forked after the fit so they share the dds memory pages
+# instead of receiving a pickled copy each.
+
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pydeseq2.ds import DeseqStats
+from pydeseq2.default_inference import DefaultInference
+from pipeline_config import slugify
+
+# Fitted dataset seen by the worker processes
+_shared_dds = None
+
+
+def contrast_name(contrast):
+    """Return the default name of a [factor, tested, reference] contrast."""
+    return f"{slugify(contrast[1])}_vs_{slugify(contrast[2])}"
+
+
+def all_pairwise_contrasts(metadata, factor="Condition", reference=None):
+    """Return every pairwise contrast between the levels of a factor.
+
+    Levels are sorted, so the contrasts do not depend on the order of the
+    metadata rows; of two levels the first one is tested against the
+    second. A reference level, if given, is tested against by every other
+    level.
+    """
+    levels = sorted(set(metadata[factor]))
+    if reference is not None:
+        if reference not in levels:
+            raise ValueError(
+                f"Reference level '{reference}' is not a level of {factor}")
+        levels.remove(reference)
+        levels.append(reference)
+    return [
+        [factor, tested, reference]
+        for tested, reference in itertools.combinations(levels, 2)
+    ]
+
+
+def _set_shared_dds(dds):
+    global _shared_dds
+    _shared_dds = dds
+
+
+def _run_contrast(name, contrast, n_cpus):
+    """Run the Wald tests and filtering for one contrast in a worker."""
+    start = time.perf_counter()
+    stats = DeseqStats(
+        _shared_dds,
+        contrast=contrast,
+        inference=DefaultInference(n_cpus=n_cpus),
+        quiet=True
+    )
+    stats.summary()
+    return name, stats.results_df, time.perf_counter() - start
+
+
+def run_contrasts(dds, contrasts, n_workers=None, n_cpus=1):
+    """Evaluate contrasts concurrently in a process pool.
+
+    contrasts is either a list of [factor, tested, reference] lists or a
+    dict mapping result names to them. n_cpus is the number of cores each
+    contrast may use for its own tests. Returns a dict of name to results
+    DataFrame, in the order given, and a dict of name to wall time.
+    """
+    if not isinstance(contrasts, dict):
+        contrasts = {contrast_name(c): c for c in contrasts}
+    if n_workers is None:
+        n_workers = min(len(contrasts), (os.cpu_count() or 1) // n_cpus)
+        n_workers = max(1, n_workers)
+
+    results = {}
+    timings = {}
+
+    # A single worker runs the contrasts in this process, which also works
+    # inside daemonic pool workers that cannot start children
+    if n_workers == 1:
+        _set_shared_dds(dds)
+        for name, contrast in contrasts.items():
+            _, results[name], timings[name] = _run_contrast(
+                name, contrast, n_cpus)
+            print(f"Contrast '{name}' finished in {timings[name]:.2f}s")
+        _set_shared_dds(None)
+        return results, timings
+
+    # Share the fit through fork when available, otherwise send one copy
+    # to each worker when it starts
+    if "fork" in multiprocessing.get_all_start_methods():
+        _set_shared_dds(dds)
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("fork")
+        )
+    else:
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_set_shared_dds,
+            initargs=(dds,)
+        )
+
+    with pool:
+        futures = [
+            pool.submit(_run_contrast, name, contrast, n_cpus)
+            for name, contrast in contrasts.items()
+        ]
+        for future in futures:
+            name, results_df, elapsed = future.result()
+            results[name] = results_df
+            timings[name] = elapsed
+            print(f"Contrast '{name}' finished in {elapsed:.2f}s")
+    _set_shared_dds(None)
+    return results, timings
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+# Chunked loader for raw count matrices (genes as rows, samples as columns).
+# Counts are read with a compact dtype, filtered chunk by chunk and written
+# straight into a samples x genes array, so the only full-size allocation
+# is the final matrix.
+
+import numpy as np
+import pandas as pd
+
+# Default number of genes read per chunk
+default_chunksize = 10000
+
+
+def load_counts(path, gene_id_column="Gene ID", gene_name_column="Gene Name",
+                chunksize=default_chunksize, count_dtype="uint32"):
+    """Load a count matrix as a samples x genes DataFrame.
+
+    Genes with a zero total count or without a gene name are dropped while
+    reading. Samples are sorted by name. Returns the counts, the gene names
+    as a categorical Series indexed by gene ID, and a dict with the number
+    of genes read and removed by each filter.
+    """
+    header = pd.read_csv(path, sep="\t", nrows=0).columns
+    samples = [c for c in header if c not in (gene_id_column,
+                                              gene_name_column)]
+    order = np.argsort(samples, kind="stable")
+    dtypes = {sample: count_dtype for sample in samples}
+    dtypes[gene_id_column] = str
+    dtypes[gene_name_column] = object
+
+    blocks = []
+    gene_ids = []
+    gene_names = []
+    stats = {"genes_read": 0, "zero_counts": 0, "missing_name": 0}
+    reader = pd.read_csv(path, sep="\t", dtype=dtypes, chunksize=chunksize)
+    for chunk in reader:
+        values = chunk[samples].to_numpy()
+        names = chunk[gene_name_column]
+        nonzero = values.sum(axis=1, dtype=np.uint64) > 0
+        named = names.notna().to_numpy()
+        keep = nonzero & named
+        stats["genes_read"] += len(chunk)
+        stats["zero_counts"] += int((~nonzero).sum())
+        stats["missing_name"] += int((nonzero & ~named).sum())
+        # Reorder the samples and transpose the (small) kept block only
+        blocks.append(values[keep][:, order].T)
+        gene_ids.append(chunk[gene_id_column].to_numpy()[keep])
+        gene_names.append(names.to_numpy()[keep])
+
+    # Fill the final samples x genes matrix block by block
+    n_genes = sum(block.shape[1] for block in blocks)
+    matrix = np.empty((len(samples), n_genes), dtype=count_dtype)
+    start = 0
+    while blocks:
+        block = blocks.pop(0)
+        matrix[:, start:start + block.shape[1]] = block
+        start += block.shape[1]
+
+    if not gene_ids:
+        gene_ids = gene_names = [np.array([], dtype=object)]
+    gene_index = pd.Index(np.concatenate(gene_ids), name=gene_id_column)
+    counts = pd.DataFrame(
+        matrix,
+        index=pd.Index(np.asarray(samples)[order], name="Sample_ID"),
+        columns=gene_index,
+        copy=False
+    )
+    gene_names = pd.Series(
+        pd.Categorical(np.concatenate(gene_names)),
+        index=gene_index,
+        name=gene_name_column
+    )
+    stats["genes_kept"] = n_genes
+    return counts, gene_names, stats
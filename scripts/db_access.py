@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+# Shared database access for the loaders and the result queries.
+# Connection settings come from the "database" section of the pipeline
+# configuration and BRCA_DB_* environment variables, so no script needs
+# hard-coded credentials. MySQL/MariaDB is used through pymysql; SQLite is
+# a local stand-in needing no server. Queries are written with %s
+# placeholders and values are always passed as parameters.
+#
+# Environment variables (override the configuration):
+#   BRCA_DB_BACKEND    mysql or sqlite
+#   BRCA_DB_HOST, BRCA_DB_PORT, BRCA_DB_SOCKET
+#   BRCA_DB_USER, BRCA_DB_PASSWORD, BRCA_DB_NAME
+#   BRCA_DB_PATH       SQLite database file
+#   BRCA_DB_POOL_SIZE  maximum connections per process
+
+import contextlib
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+# Settings used when neither the configuration nor the environment set them
+default_db_settings = {
+    "backend": "mysql",
+    "host": None,
+    "port": 3306,
+    "unix_socket": None,
+    "user": "eugwueke",
+    "password": None,
+    "database": "eugwueke",
+    "path": "../results/results.sqlite",
+    "pool_size": 4,
+    "pool_timeout": 30
+}
+
+# Socket of the local MySQL server, used when neither a host nor a socket
+# is configured
+default_socket = "/run/mysqld/mysqld.sock"
+
+# Environment variable -> setting
+env_settings = {
+    "BRCA_DB_BACKEND": "backend",
+    "BRCA_DB_HOST": "host",
+    "BRCA_DB_PORT": "port",
+    "BRCA_DB_SOCKET": "unix_socket",
+    "BRCA_DB_USER": "user",
+    "BRCA_DB_PASSWORD": "password",
+    "BRCA_DB_NAME": "database",
+    "BRCA_DB_PATH": "path",
+    "BRCA_DB_POOL_SIZE": "pool_size"
+}
+
+# Table and column names that may be put into a query
+identifier_pattern = re.compile(r"^[A-Za-z0-9_]+$")
+
+# Connection pools of this process, by settings
+pools = {}
+pools_lock = threading.Lock()
+
+
+def db_settings(settings=None):
+    """Return the database settings of a dataset.
+
+    Values come from default_db_settings, then the "database" section of
+    the dataset settings, then the BRCA_DB_* environment variables.
+    """
+    db = dict(default_db_settings)
+    if settings is not None:
+        db.update(settings.get("database") or {})
+    for variable, key in env_settings.items():
+        if variable in os.environ:
+            db[key] = os.environ[variable]
+    db["port"] = int(db["port"])
+    db["pool_size"] = int(db["pool_size"])
+    if db["backend"] not in ("mysql", "sqlite"):
+        raise ValueError(f"Unknown database backend '{db['backend']}'")
+    return db
+
+
+def connect(db, local_infile=False):
+    """Open a new connection with the given database settings.
+
+    MySQL is reached through unix_socket when it is set, otherwise through
+    host and port, and through the local server's socket when neither is.
+    """
+    if db["backend"] == "sqlite":
+        os.makedirs(os.path.dirname(db["path"]) or ".", exist_ok=True)
+        # Pooled connections may be used by the threads of a server
+        return sqlite3.connect(db["path"], check_same_thread=False)
+    import pymysql
+    options = dict(
+        user=db["user"],
+        database=db["database"],
+        cursorclass=pymysql.cursors.DictCursor,
+        local_infile=local_infile
+    )
+    if db["password"] is not None:
+        options["password"] = db["password"]
+    if db["unix_socket"] or not db["host"]:
+        options["unix_socket"] = db["unix_socket"] or default_socket
+    else:
+        options.update(host=db["host"], port=db["port"])
+    return pymysql.connect(**options)
+
+
+def is_sqlite(connection):
+    """Check whether a connection is an SQLite one."""
+    return isinstance(connection, sqlite3.Connection)
+
+
+def placeholder(connection):
+    """Return the parameter marker of a connection's driver."""
+    return "?" if is_sqlite(connection) else "%s"
+
+
+def prepare(connection, sql):
+    """Rewrite a statement written with %s placeholders for a connection."""
+    if is_sqlite(connection):
+        return sql.replace("%s", "?")
+    return sql
+
+
+def identifier(name):
+    """Check that a table or column name is safe to put into a query."""
+    if not identifier_pattern.match(name):
+        raise ValueError(f"Invalid SQL identifier '{name}'")
+    return name
+
+
+def fetch_dicts(cursor):
+    """Return the rows of an executed cursor as a list of dicts."""
+    rows = cursor.fetchall()
+    if rows and isinstance(rows[0], dict):
+        return list(rows)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def execute(connection, sql, params=()):
+    """Run one parameterized statement and return the number of rows."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(prepare(connection, sql), params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def executemany(connection, sql, rows):
+    """Run a parameterized statement once for every row."""
+    cursor = connection.cursor()
+    try:
+        cursor.executemany(prepare(connection, sql), rows)
+    finally:
+        cursor.close()
+
+
+def query(connection, sql, params=()):
+    """Run a parameterized query and return its rows as dicts."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(prepare(connection, sql), params)
+        return fetch_dicts(cursor)
+    finally:
+        cursor.close()
+
+
+def table_columns(connection, table):
+    """Return the column names of a table, or None if it does not exist."""
+    if is_sqlite(connection):
+        rows = query(
+            connection, f"PRAGMA table_info({identifier(table)})")
+        return [row["name"] for row in rows] or None
+    rows = query(
+        connection,
+        "SELECT column_name AS name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s "
+        "ORDER BY ordinal_position",
+        (table,)
+    )
+    return [row["name"] for row in rows] or None
+
+
+def rename_tables(connection, renames):
+    """Rename tables as one atomic step.
+
+    renames is a list of (old name, new name) pairs applied in order.
+    MySQL runs them in a single RENAME TABLE; SQLite in one transaction.
+    """
+    if not is_sqlite(connection):
+        execute(connection, "RENAME TABLE {};".format(", ".join(
+            f"{old} TO {new}" for old, new in renames)))
+        return
+    connection.commit()
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN")
+        for old, new in renames:
+            cursor.execute(f"ALTER TABLE {old} RENAME TO {new}")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+
+
+def _pool(db):
+    """Return the pool of this process for the given settings."""
+    key = (os.getpid(),) + tuple(sorted(
+        (k, str(v)) for k, v in db.items()))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = {
+                "idle": queue.LifoQueue(),
+                "slots": threading.BoundedSemaphore(db["pool_size"])
+            }
+        return pools[key]
+
+
+@contextlib.contextmanager
+def pooled_connection(db):
+    """Borrow a connection from a bounded per-process pool.
+
+    At most db["pool_size"] connections are open at once; callers wait up
+    to db["pool_timeout"] seconds for a free one. The transaction is
+    committed when the block succeeds and rolled back otherwise.
+    """
+    pool = _pool(db)
+    if not pool["slots"].acquire(timeout=db["pool_timeout"]):
+        raise TimeoutError("No free database connection in the pool")
+    connection = None
+    try:
+        try:
+            connection = pool["idle"].get_nowait()
+            if not is_sqlite(connection):
+                connection.ping(reconnect=True)
+        except queue.Empty:
+            connection = connect(db)
+        try:
+            yield connection
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        pool["idle"].put(connection)
+    except Exception:
+        if connection is not None:
+            connection.close()
+        raise
+    finally:
+        pool["slots"].release()
+
+
+def close_pools():
+    """Close the idle connections of every pool of this process."""
+    with pools_lock:
+        for pool in pools.values():
+            while True:
+                try:
+                    pool["idle"].get_nowait().close()
+                except queue.Empty:
+                    break
+        pools.clear()
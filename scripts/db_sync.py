@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+
+# Update the tables of a dataset without an empty or half-loaded window.
+# swap_tables builds each table under a shadow name and exchanges all of
+# them in one atomic rename. upsert_tables compares a hash of every row
+# with the hash stored at the previous load and deletes and reinserts only
+# the rows that changed, all in one transaction. Readers of an InnoDB
+# (MySQL/MariaDB) or SQLite database never see uncommitted rows.
+
+import contextlib
+import hashlib
+import db_access
+
+# Suffixes of the tables being built and of the tables being replaced
+shadow_suffix = "__shadow"
+old_suffix = "__old"
+
+# Table holding the hash of every loaded row, keyed by table and row key
+hash_table = "row_hashes"
+
+# Table holding the hash of the column names and types of every table
+schema_table = "table_schemas"
+
+# Number of keys per DELETE statement
+delete_batch_size = 1000
+
+
+def row_hash(row):
+    """Return a digest of the values of a row."""
+    text = "\x1f".join("\\N" if value is None else str(value)
+                       for value in row)
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def create_table(connection, table, columns, key=None):
+    """Create an empty table with an optional primary key column."""
+    definitions = [
+        "`{}` {}".format(column, column_type)
+        for column, column_type in columns
+    ]
+    if key is not None:
+        definitions.append("PRIMARY KEY (`{}`)".format(key))
+    db_access.execute(connection, "CREATE TABLE {} (\n    {}\n);".format(
+        table, ",\n    ".join(definitions)))
+
+
+def schema_hash(columns):
+    """Return a digest of the (column, type) pairs of a table."""
+    return row_hash([f"{column} {column_type}"
+                     for column, column_type in columns])
+
+
+def create_hash_table(connection, prefix=""):
+    """Create the row hash and schema hash tables if they do not exist."""
+    db_access.execute(connection, f"""
+    CREATE TABLE IF NOT EXISTS {prefix}{hash_table} (
+        `table_name` VARCHAR(100) NOT NULL,
+        `row_key` VARCHAR(100) NOT NULL,
+        `row_hash` CHAR(32) NOT NULL,
+        PRIMARY KEY (`table_name`, `row_key`)
+    );
+    """)
+    db_access.execute(connection, f"""
+    CREATE TABLE IF NOT EXISTS {prefix}{schema_table} (
+        `table_name` VARCHAR(100) NOT NULL,
+        `schema_hash` CHAR(32) NOT NULL,
+        PRIMARY KEY (`table_name`)
+    );
+    """)
+
+
+def stored_schema(connection, table_name, prefix=""):
+    """Return the schema hash recorded for a table, or None."""
+    rows = db_access.query(
+        connection,
+        f"SELECT schema_hash FROM {prefix}{schema_table} "
+        "WHERE table_name = %s",
+        (table_name,)
+    )
+    return rows[0]["schema_hash"] if rows else None
+
+
+def stored_hashes(connection, table_name, prefix=""):
+    """Return row key -> hash recorded for a table."""
+    rows = db_access.query(
+        connection,
+        f"SELECT row_key, row_hash FROM {prefix}{hash_table} "
+        "WHERE table_name = %s",
+        (table_name,)
+    )
+    return {row["row_key"]: row["row_hash"] for row in rows}
+
+
+def delete_keys(connection, table, key, keys, where=""):
+    """Delete the rows of a table whose key column is in keys."""
+    keys = list(keys)
+    for start in range(0, len(keys), delete_batch_size):
+        chunk = keys[start:start + delete_batch_size]
+        db_access.execute(
+            connection,
+            "DELETE FROM {} WHERE {}`{}` IN ({})".format(
+                table, where, key, ",".join(["%s"] * len(chunk))),
+            chunk
+        )
+
+
+def delete_hashes(connection, table_name, row_keys, prefix=""):
+    """Forget the recorded hashes of the given row keys."""
+    where = "`table_name` = '{}' AND ".format(
+        db_access.identifier(table_name))
+    delete_keys(connection, f"{prefix}{hash_table}", "row_key", row_keys,
+                where=where)
+
+
+def write_hashes(connection, table_name, hashes, prefix=""):
+    """Replace the recorded hashes of the given row keys."""
+    delete_hashes(connection, table_name, hashes, prefix)
+    if hashes:
+        db_access.executemany(
+            connection,
+            f"INSERT INTO {prefix}{hash_table}"
+            "(`table_name`, `row_key`, `row_hash`) VALUES (%s, %s, %s)",
+            [(table_name, k, h) for k, h in hashes.items()]
+        )
+
+
+def insert_query(table, header):
+    """Return the parameterized INSERT statement for a table."""
+    return "INSERT INTO {}({}) VALUES({})".format(
+        table,
+        ",".join("`{}`".format(column) for column in header),
+        ",".join(["%s"] * len(header))
+    )
+
+
+def swap_tables(connection, schemas, keys, load, prefix=""):
+    """Rebuild tables under shadow names and swap them in at once.
+
+    schemas maps table names to their (column, type) lists and keys maps
+    them to their primary key column. load(connection, table_name,
+    target) fills the shadow table target and returns the number of rows
+    and the row hashes (or None). Until the final rename, readers keep
+    seeing the previous tables. Returns table name -> row count.
+    """
+    row_counts = {}
+    hashes = {}
+    for table_name, columns in schemas.items():
+        shadow = f"{prefix}{table_name}{shadow_suffix}"
+        db_access.execute(connection, f"DROP TABLE IF EXISTS {shadow};")
+        create_table(connection, shadow, columns, keys.get(table_name))
+        connection.commit()
+        row_counts[table_name], hashes[table_name] = load(
+            connection, table_name, shadow)
+
+    # Forget the old hashes first, so a failure before they are rewritten
+    # leads to a rebuild instead of a wrong diff
+    create_hash_table(connection, prefix)
+    for table_name in schemas:
+        for table in (hash_table, schema_table):
+            db_access.execute(
+                connection,
+                f"DELETE FROM {prefix}{table} WHERE table_name = %s",
+                (table_name,))
+    connection.commit()
+
+    # Exchange every table in one atomic step
+    renames = []
+    replaced = []
+    for table_name in schemas:
+        table = f"{prefix}{table_name}"
+        if db_access.table_columns(connection, table) is not None:
+            renames.append((table, f"{table}{old_suffix}"))
+            replaced.append(f"{table}{old_suffix}")
+        renames.append((f"{table}{shadow_suffix}", table))
+    db_access.rename_tables(connection, renames)
+    for table in replaced:
+        db_access.execute(connection, f"DROP TABLE IF EXISTS {table};")
+
+    for table_name, table_hashes in hashes.items():
+        if table_hashes is not None:
+            write_hashes(connection, table_name, table_hashes, prefix)
+    db_access.executemany(
+        connection,
+        f"INSERT INTO {prefix}{schema_table}(`table_name`, `schema_hash`) "
+        "VALUES (%s, %s)",
+        [(table_name, schema_hash(columns))
+         for table_name, columns in schemas.items()]
+    )
+    connection.commit()
+    print(f"Swapped in {len(schemas)} rebuilt tables.")
+    return row_counts
+
+
+def insert_hashed(connection, table, key, batches):
+    """Insert all batches into a table and return the rows and hashes."""
+    header = next(batches)
+    key_index = header.index(key)
+    statement = insert_query(table, header)
+    hashes = {}
+    row_count = 0
+    try:
+        for batch in batches:
+            db_access.executemany(connection, statement, batch)
+            for row in batch:
+                hashes[row[key_index]] = row_hash(row)
+            row_count += len(batch)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return row_count, hashes
+
+
+def upsert_table(connection, table_name, key, batches, hashes, prefix=""):
+    """Write the changed rows of one table without committing.
+
+    Returns (rows written, rows deleted, rows unchanged).
+    """
+    table = f"{prefix}{table_name}"
+    header = next(batches)
+    key_index = header.index(key)
+    statement = insert_query(table, header)
+    seen = set()
+    written = 0
+    for batch in batches:
+        changed = {}
+        rows = []
+        for row in batch:
+            row_key = row[key_index]
+            seen.add(row_key)
+            digest = row_hash(row)
+            if hashes.get(row_key) != digest:
+                changed[row_key] = digest
+                rows.append(row)
+        if rows:
+            delete_keys(connection, table, key, changed)
+            db_access.executemany(connection, statement, rows)
+            write_hashes(connection, table_name, changed, prefix)
+            written += len(rows)
+    removed = [row_key for row_key in hashes if row_key not in seen]
+    delete_keys(connection, table, key, removed)
+    delete_hashes(connection, table_name, removed, prefix)
+    return written, len(removed), len(seen) - written
+
+
+def upsert_tables(connection, schemas, keys, batches, prefix="",
+                  table_stage=None):
+    """Bring tables up to date by changing only the rows that differ.
+
+    batches(table_name) returns an iterator yielding the column names and
+    then lists of rows. Rows are matched on their key column and compared
+    by hash; new and changed rows are deleted and reinserted and rows no
+    longer present are deleted, for all tables in a single transaction.
+    Tables that do not exist yet, whose column names or types changed or
+    that have no recorded hashes are rebuilt with swap_tables first.
+    Returns table name -> (rows written, rows deleted, rows unchanged).
+
+    table_stage(table_name), if given, returns a context manager wrapped
+    around the load of each table; it yields a dict whose "rows" is set to
+    the number of rows of the table processed.
+    """
+    if table_stage is None:
+        def table_stage(table_name):
+            return contextlib.nullcontext({})
+    create_hash_table(connection, prefix)
+    connection.commit()
+    rebuild = {}
+    previous = {}
+    for table_name, columns in schemas.items():
+        names = [column for column, _ in columns]
+        hashes = stored_hashes(connection, table_name, prefix)
+        table = f"{prefix}{table_name}"
+        if (db_access.table_columns(connection, table) != names
+                or stored_schema(connection, table_name, prefix)
+                != schema_hash(columns)
+                or not hashes):
+            rebuild[table_name] = columns
+        else:
+            previous[table_name] = hashes
+
+    stats = {}
+    if rebuild:
+        print(f"Rebuilding tables: {', '.join(rebuild)}")
+
+        def load(connection, table_name, target):
+            with table_stage(table_name) as record:
+                row_count, hashes = insert_hashed(
+                    connection, target, keys[table_name],
+                    batches(table_name))
+                record["rows"] = row_count
+            return row_count, hashes
+
+        row_counts = swap_tables(connection, rebuild, keys, load, prefix)
+        for table_name, row_count in row_counts.items():
+            stats[table_name] = (row_count, 0, 0)
+
+    # Apply the differences of every other table in one transaction
+    try:
+        for table_name, hashes in previous.items():
+            with table_stage(table_name) as record:
+                stats[table_name] = upsert_table(
+                    connection, table_name, keys[table_name],
+                    batches(table_name), hashes, prefix)
+                written, _, unchanged = stats[table_name]
+                record["rows"] = written + unchanged
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+
+    for table_name, (written, removed, unchanged) in stats.items():
+        print(f"Table '{prefix}{table_name}': {written} rows written, "
+              f"{removed} deleted, {unchanged} unchanged")
+    return stats
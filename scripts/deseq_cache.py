@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+# Content-addressed on-disk cache for fitted DeseqDataSet objects.
+# Entries are keyed by a hash of everything that determines the fit, so a
+# re-run on unchanged inputs can skip dds.deseq2() entirely.
+
+import hashlib
+import os
+import pickle
+import tempfile
+import pandas as pd
+import pydeseq2
+
+# Default cache location and size bound
+default_cache_dir = "../results/.deseq_cache"
+default_max_bytes = 2 * 1024 ** 3
+
+# File extension of the cache entries
+extension = ".pkl"
+
+
+def fingerprint(counts, metadata, design_factors, **fit_options):
+    """Return a hex digest identifying a DESeq2 fit.
+
+    The key covers the count matrix (values, sample and gene labels), the
+    metadata, the design factors, any extra fit options and the installed
+    pydeseq2 version.
+    """
+    digest = hashlib.sha256()
+    for frame in (counts, metadata):
+        digest.update(pd.util.hash_pandas_object(frame, index=True).values)
+        digest.update(repr(list(frame.columns)).encode())
+        digest.update(repr([str(d) for d in frame.dtypes]).encode())
+    digest.update(repr(design_factors).encode())
+    digest.update(repr(sorted(fit_options.items())).encode())
+    digest.update(pydeseq2.__version__.encode())
+    return digest.hexdigest()
+
+
+def entry_path(cache_dir, key):
+    """Return the path of a cache entry from its key."""
+    return os.path.join(cache_dir, f"{key}{extension}")
+
+
+def load(cache_dir, key):
+    """Return the cached DeseqDataSet for key, or None on a miss.
+
+    A hit refreshes the entry's modification time, which is what the LRU
+    eviction orders by.
+    """
+    path = entry_path(cache_dir, key)
+    try:
+        with open(path, "rb") as file:
+            dds = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        # Corrupt or incompatible entry, drop it and refit
+        os.remove(path)
+        return None
+    os.utime(path)
+    return dds
+
+
+def store(cache_dir, key, dds, max_bytes=default_max_bytes):
+    """Save a fitted DeseqDataSet under key and evict old entries."""
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so readers never see partial entries
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(dds, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path(cache_dir, key))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    evict(cache_dir, max_bytes, keep=key)
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """Remove least recently used entries until the cache fits max_bytes.
+
+    The entry named by keep is never removed. Returns the removed keys.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(extension):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        key = name[:-len(extension)]
+        if key == keep:
+            continue
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+        removed.append(key)
+    return removed
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+# Heatmaps of thousands of genes.
+# bioinfokit's hmap clusters the full genes x genes distance matrix and
+# draws one cell per value, which limits it to a few dozen genes. Here rows
+# are z-scored in place with NumPy. Small gene sets are ordered by average
+# linkage. Larger ones are grouped by k-means on their leading principal
+# components, the centroids are ordered by linkage and each group's genes
+# are ordered along the first component. With at most max_groups groups,
+# time and memory grow linearly with the genes. The row order of a gene set
+# can be cached on disk, and the matrix is drawn as a single raster image.
+
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import matplotlib
+# Render without a display; must be selected before pyplot is imported
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from scipy.cluster import hierarchy
+
+# Largest gene set ordered by exact average linkage
+exact_rows = 2000
+
+# Principal components the k-means grouping works on
+n_components = 20
+
+# k-means iterations of the grouping, and its largest number of groups;
+# a fixed cap keeps each iteration linear in the number of genes
+kmeans_iterations = 25
+max_groups = 100
+
+# Label every row or column up to this many of them
+max_labels = 60
+
+
+def zscore_rows(values):
+    """Z-score the rows of a 2-D float array in place; returns it.
+
+    Rows without variance become 0.
+    """
+    values -= values.mean(axis=1, keepdims=True)
+    std = values.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+    values /= std
+    return values
+
+
+def leading_components(values, k=n_components):
+    """Project the (centered) rows on their k leading principal components."""
+    k = min(k, *values.shape)
+    centered = values - values.mean(axis=0)
+    # Eigenvectors of the small samples x samples covariance keep this
+    # linear in the number of rows
+    _, vectors = np.linalg.eigh(centered.T @ centered)
+    return centered @ vectors[:, ::-1][:, :k]
+
+
+def kmeans(points, k, iterations=kmeans_iterations, seed=0):
+    """Group points with Lloyd's k-means; returns labels and centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), size=k, replace=False)]
+    sq_norms = (points ** 2).sum(axis=1)
+    for _ in range(iterations):
+        distances = (sq_norms[:, None] - 2 * points @ centroids.T
+                     + (centroids ** 2).sum(axis=1))
+        labels = distances.argmin(axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, points)
+        empty = counts == 0
+        new_centroids = np.where(
+            empty[:, None], centroids,
+            sums / np.maximum(counts, 1)[:, None])
+        if np.allclose(new_centroids, centroids):
+            break
+        centroids = new_centroids
+    return labels, centroids
+
+
+def order_rows(values, seed=0):
+    """Return a clustered row order of a z-scored genes x samples array."""
+    n = len(values)
+    if n < 3:
+        return np.arange(n)
+    if n <= exact_rows:
+        return hierarchy.leaves_list(
+            hierarchy.linkage(values, method="average"))
+    points = leading_components(values)
+    k = min(max_groups, int(np.sqrt(n)))
+    labels, centroids = kmeans(points, k, seed=seed)
+    group_order = hierarchy.leaves_list(
+        hierarchy.linkage(centroids, method="average"))
+    # Within a group, sort along the first component; the stable lexsort
+    # puts the groups in linkage order
+    rank = np.empty(k, dtype=np.int64)
+    rank[group_order] = np.arange(k)
+    return np.lexsort((points[:, 0], rank[labels]))
+
+
+def order_key(df):
+    """Return the digest of the genes, samples and values of a heatmap."""
+    digest = hashlib.sha256()
+    digest.update(repr(list(df.index)).encode())
+    digest.update(repr(list(df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values)
+    return digest.hexdigest()
+
+
+def cached_order(df, values, cache_dir=None):
+    """Return the row order of a heatmap, reusing a cached one.
+
+    Orders are stored in cache_dir by the digest of the gene set and its
+    values, so a heatmap redrawn with other display settings, or the same
+    genes drawn in another figure, is not clustered again.
+    """
+    if cache_dir is None:
+        return order_rows(values)
+    path = os.path.join(cache_dir, order_key(df) + ".npy")
+    if os.path.exists(path):
+        return np.load(path)
+    order = order_rows(values)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, order)
+    os.replace(tmp_path, path)
+    return order
+
+
+def draw_heatmap(df, path, cache_dir=None, cmap="RdYlGn", dim=(6, 8),
+                 dpi=300, cluster_samples=True):
+    """Draw a z-scored, clustered heatmap of a genes x samples DataFrame.
+
+    The matrix is shown as one image, so the drawing time does not depend
+    on the number of cells. Row and column labels are shown when there
+    are at most max_labels of them.
+    """
+    values = zscore_rows(df.to_numpy(dtype=np.float32, copy=True))
+    rows = cached_order(df, values, cache_dir)
+    columns = np.arange(values.shape[1])
+    if cluster_samples and values.shape[1] > 2:
+        # Few samples: exact linkage of the sample profiles is cheap
+        columns = hierarchy.leaves_list(
+            hierarchy.linkage(values.T, method="average"))
+    values = values[rows][:, columns]
+
+    fig, ax = plt.subplots(figsize=dim)
+    # Scale the colours to the bulk of the values, not to outliers
+    limit = float(np.percentile(np.abs(values), 99)) or 1.0
+    image = ax.imshow(values, aspect="auto", interpolation="nearest",
+                      cmap=cmap, vmin=-limit, vmax=limit)
+    if len(rows) <= max_labels:
+        ax.set_yticks(np.arange(len(rows)))
+        ax.set_yticklabels(df.index[rows], fontsize=4)
+    else:
+        ax.set_yticks([])
+        ax.set_ylabel(f"{len(rows)} genes")
+    if len(columns) <= max_labels:
+        ax.set_xticks(np.arange(len(columns)))
+        ax.set_xticklabels(df.columns[columns], fontsize=6, rotation=90)
+    else:
+        ax.set_xticks([])
+        ax.set_xlabel(f"{len(columns)} samples")
+    fig.colorbar(image, ax=ax, label="z-score", shrink=0.5)
+    fig.savefig(path, dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+# Low-count gene filter applied before the DESeq2 fit.
+# Genes with too few reads to be tested are dropped up front instead of
+# going through size factor, dispersion, LFC and Cook's fitting only to be
+# removed by independent filtering. The rules are group aware: a gene is
+# kept when it reaches a threshold in at least as many samples as the
+# smallest group of the design factor has, so genes expressed in one
+# condition only survive.
+
+import numpy as np
+
+# Rules used when the prefilter is switched on without options
+default_rules = {
+    "min_count": 10,
+    "min_cpm": None,
+    "min_samples": None,
+    "min_total": None
+}
+
+
+def smallest_group(metadata, factor):
+    """Return the number of samples of the smallest design factor level."""
+    return int(metadata[factor].value_counts().min())
+
+
+def prefilter(counts, metadata, factor, rules=None):
+    """Drop the genes failing the prefilter rules.
+
+    counts is a samples x genes DataFrame. rules (see default_rules) are:
+      min_count    reads a sample needs for the gene to count as expressed
+      min_cpm      counts per million a sample needs, on its library size
+      min_samples  samples that must pass (default: smallest group size)
+      min_total    reads the gene needs across all samples
+    Exactly the rules given are applied; rules None or True stands for
+    default_rules. Returns the kept counts and a dict with the number of
+    genes in, removed by each rule (the first one failed) and kept.
+    """
+    if rules is None or rules is True:
+        rules = default_rules
+    unknown = set(rules) - set(default_rules)
+    if unknown:
+        raise ValueError(f"Unknown prefilter rules: {sorted(unknown)}")
+    rules = dict(dict.fromkeys(default_rules), **rules)
+    values = counts.to_numpy()
+    min_samples = rules["min_samples"] or smallest_group(metadata, factor)
+    keep = np.ones(values.shape[1], dtype=bool)
+    stats = {"genes_in": values.shape[1], "min_samples": min_samples}
+
+    checks = []
+    if rules["min_count"]:
+        checks.append(("min_count", lambda: (
+            (values >= rules["min_count"]).sum(axis=0) >= min_samples)))
+    if rules["min_cpm"]:
+        # Compare with each sample's count threshold, not a CPM matrix
+        def passes_cpm():
+            library_sizes = values.sum(axis=1, dtype=np.float64)
+            thresholds = rules["min_cpm"] * library_sizes / 1e6
+            return (values >= thresholds[:, None]).sum(axis=0) >= min_samples
+        checks.append(("min_cpm", passes_cpm))
+    if rules["min_total"]:
+        checks.append(("min_total", lambda: (
+            values.sum(axis=0, dtype=np.uint64) >= rules["min_total"])))
+
+    for rule, check in checks:
+        failed = keep & ~check()
+        stats[f"removed_{rule}"] = int(failed.sum())
+        keep &= ~failed
+    stats["genes_kept"] = int(keep.sum())
+    if keep.all():
+        return counts, stats
+    return counts.loc[:, keep], stats
@@ -1,8 +1,13 @@
 #!/usr/bin/python3
 
-# Import libraries
+# Import libraries; pandas and the results store (NumPy, PyArrow) are
+# imported by the functions using them, so converting TSV files alone and
+# "brca_gea.py sql --help" start without them
+import argparse
 import os
-import pandas as pd
+import acquire_data
+import pipeline_config
+import stage_profiler
 
 # Define functions to convert TSV/CSV to MySQL INSERT statements
 
@@ -14,88 +19,193 @@ def add_backticks(row, delimiter='\t'):
     return ",".join(output)
 
 
-def add_quotes(row, delimiter='\t'):
-    """Wrap values in single quotes."""
+def add_quotes(row, delimiter='\t', null=None):
+    """Wrap values in single quotes.
+
+    If null is given, empty values are written as that literal instead.
+    """
     values = row.split(delimiter)
-    output = ["'{}'".format(value) for value in values]
+    output = [
+        null if null is not None and value == '' else "'{}'".format(value)
+        for value in values
+    ]
     return ",".join(output)
 
 
-def csv_to_mysql(table, csv_file_path, delimiter='\t'):
-    """This function converts a CSV/TSV file to MySQL INSERT statements."""
-    with open(csv_file_path, 'r') as file:
-        csv_array = file.readlines()
-    header_str = add_backticks(csv_array[0].strip(), delimiter)
-    sql_statement = ""
-    # Generate INSERT statements for each row in the table
-    for row in csv_array[1:]:
-        row_str = add_quotes(row.strip(), delimiter)
-        sql_statement += "INSERT INTO {}({}) VALUES({}); \n".format(table, header_str, row_str)
-    return sql_statement
-
-
-# Read the TSV file into a dataframe
-file_path = "../data/E-GEOD-52194-experiment-design.tsv"
-df = pd.read_csv(file_path, sep='\t')
-
-# Remove rows for samples not analyzed
-filtered_df = df[df['Analysed'] != 'No']
-
-# Select and rename specific columns to be short and clear
-selected_columns = {
-    'Run': 'Sample_ID',
-    'Sample Characteristic[clinical information]': 'Condition',
-    'Sample Characteristic[disease]': 'Disease'
-}
-filtered_df = filtered_df[list(selected_columns.keys())].rename(columns=selected_columns)
-
-# Save the filtered DataFrame to a new TSV file
-output_file_path = "../data/E-GEOD-52194-experiment-design-filtered.tsv"
-filtered_df.to_csv(output_file_path, sep='\t', index=False)
-print(f"Filtered data is saved")
-
-# Specify the paths to the data files
-raw_counts_path = "../data/E-GEOD-52194-raw-counts.tsv"
-metadata_path = "../data/E-GEOD-52194-experiment-design-filtered.tsv"
-
-# Generate SQL statements for the raw data files (TSV)
-raw_counts_sql = csv_to_mysql('raw_counts', raw_counts_path, delimiter='\t')
-metadata_sql = csv_to_mysql('experiment_metadata', metadata_path, delimiter='\t')
-
-# Create a directory to save results
-output_dir = "../results/sql_outputs"
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-    print(f"Directory created!")
-else:
-    print(f"Directory already exists.")
-
-# Save the insert statements to SQL files
-with open(f"{output_dir}/raw_counts.sql", "w") as raw_counts_file:
-    raw_counts_file.write(raw_counts_sql)
-
-with open(f"{output_dir}/metadata.sql", "w") as metadata_file:
-    metadata_file.write(metadata_sql)
-
-# Set the filename of CSV files from differential analysis results 
-analysed_csv_files = {
-    "tnbc_vs_normal_results": "tnbc_vs_normal_results.csv",
-    "nontnbc_vs_normal_results": "nontnbc_vs_normal_results.csv",
-    "her2_vs_normal_results": "her2_vs_normal_results.csv",
-    "tnbc_vs_nontnbc_results": "tnbc_vs_nontnbc_results.csv",
-    "tnbc_vs_her2_results": "tnbc_vs_her2_results.csv",
-    "nontnbc_vs_her2_results": "nontnbc_vs_her2_results.csv",
-    "normalized_counts": "normalized_counts.csv"
-}
-
-# Process each CSV file, generate INSERT statements and save to sql file
-for table_name, file_name in analysed_csv_files.items():
-    file_path = f"../results/deseq_analysis/{file_name}"
-    sql_statements = csv_to_mysql(table_name, file_path, delimiter=',')
-    output_file_path = f"{output_dir}/{table_name}.sql"
-    with open(output_file_path, "w") as sql_file:
-        sql_file.write(sql_statements)
-        print(f"SQL statements for '{table_name}' saved to {output_dir}")
-
-# Print statement to show process is finished
-print("All SQL statements for TSV and CSV files is saved")
+def iter_insert_statements(table, csv_file_path, delimiter='\t',
+                           batch_size=1000):
+    """Lazily yield multi-row INSERT statements for a CSV/TSV file.
+
+    Rows are read one at a time and grouped into statements of at most
+    batch_size rows, so memory use does not depend on the file size. Empty
+    fields are written as NULL.
+    """
+    with acquire_data.open_text(csv_file_path) as file:
+        header = file.readline()
+        if not header:
+            return
+        prefix = "INSERT INTO {}({}) VALUES".format(
+            table, add_backticks(header.rstrip("\r\n"), delimiter))
+        batch = []
+        for row in file:
+            if not row.strip():
+                continue
+            row_str = add_quotes(
+                row.rstrip("\r\n"), delimiter, null="NULL")
+            batch.append("({})".format(row_str))
+            if len(batch) >= batch_size:
+                yield "{}{}; \n".format(prefix, ",".join(batch))
+                batch = []
+        if batch:
+            yield "{}{}; \n".format(prefix, ",".join(batch))
+
+
+def csv_to_mysql(table, csv_file_path, output_file, delimiter='\t',
+                 batch_size=1000):
+    """Convert a CSV/TSV file to MySQL INSERT statements.
+
+    Statements are streamed straight to the open output_file handle.
+    """
+    for statement in iter_insert_statements(
+            table, csv_file_path, delimiter, batch_size):
+        output_file.write(statement)
+
+
+def store_to_mysql(table, store_path, output_file, batch_size=1000):
+    """Convert a table from the columnar results store to INSERT statements.
+
+    Values are quoted the same way as add_quotes does for CSV rows, with
+    missing values written as NULL.
+    """
+    import results_store
+    batches_to_mysql(
+        table, results_store.iter_row_batches(store_path, batch_size),
+        output_file)
+
+
+def frame_to_mysql(table, df, output_file, batch_size=1000):
+    """Convert a DataFrame indexed by Gene ID to INSERT statements.
+
+    Gives the same statements as store_to_mysql on the stored table.
+    """
+    import normalized_schema
+    import results_store
+    df = df.rename_axis(results_store.index_column).reset_index()
+    batches_to_mysql(
+        table, normalized_schema.frame_batches(df, batch_size), output_file)
+
+
+def batches_to_mysql(table, batches, output_file):
+    """Write INSERT statements for a header and row batches."""
+    header = next(batches)
+    prefix = "INSERT INTO {}({}) VALUES".format(
+        table, add_backticks('\t'.join(header)))
+    for batch in batches:
+        rows = [
+            "({})".format(",".join(
+                "NULL" if value is None else "'{}'".format(value)
+                for value in row
+            ))
+            for row in batch
+        ]
+        output_file.write("{}{}; \n".format(prefix, ",".join(rows)))
+
+
+def generate_sql(settings, batch_size=1000, tables=None):
+    """Write the INSERT statements of every table of one dataset.
+
+    settings are the resolved dataset settings from pipeline_config. The
+    .sql files are written to settings["sql_dir"] and table names are
+    prefixed with settings["table_prefix"]. tables may map analysis table
+    names to DataFrames already in memory, which are then used instead of
+    reading the stored tables.
+    """
+    import pandas as pd
+    import results_store
+    tables = tables or {}
+    prefix = settings["table_prefix"]
+
+    # Read the TSV file into a dataframe
+    df = pd.read_csv(settings["design"], sep='\t')
+
+    # Remove rows for samples not analyzed
+    filtered_df = df[df['Analysed'] != 'No']
+
+    # Select and rename specific columns to be short and clear
+    selected_columns = settings["metadata_columns"]
+    filtered_df = filtered_df[list(selected_columns.keys())]
+    filtered_df = filtered_df.rename(columns=selected_columns)
+
+    # Save the filtered DataFrame to a new TSV file
+    filtered_df.to_csv(settings["filtered_design"], sep='\t', index=False)
+    print(f"Filtered data is saved")
+
+    # Specify the paths to the data files
+    raw_counts_path = settings["raw_counts"]
+    metadata_path = settings["filtered_design"]
+
+    # Create a directory to save results
+    output_dir = settings["sql_dir"]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        print(f"Directory created!")
+    else:
+        print(f"Directory already exists.")
+
+    # Generate SQL statements for the raw data files (TSV) and save them
+    with stage_profiler.stage("sql:raw_counts"), \
+            open(f"{output_dir}/raw_counts.sql", "w") as raw_counts_file:
+        csv_to_mysql(f"{prefix}raw_counts", raw_counts_path, raw_counts_file,
+                     delimiter='\t', batch_size=batch_size)
+
+    with stage_profiler.stage("sql:experiment_metadata"), \
+            open(f"{output_dir}/metadata.sql", "w") as metadata_file:
+        csv_to_mysql(f"{prefix}experiment_metadata", metadata_path,
+                     metadata_file, delimiter='\t', batch_size=batch_size)
+
+    # Process each stored table, generate INSERT statements and save to sql
+    deseq_dir = settings["deseq_dir"]
+    for table_name in results_store.analysis_tables(deseq_dir):
+        store_path = results_store.table_path(deseq_dir, table_name)
+        output_file_path = f"{output_dir}/{table_name}.sql"
+        with stage_profiler.stage(f"sql:{table_name}"), \
+                open(output_file_path, "w") as sql_file:
+            if table_name in tables:
+                frame_to_mysql(f"{prefix}{table_name}", tables[table_name],
+                               sql_file, batch_size=batch_size)
+            else:
+                store_to_mysql(f"{prefix}{table_name}", store_path,
+                               sql_file, batch_size=batch_size)
+            print(f"SQL statements for '{table_name}' saved to {output_dir}")
+
+    # Print statement to show process is finished
+    print("All SQL statements for TSV files and results tables is saved")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate INSERT statements from the pipeline data."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Rows per multi-row INSERT statement (default: 1000)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    stage_profiler.context["dataset"] = settings["name"]
+    try:
+        generate_sql(settings, batch_size=args.batch_size)
+    finally:
+        stage_profiler.write_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+
+# Precomputed gene-level index of the differential expression results.
+# Written once after the analysis, it holds for every contrast the row
+# order of the genes by pvalue and padj, packed significance bitmaps at
+# standard thresholds and the log2FoldChange/pvalue/padj values, plus
+# sorted gene name and ID keys mapping to rows. All arrays are .npy files
+# read with memory mapping, so top genes and "is gene X significant in
+# contrast Y" lookups touch a few pages instead of loading and sorting the
+# results tables.
+
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pipeline_config
+import results_store
+import significance
+
+# Directory of the index inside the analysis output directory
+index_dirname = "hit_index"
+meta_name = "index.json"
+
+# Columns kept for every contrast and the columns genes are ordered by
+value_columns = ["log2FoldChange", "pvalue", "padj"]
+order_columns = ["pvalue", "padj"]
+
+# Thresholds with a precomputed significance bitmap; other thresholds are
+# evaluated on the stored values
+standard_alphas = [0.01, 0.05, 0.1]
+standard_lfc_thresholds = [0.0, 0.5, 1.0]
+
+
+def index_dir(deseq_dir):
+    """Return the index directory of an analysis output directory."""
+    return os.path.join(deseq_dir, index_dirname)
+
+
+def bitmap_name(contrast_id, column, alpha, lfc_threshold):
+    """Return the array name of a significance bitmap."""
+    return f"{contrast_id}_{column}_{alpha:g}_{lfc_threshold:g}_bits"
+
+
+def significant(values, column, alpha, lfc_threshold):
+    """Return the significance calls of a genes x value_columns array.
+
+    Applies significance.significant_calls to the column and the
+    log2FoldChange values.
+    """
+    return significance.significant_calls(
+        values[:, value_columns.index(column)],
+        values[:, value_columns.index("log2FoldChange")],
+        alpha, lfc_threshold)
+
+
+def sorted_keys(keys):
+    """Return the sorted keys and the rows they come from."""
+    order = np.argsort(keys, kind="stable")
+    return keys[order], order.astype(np.int32)
+
+
+def build_index(deseq_dir, results):
+    """Write the index of the results of every contrast.
+
+    results maps contrast names to results tables indexed by Gene ID with
+    a Gene_Name column, as written by run_deseq_analysis.py. Without
+    contrasts the index is empty and lookups find no genes. The index is
+    built next to the old one and swapped in when complete.
+    """
+    names = list(results)
+    first = results[names[0]] if names else pd.DataFrame(
+        {"Gene_Name": pd.Series([], dtype=object)})
+    genes = first.index
+    arrays = {
+        "gene_ids": np.asarray(genes.astype(str), dtype=str),
+        "gene_names": np.asarray(
+            first["Gene_Name"].astype(object).fillna("").astype(str),
+            dtype=str)
+    }
+    arrays["id_keys"], arrays["id_rows"] = sorted_keys(arrays["gene_ids"])
+    arrays["name_keys"], arrays["name_rows"] = sorted_keys(
+        arrays["gene_names"])
+
+    valid = {}
+    for contrast_id, name in enumerate(names):
+        values = results[name].reindex(genes)[value_columns].to_numpy(
+            dtype=np.float64)
+        arrays[f"{contrast_id}_values"] = values
+        for column in order_columns:
+            # NaN values sort last, after the valid count
+            column_values = values[:, value_columns.index(column)]
+            arrays[f"{contrast_id}_{column}_order"] = np.argsort(
+                column_values, kind="stable").astype(np.int32)
+            valid[f"{contrast_id}_{column}"] = int(
+                np.count_nonzero(~np.isnan(column_values)))
+            for alpha in standard_alphas:
+                for lfc_threshold in standard_lfc_thresholds:
+                    arrays[bitmap_name(
+                        contrast_id, column, alpha, lfc_threshold)] = (
+                        np.packbits(significant(
+                            values, column, alpha, lfc_threshold)))
+
+    path = index_dir(deseq_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for array_name, data in arrays.items():
+        np.save(os.path.join(tmp_path, array_name + ".npy"), data)
+    meta = {
+        "contrasts": names,
+        "n_genes": len(genes),
+        "valid": valid,
+        "alphas": standard_alphas,
+        "lfc_thresholds": standard_lfc_thresholds
+    }
+    with open(os.path.join(tmp_path, meta_name), "w") as file:
+        json.dump(meta, file, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def build_from_store(deseq_dir):
+    """Write the index from the results tables stored in deseq_dir."""
+    results = {
+        name: results_store.read_table(
+            results_store.table_path(deseq_dir, f"{name}_results"),
+            columns=value_columns + ["Gene_Name"])
+        for name in results_store.read_manifest(deseq_dir)
+    }
+    build_index(deseq_dir, results)
+
+
+def open_index(deseq_dir, build=False):
+    """Open the index of an analysis output directory.
+
+    Returns a dict holding the index metadata; arrays are memory mapped
+    on first use. A missing index is built from the results tables if
+    build is set, otherwise FileNotFoundError is raised.
+    """
+    path = index_dir(deseq_dir)
+    if build and not os.path.exists(os.path.join(path, meta_name)):
+        build_from_store(deseq_dir)
+    with open(os.path.join(path, meta_name), "r") as file:
+        meta = json.load(file)
+    return {"path": path, "meta": meta, "arrays": {}}
+
+
+def array(index, name):
+    """Return a memory mapped array of an index."""
+    if name not in index["arrays"]:
+        index["arrays"][name] = np.load(
+            os.path.join(index["path"], name + ".npy"), mmap_mode="r")
+    return index["arrays"][name]
+
+
+def contrast_id(index, contrast):
+    """Return the position of a contrast in the index."""
+    try:
+        return index["meta"]["contrasts"].index(contrast)
+    except ValueError:
+        raise KeyError(f"Unknown contrast '{contrast}'") from None
+
+
+def gene_rows(index, gene):
+    """Return the rows of a gene, given by ID or name (names may repeat)."""
+    for kind in ("id", "name"):
+        keys = array(index, f"{kind}_keys")
+        start = np.searchsorted(keys, gene, side="left")
+        stop = np.searchsorted(keys, gene, side="right")
+        if stop > start:
+            return np.asarray(array(index, f"{kind}_rows")[start:stop])
+    return np.array([], dtype=np.int32)
+
+
+def significant_mask(index, contrast, column="pvalue", alpha=0.05,
+                     lfc_threshold=0.5, rows=None):
+    """Return the significance calls of a contrast, for rows or all genes.
+
+    Standard thresholds are read from the bitmaps, others are computed
+    from the stored values.
+    """
+    i = contrast_id(index, contrast)
+    meta = index["meta"]
+    if alpha in meta["alphas"] and lfc_threshold in meta["lfc_thresholds"]:
+        bits = array(index, bitmap_name(i, column, alpha, lfc_threshold))
+        if rows is None:
+            return np.unpackbits(bits, count=meta["n_genes"]).astype(bool)
+        rows = np.asarray(rows)
+        return ((bits[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
+    values = array(index, f"{i}_values")
+    if rows is not None:
+        values = values[np.asarray(rows)]
+    return significant(values, column, alpha, lfc_threshold)
+
+
+def is_significant(index, gene, contrast, column="pvalue", alpha=0.05,
+                   lfc_threshold=0.5):
+    """Check whether a gene (ID or name) is significant in a contrast."""
+    rows = gene_rows(index, gene)
+    if len(rows) == 0:
+        raise KeyError(f"Unknown gene '{gene}'")
+    return bool(significant_mask(
+        index, contrast, column, alpha, lfc_threshold, rows).any())
+
+
+def gene_table(index, rows, contrast=None):
+    """Return the genes at the given rows, with a contrast's values."""
+    rows = np.asarray(rows, dtype=np.int64)
+    table = pd.DataFrame(
+        {"Gene_Name": array(index, "gene_names")[rows]},
+        index=pd.Index(array(index, "gene_ids")[rows],
+                       name=results_store.index_column)
+    )
+    if contrast is not None:
+        values = array(index, f"{contrast_id(index, contrast)}_values")
+        for j, column in enumerate(value_columns):
+            table[column] = values[rows, j]
+    return table
+
+
+def top_rows(index, contrast, n=10, column="pvalue", threshold=None):
+    """Return the rows of the n genes with the lowest column value.
+
+    Genes with a missing value are left out. threshold may be a (column,
+    alpha, lfc_threshold) tuple restricting the genes to significant ones.
+    """
+    i = contrast_id(index, contrast)
+    valid = index["meta"]["valid"][f"{i}_{column}"]
+    order = array(index, f"{i}_{column}_order")
+    if threshold is None:
+        return np.asarray(order[:min(n, valid)])
+    mask = significant_mask(index, contrast, *threshold)
+    order = np.asarray(order[:valid])
+    return order[mask[order]][:n]
+
+
+def top_genes(index, contrast, n=10, column="pvalue", threshold=None):
+    """Return the n genes with the lowest pvalue (or padj) of a contrast."""
+    return gene_table(
+        index, top_rows(index, contrast, n, column, threshold), contrast)
+
+
+def significance_matrix(index, column="pvalue", alpha=0.05,
+                        lfc_threshold=0.5):
+    """Return a genes x contrasts boolean DataFrame of significant calls.
+
+    Calls follow significance.significant_calls.
+    """
+    calls = {
+        contrast: significant_mask(
+            index, contrast, column, alpha, lfc_threshold)
+        for contrast in index["meta"]["contrasts"]
+    }
+    return pd.DataFrame(
+        calls,
+        index=pd.Index(np.asarray(array(index, "gene_ids")),
+                       name=results_store.index_column)
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Query the gene-level index of the analysis results."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--column",
+        choices=order_columns,
+        default="pvalue",
+        help="Column genes are ranked and called by (default: pvalue)"
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.05,
+        help="Significance threshold (default: 0.05)"
+    )
+    parser.add_argument(
+        "--lfc-threshold",
+        type=float,
+        default=0.5,
+        help="Minimum absolute log2FoldChange (default: 0.5)"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    top = commands.add_parser("top", help="Top genes of a contrast")
+    top.add_argument("contrast", help="Contrast name")
+    top.add_argument(
+        "-n",
+        type=int,
+        default=10,
+        help="Number of genes (default: 10)"
+    )
+    top.add_argument(
+        "--significant",
+        action="store_true",
+        help="Only list significant genes"
+    )
+    gene = commands.add_parser(
+        "gene", help="Significance of a gene in every contrast")
+    gene.add_argument("gene", help="Gene name or ID")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    index = open_index(settings["deseq_dir"], build=True)
+    threshold = (args.column, args.alpha, args.lfc_threshold)
+    if args.command == "top":
+        print(top_genes(
+            index, args.contrast, args.n, args.column,
+            threshold if args.significant else None).to_string())
+        return
+    for contrast in index["meta"]["contrasts"]:
+        call = is_significant(index, args.gene, contrast, *threshold)
+        print(f"{contrast}: {'significant' if call else 'not significant'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+
+# Normalized (long format) database layout for the pipeline results.
+# Instead of one wide table per contrast and one column per sample, genes,
+# samples and contrasts get their own tables and the values live in two
+# fact tables keyed by (gene, sample) and (contrast, gene). The DDL sticks
+# to syntax shared by MySQL/MariaDB and SQLite.
+
+import numpy as np
+import pandas as pd
+import results_store
+
+# Table definitions, created in this order and dropped in reverse
+table_definitions = {
+    "genes": """
+    CREATE TABLE {prefix}genes (
+        `gene_id` VARCHAR(30) NOT NULL,
+        `gene_name` VARCHAR(50) NULL,
+        PRIMARY KEY (`gene_id`)
+    );
+    """,
+    "samples": """
+    CREATE TABLE {prefix}samples (
+        `sample_id` VARCHAR(30) NOT NULL,
+        `condition_name` VARCHAR(100) NULL,
+        `disease` VARCHAR(100) NULL,
+        PRIMARY KEY (`sample_id`)
+    );
+    """,
+    "contrasts": """
+    CREATE TABLE {prefix}contrasts (
+        `contrast_id` INTEGER NOT NULL,
+        `name` VARCHAR(100) NOT NULL,
+        `factor` VARCHAR(100) NOT NULL,
+        `tested_level` VARCHAR(100) NOT NULL,
+        `reference_level` VARCHAR(100) NOT NULL,
+        PRIMARY KEY (`contrast_id`)
+    );
+    """,
+    "counts": """
+    CREATE TABLE {prefix}counts (
+        `gene_id` VARCHAR(30) NOT NULL,
+        `sample_id` VARCHAR(30) NOT NULL,
+        `raw_count` BIGINT NULL,
+        `normalized_count` DOUBLE NULL,
+        PRIMARY KEY (`gene_id`, `sample_id`)
+    );
+    """,
+    "de_results": """
+    CREATE TABLE {prefix}de_results (
+        `contrast_id` INTEGER NOT NULL,
+        `gene_id` VARCHAR(30) NOT NULL,
+        `baseMean` DOUBLE NULL,
+        `log2FoldChange` DOUBLE NULL,
+        `lfcSE` DOUBLE NULL,
+        `stat` DOUBLE NULL,
+        `pvalue` DOUBLE NULL,
+        `padj` DOUBLE NULL,
+        PRIMARY KEY (`contrast_id`, `gene_id`)
+    );
+    """
+}
+
+# Secondary indexes as (index name, table, columns)
+index_definitions = [
+    ("idx_genes_name", "genes", ["gene_name"]),
+    ("idx_contrasts_name", "contrasts", ["name"]),
+    ("idx_counts_sample", "counts", ["sample_id"]),
+    ("idx_de_results_padj", "de_results", ["contrast_id", "padj"]),
+    ("idx_de_results_gene", "de_results", ["gene_id"])
+]
+
+# Columns of the fact tables filled from the results store
+result_columns = ["baseMean", "log2FoldChange", "lfcSE", "stat", "pvalue",
+                  "padj"]
+
+# Long counts rows built from each chunk of the raw counts file
+count_chunk_rows = 1000000
+
+# Filtered design column holding the disease of each sample
+disease_column = "Disease"
+
+
+def create_schema(cursor, prefix=""):
+    """Drop and recreate the normalized tables and their indexes."""
+    for table_name in reversed(list(table_definitions)):
+        cursor.execute(f"DROP TABLE IF EXISTS {prefix}{table_name};")
+    for definition in table_definitions.values():
+        cursor.execute(definition.format(prefix=prefix))
+    for index_name, table_name, columns in index_definitions:
+        column_list = ",".join("`{}`".format(c) for c in columns)
+        cursor.execute(
+            f"CREATE INDEX {prefix}{index_name} "
+            f"ON {prefix}{table_name} ({column_list});"
+        )
+
+
+def frame_batches(df, batch_size=5000):
+    """Yield the column names and then row batches of a DataFrame.
+
+    Missing values become None, so the batches can go straight to
+    setup_database.bulk_insert_table.
+    """
+    yield list(df.columns)
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield chunk.values.tolist()
+
+
+def gene_table(settings):
+    """Return the genes table from the raw counts annotation."""
+    genes = pd.read_csv(
+        settings["raw_counts"],
+        sep="\t",
+        usecols=[settings["gene_id_column"], settings["gene_name_column"]]
+    )
+    genes.columns = ["gene_id", "gene_name"]
+    return genes.drop_duplicates("gene_id")
+
+
+def sample_table(settings):
+    """Return the samples table from the filtered experiment design.
+
+    Columns are found by role: the sample ID is the renamed sample_column,
+    the condition the design_factor column and the disease the Disease
+    column. Roles missing from metadata_columns are left empty.
+    """
+    design = pd.read_csv(settings["filtered_design"], sep="\t")
+    sources = {
+        "sample_id": settings["metadata_columns"][settings["sample_column"]],
+        "condition_name": settings["design_factor"],
+        "disease": disease_column
+    }
+    samples = pd.DataFrame(index=design.index)
+    for column, source in sources.items():
+        samples[column] = design[source] if source in design else None
+    return samples
+
+
+def contrast_table(settings):
+    """Return the contrasts table from the contrast manifest."""
+    manifest = results_store.read_manifest(settings["deseq_dir"])
+    rows = [
+        [contrast_id, name] + list(contrast)
+        for contrast_id, (name, contrast) in enumerate(manifest.items(), 1)
+    ]
+    return pd.DataFrame(rows, columns=["contrast_id", "name", "factor",
+                                       "tested_level", "reference_level"])
+
+
+def normalized_reader(settings, samples):
+    """Return a function reading the normalized counts of some genes.
+
+    The function takes a list of gene IDs and returns a genes x samples
+    array, NaN where a gene or sample was not analysed. Count matrices
+    are read gene by gene from the memory mapped file.
+    """
+    path = results_store.table_path(settings["deseq_dir"], "normalized_counts")
+    if not results_store.is_matrix(path):
+        # Gene-major table of an older analysis: read it once
+        table = results_store.read_table(path)
+
+        def read(genes):
+            return table.reindex(index=genes, columns=samples).to_numpy()
+        return read
+
+    stored = set(results_store.matrix_genes(path))
+
+    def read(genes):
+        counts = results_store.read_matrix(
+            path, [gene for gene in genes if gene in stored])
+        return counts.reindex(index=samples, columns=genes).to_numpy().T
+    return read
+
+
+def count_batches(settings, batch_size=5000):
+    """Yield the column names and row batches of the long counts table.
+
+    The raw counts file is read a few genes at a time, together with the
+    normalized counts of the same genes, so memory use does not grow with
+    the dataset. Rows are ordered by gene, then sample.
+    """
+    gene_id = settings["gene_id_column"]
+    header = pd.read_csv(settings["raw_counts"], sep="\t", nrows=0).columns
+    samples = [column for column in header
+               if column not in (gene_id, settings["gene_name_column"])]
+    sample_ids = np.asarray(samples, dtype=object)
+    read_normalized = normalized_reader(settings, samples)
+    yield ["gene_id", "sample_id", "raw_count", "normalized_count"]
+    if not samples:
+        return
+
+    dtypes = dict.fromkeys(samples, "int64")
+    dtypes[gene_id] = str
+    reader = pd.read_csv(
+        settings["raw_counts"], sep="\t", usecols=[gene_id] + samples,
+        dtype=dtypes, chunksize=max(1, count_chunk_rows // len(samples)))
+    for chunk in reader:
+        genes = chunk[gene_id].to_numpy(dtype=object)
+        # Gene-major, like the rows of the melted table
+        raw = chunk[samples].to_numpy().ravel()
+        normalized = results_store.shortest_float64(
+            read_normalized(list(genes)).ravel())
+        for start in range(0, len(raw), batch_size):
+            rows = np.arange(start, min(start + batch_size, len(raw)))
+            yield [
+                [gene, sample, count, None if value != value else value]
+                for gene, sample, count, value in zip(
+                    genes[rows // len(samples)].tolist(),
+                    sample_ids[rows % len(samples)].tolist(),
+                    raw[rows].tolist(),
+                    normalized[rows].tolist())
+            ]
+
+
+def result_table(settings, contrasts):
+    """Return the long de_results table for every stored contrast."""
+    frames = []
+    for contrast_id, name in zip(contrasts["contrast_id"], contrasts["name"]):
+        df = results_store.read_table(
+            results_store.table_path(settings["deseq_dir"], f"{name}_results"),
+            columns=result_columns
+        )
+        df = df.rename_axis("gene_id").reset_index()
+        df.insert(0, "contrast_id", contrast_id)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_normalized(connection, settings, insert_rows, batch_size=5000):
+    """Create the normalized tables for one dataset and fill them.
+
+    insert_rows(connection, table, batches) inserts the batches yielded by
+    frame_batches, such as setup_database.bulk_insert_table. Returns
+    table name -> number of rows inserted.
+    """
+    prefix = settings["table_prefix"]
+    cursor = connection.cursor()
+    try:
+        create_schema(cursor, prefix)
+    finally:
+        cursor.close()
+    connection.commit()
+
+    # The counts table is streamed, the others are small enough for memory
+    contrasts = contrast_table(settings)
+    tables = {
+        "genes": lambda: frame_batches(gene_table(settings), batch_size),
+        "samples": lambda: frame_batches(sample_table(settings), batch_size),
+        "contrasts": lambda: frame_batches(contrasts, batch_size),
+        "counts": lambda: count_batches(settings, batch_size),
+        "de_results": lambda: frame_batches(
+            result_table(settings, contrasts), batch_size)
+    }
+    row_counts = {}
+    for table_name, batches in tables.items():
+        row_counts[table_name] = insert_rows(
+            connection, f"{prefix}{table_name}", batches())
+    return row_counts
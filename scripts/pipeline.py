@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+
+# Run the pipeline for every dataset of a configuration file.
+# The stages of a dataset form a dependency graph (pipeline_dag.py): a stage
+# is skipped when its inputs and settings are unchanged since its last run,
+# and independent stages (SQL generation and plotting) run concurrently.
+# All stage modules are imported once here; datasets are then fanned out to
+# forked worker processes that reuse those imports.
+
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import acquire_data
+import batch_deseq
+import db_access
+import generate_insert_statements
+import hit_index
+import pipeline_config
+import pipeline_dag
+import results_store
+import run_deseq_analysis
+import setup_database
+import stage_profiler
+import visualize_results
+
+
+def fetch_data(settings):
+    """Download the raw counts and design through the download cache."""
+    acquire_data.fetch_dataset(settings)
+
+
+def analyze(settings):
+    """Run the differential expression analysis."""
+    run_deseq_analysis.run_analysis(settings, use_cache=settings["use_cache"])
+
+
+def generate_sql(settings):
+    """Write the INSERT statements of every table."""
+    generate_insert_statements.generate_sql(settings)
+
+
+def load_db(settings):
+    """Rebuild and load the database tables."""
+    connection = setup_database.connect(
+        settings, local_infile=settings["db_mode"] == "infile")
+    try:
+        setup_database.load_database(
+            connection, settings, settings["db_mode"],
+            sync=settings["db_sync"])
+    finally:
+        connection.close()
+
+
+def plot(settings):
+    """Draw the volcano plots and heatmaps."""
+    visualize_results.plot_results(
+        settings,
+        min_comparisons=settings["min_comparisons"],
+        significance_column=settings["significance_column"],
+        alpha=settings["alpha"],
+        lfc_threshold=settings["lfc_threshold"],
+        workers=settings["plot_workers"],
+        max_background_points=settings["max_background_points"],
+        heatmap_mode=settings["heatmap_mode"]
+    )
+
+
+def source_files(settings):
+    """Return the downloaded input files of a dataset."""
+    return [settings["raw_counts"], settings["design"]]
+
+
+def analysis_files(settings):
+    """Return the contrast manifest and the tables it lists."""
+    deseq_dir = settings["deseq_dir"]
+    manifest = os.path.join(deseq_dir, results_store.manifest_name)
+    if not os.path.exists(manifest):
+        return [manifest]
+    return [manifest] + [
+        results_store.table_path(deseq_dir, table_name)
+        for table_name in results_store.analysis_tables(deseq_dir)
+        + [results_store.annotation_name]
+    ] + [os.path.join(hit_index.index_dir(deseq_dir), hit_index.meta_name)]
+
+
+def sql_files(settings):
+    """Return the filtered design and the generated .sql files."""
+    sql_dir = settings["sql_dir"]
+    paths = [
+        settings["filtered_design"],
+        os.path.join(sql_dir, "raw_counts.sql"),
+        os.path.join(sql_dir, "metadata.sql")
+    ]
+    manifest = os.path.join(settings["deseq_dir"], results_store.manifest_name)
+    if os.path.exists(manifest):
+        paths += [
+            os.path.join(sql_dir, f"{table_name}.sql")
+            for table_name in results_store.analysis_tables(
+                settings["deseq_dir"])
+        ]
+    return paths
+
+
+def plot_files(settings):
+    """Return the files written by the plotting stage."""
+    return [os.path.join(settings["plots_dir"], "significant_overlap.csv")]
+
+
+def setting_values(*keys):
+    """Return a function selecting the settings a stage depends on."""
+    return lambda settings: {key: settings[key] for key in keys}
+
+
+def database_target(settings):
+    """Return the database settings a load depends on, without secrets.
+
+    They are resolved like db_access.connect does, environment variables
+    included, so loading into another database is not skipped.
+    """
+    db = db_access.db_settings(settings)
+    for key in ("password", "pool_size", "pool_timeout"):
+        db.pop(key, None)
+    return db
+
+
+def load_params(settings):
+    """Return the settings the database load depends on."""
+    params = setting_values("table_prefix", "db_mode", "db_sync")(settings)
+    params["database"] = database_target(settings)
+    return params
+
+
+# Stages of a dataset, in an order compatible with their dependencies
+dataset_stages = {
+    "fetch": {
+        "run": fetch_data,
+        "deps": [],
+        "inputs": lambda settings: [],
+        "outputs": source_files,
+        "params": setting_values(),
+        "skip_if_outputs_exist": True
+    },
+    "analyze": {
+        "run": analyze,
+        "deps": ["fetch"],
+        "inputs": source_files,
+        "outputs": analysis_files,
+        "params": setting_values(
+            "gene_id_column", "gene_name_column", "sample_column",
+            "factor_column", "design_factor", "reference_level",
+            "contrasts", "prefilter",
+            "count_dtype", "count_compression", "transformed_counts")
+    },
+    "sql": {
+        "run": generate_sql,
+        "deps": ["analyze"],
+        "inputs": lambda settings: (
+            source_files(settings) + analysis_files(settings)),
+        "outputs": sql_files,
+        "params": setting_values("table_prefix", "metadata_columns")
+    },
+    "load-db": {
+        "run": load_db,
+        "deps": ["sql"],
+        "inputs": lambda settings: (
+            source_files(settings) + analysis_files(settings)
+            + sql_files(settings)),
+        "outputs": lambda settings: [],
+        "params": load_params
+    },
+    "plot": {
+        "run": plot,
+        "deps": ["analyze"],
+        "inputs": analysis_files,
+        "outputs": plot_files,
+        "params": setting_values(
+            "min_comparisons", "significance_column", "alpha",
+            "lfc_threshold", "max_background_points", "heatmap_mode")
+    }
+}
+
+# All stages, in the order they are listed
+all_stages = list(dataset_stages)
+
+# Stages run when none are selected; downloading only applies to
+# E-GEOD-52194 and loading the database needs access to it, so both have
+# to be asked for explicitly
+default_stages = ["analyze", "sql", "plot"]
+
+
+def run_dataset(settings, stages=default_stages, db_mode="bulk",
+                use_cache=True, force=False):
+    """Run the selected stages for one dataset, skipping unchanged ones.
+
+    Stages run in worker processes as soon as their dependencies are done,
+    at most settings["stage_workers"] at a time. Returns stage name ->
+    status (see pipeline_dag.run_dag) and raises RuntimeError when a stage
+    fails.
+    """
+    settings = dict(settings, db_mode=db_mode, use_cache=use_cache)
+    selected = [name for name in all_stages if name in stages]
+    status = pipeline_dag.run_dag(
+        dataset_stages, settings, selected,
+        workers=settings["stage_workers"], force=force)
+    failed = [name for name, result in status.items()
+              if result not in ("ran", "skipped")]
+    if failed:
+        raise RuntimeError(f"Stages not completed: {', '.join(failed)}")
+    return status
+
+
+def _run_dataset_job(settings, stages, db_mode, use_cache, force):
+    """Run one dataset in a worker and report how it went."""
+    start = time.perf_counter()
+    stage_profiler.context["dataset"] = settings["name"]
+    try:
+        with stage_profiler.stage("dataset"):
+            run_dataset(settings, stages, db_mode, use_cache, force)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        stage_profiler.write_report()
+    return settings["name"], time.perf_counter() - start, error
+
+
+def run_batch(config, names=None, workers=None, stages=default_stages,
+              db_mode="bulk", use_cache=True, force=False):
+    """Process several datasets of a configuration concurrently.
+
+    The cores are split between the dataset workers: each dataset gets
+    cpu_count // workers cores for PyDESeq2 and runs its stages,
+    contrasts and plots in its own process. Returns dataset name -> error
+    traceback (None on success).
+    """
+    if names is None:
+        names = pipeline_config.dataset_names(config)
+    workers, cpus_per_dataset = batch_deseq.split_cores(
+        len(names), workers=workers)
+
+    jobs = []
+    for name in names:
+        settings = pipeline_config.dataset_settings(config, name)
+        if workers > 1:
+            settings["n_cpus"] = min(
+                settings["n_cpus"] or cpus_per_dataset, cpus_per_dataset)
+            settings["contrast_workers"] = 1
+            settings["plot_workers"] = 1
+            settings["stage_workers"] = 1
+        jobs.append(settings)
+
+    errors = {}
+    if workers == 1:
+        results = [
+            _run_dataset_job(settings, stages, db_mode, use_cache, force)
+            for settings in jobs
+        ]
+    else:
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=context) as pool:
+            futures = [
+                pool.submit(_run_dataset_job, settings, stages, db_mode,
+                            use_cache, force)
+                for settings in jobs
+            ]
+            results = [future.result() for future in futures]
+
+    for name, elapsed, error in results:
+        errors[name] = error
+        status = "failed" if error else "finished"
+        print(f"Dataset '{name}' {status} in {elapsed:.2f}s")
+        if error:
+            print(error)
+    return errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline for the datasets of a configuration."
+    )
+    parser.add_argument(
+        "--config",
+        default=pipeline_config.default_config_path,
+        help="Pipeline configuration file "
+             f"(default: {pipeline_config.default_config_path})"
+    )
+    parser.add_argument(
+        "--dataset",
+        action="append",
+        default=None,
+        help="Dataset to process, can be repeated (default: all datasets)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of datasets processed at the same time "
+             "(default: one per dataset, up to the number of CPUs)"
+    )
+    parser.add_argument(
+        "--only", "--stages",
+        dest="only",
+        nargs="+",
+        choices=all_stages,
+        default=None,
+        help=f"Run only these stages (default: {' '.join(default_stages)})"
+    )
+    parser.add_argument(
+        "--from",
+        dest="start",
+        choices=all_stages,
+        default=None,
+        help="Run this stage and every stage depending on it"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run the selected stages even if their inputs are unchanged"
+    )
+    parser.add_argument(
+        "--db-mode",
+        choices=["sql", "bulk", "infile"],
+        default="bulk",
+        help="Load path used by the load-db stage (default: bulk)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always refit the DESeq2 models"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Share one run report between this process and the dataset workers
+    print(f"Run report: {stage_profiler.report_dir()}/"
+          f"{stage_profiler.run_id()}.json")
+    config = pipeline_config.load_config(args.config)
+    stages = default_stages
+    if args.only is not None or args.start is not None:
+        stages = pipeline_dag.select_stages(
+            dataset_stages, args.only, args.start)
+    errors = run_batch(
+        config,
+        names=args.dataset,
+        workers=args.workers,
+        stages=stages,
+        db_mode=args.db_mode,
+        use_cache=not args.no_cache,
+        force=args.force
+    )
+    failed = [name for name, error in errors.items() if error]
+    if failed:
+        raise SystemExit(f"Failed datasets: {', '.join(failed)}")
+    print("All datasets processed successfully")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+# Read the pipeline configuration and resolve the settings of each dataset.
+# A configuration file (YAML or TOML) lists the datasets to process, their
+# design factor and the contrasts to test; anything left out falls back to
+# the defaults below, which describe an EBI Expression Atlas download.
+
+import os
+
+# Default configuration file, next to the scripts
+default_config_path = "pipeline.yaml"
+
+# Settings used when neither the dataset nor the config defaults set them
+default_settings = {
+    "data_dir": "../data",
+    "results_root": "../results",
+    "results_dir": None,
+    "raw_counts": None,
+    "design": None,
+    "gene_id_column": "Gene ID",
+    "gene_name_column": "Gene Name",
+    "sample_column": "Run",
+    "factor_column": "Factor Value[clinical information]",
+    "design_factor": "Condition",
+    "reference_level": None,
+    "metadata_columns": {
+        "Run": "Sample_ID",
+        "Sample Characteristic[clinical information]": "Condition",
+        "Sample Characteristic[disease]": "Disease"
+    },
+    "contrasts": None,
+    "source": None,
+    "mirror": None,
+    "checksums": None,
+    "download_cache": None,
+    "fetch_max_age": 86400,
+    "table_prefix": "",
+    "database": None,
+    "db_sync": None,
+    "count_chunksize": 10000,
+    "prefilter": None,
+    "count_dtype": "float64",
+    "count_compression": "uncompressed",
+    "transformed_counts": None,
+    "n_cpus": None,
+    "contrast_workers": None,
+    "plot_workers": None,
+    "stage_workers": None,
+    "min_comparisons": 2,
+    "significance_column": "pvalue",
+    "alpha": 0.05,
+    "lfc_threshold": 0.5,
+    "max_background_points": None,
+    "heatmap_mode": "top"
+}
+
+
+def load_config(path=default_config_path):
+    """Read a YAML or TOML configuration file into a dict."""
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+    import yaml
+    with open(path, "r") as file:
+        return yaml.safe_load(file) or {}
+
+
+def dataset_names(config):
+    """Return the names of the datasets listed in a configuration."""
+    return [dataset["name"] for dataset in config.get("datasets", [])]
+
+
+def normalize_contrasts(contrasts, design_factor):
+    """Turn a contrast specification into a dict of name to contrast.
+
+    contrasts may be a dict of name to [tested, reference] or a list of
+    [tested, reference] pairs, in which case names are derived from the
+    levels. None is returned unchanged and means all pairwise contrasts.
+    """
+    if contrasts is None:
+        return None
+    if not isinstance(contrasts, dict):
+        contrasts = {
+            "{}_vs_{}".format(slugify(tested), slugify(reference)):
+                [tested, reference]
+            for tested, reference in contrasts
+        }
+    return {
+        name: [design_factor, levels[-2], levels[-1]]
+        for name, levels in contrasts.items()
+    }
+
+
+def slugify(level):
+    """Turn a factor level into a lower case name usable in file names."""
+    slug = "".join(c if c.isalnum() else "_" for c in level.lower())
+    return "_".join(part for part in slug.split("_") if part)
+
+
+def dataset_settings(config, name=None):
+    """Return the resolved settings of one dataset of a configuration.
+
+    Values are taken from the dataset entry, then the config "defaults"
+    section, then default_settings. Input and output paths not given
+    explicitly are derived from the dataset name. Without a name the first
+    dataset is used.
+    """
+    datasets = config.get("datasets", [])
+    if not datasets:
+        raise ValueError("The configuration does not list any datasets")
+    if name is None:
+        entry = datasets[0]
+    else:
+        matches = [d for d in datasets if d["name"] == name]
+        if not matches:
+            raise ValueError(f"Dataset '{name}' is not in the configuration")
+        entry = matches[0]
+
+    settings = dict(default_settings)
+    settings.update(config.get("defaults", {}))
+    settings.update(entry)
+    name = settings["name"]
+    data_dir = settings["data_dir"]
+
+    # Derive the input paths from the dataset name; downloaded files are
+    # kept gzip-compressed
+    ext = ".tsv" if settings["source"] is None else ".tsv.gz"
+    if settings["raw_counts"] is None:
+        settings["raw_counts"] = os.path.join(
+            data_dir, f"{name}-raw-counts{ext}")
+    if settings["design"] is None:
+        settings["design"] = os.path.join(
+            data_dir, f"{name}-experiment-design{ext}")
+    design = settings["design"]
+    if design.endswith(".gz"):
+        design = design[:-3]
+    root, ext = os.path.splitext(design)
+    settings["filtered_design"] = f"{root}-filtered{ext}"
+
+    # Derive the output directories
+    if settings["results_dir"] is None:
+        settings["results_dir"] = os.path.join(
+            settings["results_root"], name)
+    results_dir = settings["results_dir"]
+    settings["deseq_dir"] = os.path.join(results_dir, "deseq_analysis")
+    settings["sql_dir"] = os.path.join(results_dir, "sql_outputs")
+    settings["plots_dir"] = os.path.join(results_dir, "plots")
+
+    settings["contrasts"] = normalize_contrasts(
+        settings["contrasts"], settings["design_factor"])
+    return settings
+
+
+def add_config_arguments(parser):
+    """Add the --config and --dataset options shared by the scripts."""
+    parser.add_argument(
+        "--config",
+        default=default_config_path,
+        help=f"Pipeline configuration file (default: {default_config_path})"
+    )
+    parser.add_argument(
+        "--dataset",
+        default=None,
+        help="Name of the dataset to process (default: the first one)"
+    )
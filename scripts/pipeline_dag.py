@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+# Run the stages of a pipeline as a dependency graph.
+# Each stage declares the stages it depends on, the files it reads and
+# writes and the settings it uses. A stage is skipped when the fingerprint
+# of its input files and settings matches the one recorded after its last
+# successful run and its outputs still exist. Stages whose dependencies
+# are done run concurrently in worker processes.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import stage_profiler
+
+# Name of the state file kept in the results directory of a dataset
+state_name = ".pipeline_state.json"
+
+# Block size used to hash input files
+hash_block_size = 1 << 20
+
+
+def load_state(path):
+    """Read the fingerprints recorded by earlier runs."""
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"stages": {}, "files": {}}
+
+
+def save_state(path, state):
+    """Write the recorded fingerprints, replacing the file atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_digest(path, known):
+    """Return the sha256 of a file, or None when it does not exist.
+
+    known maps paths to their last size, mtime and digest; a file whose
+    size and mtime are unchanged is not read again.
+    """
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    entry = known.get(path)
+    if (entry and entry["size"] == info.st_size
+            and entry["mtime_ns"] == info.st_mtime_ns):
+        return entry["sha256"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(hash_block_size), b""):
+            digest.update(block)
+    known[path] = {
+        "size": info.st_size,
+        "mtime_ns": info.st_mtime_ns,
+        "sha256": digest.hexdigest()
+    }
+    return known[path]["sha256"]
+
+
+def fingerprint(paths, params, known):
+    """Return a digest of the input files and settings of a stage."""
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(path.encode())
+        digest.update(str(file_digest(path, known)).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def descendants(stages, name):
+    """Return a stage and every stage that depends on it."""
+    selected = {name}
+    changed = True
+    while changed:
+        changed = False
+        for other, stage in stages.items():
+            if other not in selected and selected & set(stage["deps"]):
+                selected.add(other)
+                changed = True
+    return selected
+
+
+def select_stages(stages, only=None, start=None):
+    """Return the stages to run, in declaration order.
+
+    only lists stages to run on their own; start selects a stage and
+    everything downstream of it. Both may be combined (intersection).
+    """
+    selected = set(stages)
+    if only is not None:
+        selected &= set(only)
+    if start is not None:
+        selected &= descendants(stages, start)
+    return [name for name in stages if name in selected]
+
+
+def is_up_to_date(stage, settings, key, recorded):
+    """Check whether a stage can be skipped."""
+    outputs = stage["outputs"](settings)
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+    if stage.get("skip_if_outputs_exist"):
+        return True
+    return recorded == key
+
+
+def _run_stage(name, run, settings):
+    """Run one stage, in this process or a worker, and report errors."""
+    stage_profiler.context["dataset"] = settings["name"]
+    try:
+        with stage_profiler.stage(f"stage:{name}"):
+            run(settings)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        stage_profiler.write_report()
+    return name, error
+
+
+def run_dag(stages, settings, selected, workers=None, force=False):
+    """Run the selected stages of one dataset, skipping unchanged ones.
+
+    stages maps stage names, in a valid order, to dicts with:
+      run(settings)      runs the stage
+      deps               names of the stages it depends on
+      inputs(settings)   files it reads
+      outputs(settings)  files it writes
+      params(settings)   settings that change its outputs
+    Dependencies that are not selected are assumed to be done. Stages run
+    concurrently in up to workers processes; force reruns every selected
+    stage. Returns stage name -> "ran", "skipped", "blocked" or an error
+    traceback.
+    """
+    state_path = os.path.join(settings["results_dir"], state_name)
+    state = load_state(state_path)
+    pending = list(selected)
+    status = {}
+    keys = {}
+    if workers is None:
+        workers = len(pending)
+    workers = max(1, workers)
+
+    pool = None
+    if workers > 1:
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    running = {}
+    try:
+        while pending or running:
+            finished = []
+            for name in list(pending):
+                deps = [d for d in stages[name]["deps"] if d in selected]
+                if any(status.get(d, "ran") not in ("ran", "skipped")
+                       for d in deps):
+                    # An upstream stage failed or was blocked
+                    status[name] = "blocked"
+                    pending.remove(name)
+                    continue
+                if not all(d in status for d in deps):
+                    continue
+                if len(running) >= workers:
+                    break
+                pending.remove(name)
+
+                # Fingerprint the inputs once the upstream stages are done
+                stage = stages[name]
+                keys[name] = fingerprint(
+                    stage["inputs"](settings), stage["params"](settings),
+                    state["files"])
+                if not force and is_up_to_date(
+                        stage, settings, keys[name],
+                        state["stages"].get(name)):
+                    print(f"Stage '{name}' is up to date, skipping")
+                    status[name] = "skipped"
+                    continue
+                print(f"Running stage '{name}'")
+                if pool is None:
+                    finished.append(_run_stage(name, stage["run"], settings))
+                    break
+                future = pool.submit(_run_stage, name, stage["run"], settings)
+                running[future] = name
+
+            if not finished and running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished.append(future.result())
+                    del running[future]
+
+            for name, error in finished:
+                if error:
+                    status[name] = error
+                    state["stages"].pop(name, None)
+                    print(f"Stage '{name}' failed")
+                    print(error)
+                    continue
+                status[name] = "ran"
+                # Record the inputs the stage ran from; its outputs are
+                # hashed when a downstream stage reads them
+                state["stages"][name] = keys[name]
+                save_state(state_path, state)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    save_state(state_path, state)
+    return status
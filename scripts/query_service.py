@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+# Local query service over the differential expression results.
+# Answers the lookups of result_queries.py on the normalized tables, either
+# once from the command line or as JSON over HTTP:
+#   GET /contrasts                  stored contrasts
+#   GET /contrasts/<name>/top?n=10  top genes by padj for a contrast
+#   GET /genes/<name>               a gene across all contrasts
+# Requests borrow connections from the db_access pool, so concurrent
+# clients share at most pool_size connections.
+
+import argparse
+import json
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import db_access
+import pipeline_config
+import result_queries
+
+# Largest number of genes returned by a top genes request
+max_top = 1000
+
+
+def route(path):
+    """Return the lookup function and its arguments for a request path."""
+    url = urllib.parse.urlsplit(path)
+    parts = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+    params = urllib.parse.parse_qs(url.query)
+    if parts == ["contrasts"]:
+        return result_queries.list_contrasts, ()
+    if len(parts) == 3 and parts[0] == "contrasts" and parts[2] == "top":
+        n = min(int(params.get("n", ["10"])[0]), max_top)
+        return result_queries.top_genes, (parts[1], n)
+    if len(parts) == 2 and parts[0] == "genes":
+        return result_queries.gene_contrasts, (parts[1],)
+    return None, ()
+
+
+def lookup(db, path, prefix=""):
+    """Answer a request path; returns (HTTP status, JSON payload)."""
+    try:
+        function, args = route(path)
+    except ValueError:
+        return 400, {"error": "n must be an integer"}
+    if function is None:
+        return 404, {"error": f"Unknown path '{path}'"}
+    with db_access.pooled_connection(db) as connection:
+        return 200, function(connection, *args, prefix=prefix)
+
+
+def make_handler(db, prefix=""):
+    """Return a request handler class answering from the given database."""
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                status, payload = lookup(db, self.path, prefix)
+            except Exception as error:
+                status, payload = 500, {"error": str(error)}
+            body = json.dumps(payload, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return QueryHandler
+
+
+def serve(db, host="127.0.0.1", port=8000, prefix=""):
+    """Serve the lookups over HTTP until interrupted."""
+    server = ThreadingHTTPServer((host, port), make_handler(db, prefix))
+    print(f"Serving results on http://{host}:{port}/contrasts")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        db_access.close_pools()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Query the differential expression results database."
+    )
+    pipeline_config.add_config_arguments(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("contrasts", help="List the stored contrasts")
+    top = commands.add_parser("top", help="Top genes by padj for a contrast")
+    top.add_argument("contrast", help="Contrast name")
+    top.add_argument(
+        "-n",
+        type=int,
+        default=10,
+        help="Number of genes (default: 10)"
+    )
+    gene = commands.add_parser("gene", help="A gene across all contrasts")
+    gene.add_argument("gene", help="Gene name")
+    server = commands.add_parser("serve", help="Serve the queries over HTTP")
+    server.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1)"
+    )
+    server.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="Port to listen on (default: 8000)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    db = db_access.db_settings(settings)
+    prefix = settings["table_prefix"]
+
+    if args.command == "serve":
+        serve(db, args.host, args.port, prefix)
+        return
+    if args.command == "contrasts":
+        path = "/contrasts"
+    elif args.command == "top":
+        path = "/contrasts/{}/top?n={}".format(
+            urllib.parse.quote(args.contrast), args.n)
+    else:
+        path = "/genes/{}".format(urllib.parse.quote(args.gene))
+    status, payload = lookup(db, path, prefix)
+    print(json.dumps(payload, indent=2, default=str))
+    if status != 200:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
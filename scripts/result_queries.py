@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Common lookups on the results database, for both the normalized layout
+# (normalized_schema.py) and the original wide per-contrast tables, plus a
+# small benchmark comparing their latency.
+
+import argparse
+import statistics
+import time
+import db_access
+import pipeline_config
+import results_store
+
+
+def run_query(connection, query, params=()):
+    """Execute a query written with %s placeholders and return dicts."""
+    return db_access.query(connection, query, params)
+
+
+def list_contrasts(connection, prefix=""):
+    """Return the contrasts stored in the normalized layout."""
+    query = f"""
+    SELECT name, factor, tested_level, reference_level
+    FROM {prefix}contrasts
+    ORDER BY contrast_id
+    """
+    return run_query(connection, query)
+
+
+def top_genes(connection, contrast, n=10, prefix=""):
+    """Return the top n genes by padj for a contrast (normalized layout)."""
+    query = f"""
+    SELECT g.gene_id, g.gene_name, r.baseMean, r.log2FoldChange,
+           r.pvalue, r.padj
+    FROM {prefix}de_results r
+    JOIN {prefix}contrasts c ON c.contrast_id = r.contrast_id
+    JOIN {prefix}genes g ON g.gene_id = r.gene_id
+    WHERE c.name = %s AND r.padj IS NOT NULL
+    ORDER BY r.padj
+    LIMIT {int(n)}
+    """
+    return run_query(connection, query, (contrast,))
+
+
+def gene_contrasts(connection, gene_name, prefix=""):
+    """Return the results of every contrast for a gene (normalized layout)."""
+    query = f"""
+    SELECT c.name AS contrast, g.gene_id, g.gene_name, r.baseMean,
+           r.log2FoldChange, r.pvalue, r.padj
+    FROM {prefix}genes g
+    JOIN {prefix}de_results r ON r.gene_id = g.gene_id
+    JOIN {prefix}contrasts c ON c.contrast_id = r.contrast_id
+    WHERE g.gene_name = %s
+    ORDER BY c.contrast_id
+    """
+    return run_query(connection, query, (gene_name,))
+
+
+def legacy_top_genes(connection, contrast, n=10, prefix=""):
+    """Return the top n genes by padj for a contrast (wide tables)."""
+    query = f"""
+    SELECT `Gene ID` AS gene_id, `Gene_Name` AS gene_name, baseMean,
+           log2FoldChange, pvalue, padj
+    FROM {prefix}{db_access.identifier(contrast)}_results
+    WHERE padj IS NOT NULL
+    ORDER BY padj
+    LIMIT {int(n)}
+    """
+    return run_query(connection, query)
+
+
+def legacy_gene_contrasts(connection, gene_name, contrasts, prefix=""):
+    """Return the results of every contrast for a gene (wide tables)."""
+    contrasts = [db_access.identifier(contrast) for contrast in contrasts]
+    query = "\nUNION ALL\n".join(
+        f"""
+        SELECT '{contrast}' AS contrast, `Gene ID` AS gene_id,
+               `Gene_Name` AS gene_name, baseMean, log2FoldChange,
+               pvalue, padj
+        FROM {prefix}{contrast}_results
+        WHERE `Gene_Name` = %s
+        """
+        for contrast in contrasts
+    )
+    return run_query(connection, query, (gene_name,) * len(contrasts))
+
+
+def time_query(function, *args, repeats=20, **kwargs):
+    """Return the median latency of a query function in milliseconds."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def benchmark(connection, contrasts, gene_name, n=10, prefix="",
+              repeats=20):
+    """Compare the latency of the lookups on both layouts.
+
+    Returns a list of (lookup, layout, median ms) tuples.
+    """
+    options = dict(prefix=prefix, repeats=repeats)
+    contrast = contrasts[0]
+    return [
+        ("top genes by padj", "normalized",
+         time_query(top_genes, connection, contrast, n, **options)),
+        ("top genes by padj", "wide",
+         time_query(legacy_top_genes, connection, contrast, n, **options)),
+        ("gene across contrasts", "normalized",
+         time_query(gene_contrasts, connection, gene_name, **options)),
+        ("gene across contrasts", "wide",
+         time_query(legacy_gene_contrasts, connection, gene_name, contrasts,
+                    **options))
+    ]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark result lookups on the normalized and wide "
+                    "database layouts."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--gene",
+        required=True,
+        help="Gene name used for the gene lookup"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=20,
+        help="Number of times each lookup is timed (default: 20)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    contrasts = list(results_store.read_manifest(settings["deseq_dir"]))
+
+    connection = db_access.connect(db_access.db_settings(settings))
+    try:
+        rows = benchmark(connection, contrasts, args.gene,
+                         prefix=settings["table_prefix"],
+                         repeats=args.repeats)
+    finally:
+        connection.close()
+    for lookup, layout, latency in rows:
+        print(f"{lookup:<24} {layout:<11} {latency:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+
+# Columnar (Arrow/Feather) storage for the differential analysis outputs.
+# Tables are written uncompressed so readers can memory map them and load
+# only the columns they need.
+#
+# Count matrices are stored as written by PyDESeq2, samples as rows and
+# one column per gene, so any set of genes can be read without loading the
+# rest. The gene names live in a separate annotation table. Readers that
+# expect genes as rows (database loaders, SQL export) get that view from
+# read_table, read_schema and iter_row_batches.
+
+import csv
+import json
+import os
+import numpy as np
+import pyarrow as pa
+from pyarrow import feather
+
+# Name of the column holding the gene identifiers
+index_column = "Gene ID"
+
+# File extension of the columnar tables
+extension = ".feather"
+
+# Manifest listing the contrasts written to a results directory
+manifest_name = "contrasts.json"
+
+# Sample column of the count matrices and gene name column of the
+# annotation table
+sample_column = "Sample_ID"
+name_column = "Gene_Name"
+
+# Table holding the gene names of the count matrices
+annotation_name = "gene_annotation"
+
+# Schema metadata marking a samples x genes count matrix
+layout_key = b"layout"
+matrix_layout = b"samples_x_genes"
+
+
+def table_path(output_dir, name):
+    """Return the path of a stored table from its name."""
+    return os.path.join(output_dir, f"{name}{extension}")
+
+
+def write_table(df, path):
+    """Write a DataFrame indexed by Gene ID as an uncompressed Feather file.
+
+    Column dtypes (float32/float64, integers, strings) are kept as they are.
+    """
+    table = pa.Table.from_pandas(
+        df.rename_axis(index_column).reset_index(), preserve_index=False
+    )
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def read_table(path, columns=None):
+    """Read a stored table with memory mapping, indexed by Gene ID.
+
+    If columns is given only those columns are returned, and read from
+    disk. Count matrices are returned with genes as rows, one column per
+    sample and a Gene_Name column; as they are stored by gene, every
+    sample is read before the columns are selected.
+    """
+    if is_matrix(path):
+        table = read_gene_table(path)
+        if columns is not None:
+            table = table[[c for c in columns if c != index_column]]
+        return table
+    if columns is not None:
+        columns = [index_column] + [c for c in columns if c != index_column]
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas().set_index(index_column)
+
+
+def read_columns(path):
+    """Return the column names of a stored table without reading data."""
+    with pa.memory_map(path) as source:
+        schema = pa.ipc.open_file(source).schema
+    return [name for name in schema.names if name != index_column]
+
+
+def read_schema(path):
+    """Return (column, Arrow type name) pairs of a stored table.
+
+    Count matrices are described with genes as rows: Gene ID, one column
+    per sample and Gene_Name.
+    """
+    with pa.memory_map(path) as source:
+        schema = pa.ipc.open_file(source).schema
+    if not _is_matrix_schema(schema):
+        return [(field.name, str(field.type)) for field in schema]
+    count_type = str(schema.field(1).type) if len(schema) > 1 else "float"
+    return (
+        [(index_column, "string")]
+        + [(sample, count_type) for sample in matrix_samples(path)]
+        + [(name_column, "string")]
+    )
+
+
+def _is_matrix_schema(schema):
+    """Check whether a schema is the one of a count matrix."""
+    return (schema.metadata or {}).get(layout_key) == matrix_layout
+
+
+def is_matrix(path):
+    """Check whether a stored table is a samples x genes count matrix."""
+    with pa.memory_map(path) as source:
+        return _is_matrix_schema(pa.ipc.open_file(source).schema)
+
+
+def write_matrix(path, matrix, samples, genes, dtype="float64",
+                 compression="uncompressed", batch_rows=256, transform=None):
+    """Write a samples x genes matrix with one column per gene.
+
+    The matrix is converted batch_rows samples at a time (applying
+    transform to each block if given), so no full-size copy or transpose
+    of it is made. compression may be "uncompressed", "lz4" or "zstd";
+    compressed files cannot be memory mapped but shrink zero-dominated
+    counts a lot, and only the requested genes are decompressed.
+    """
+    arrow_type = pa.from_numpy_dtype(np.dtype(dtype))
+    schema = pa.schema(
+        [pa.field(sample_column, pa.string())]
+        + [pa.field(str(gene), arrow_type) for gene in genes],
+        metadata={layout_key: matrix_layout}
+    )
+    options = pa.ipc.IpcWriteOptions(
+        compression=None if compression == "uncompressed" else compression)
+    samples = [str(sample) for sample in samples]
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema, options=options) as writer:
+            for start in range(0, len(samples), batch_rows):
+                block = np.asarray(matrix[start:start + batch_rows])
+                if transform is not None:
+                    block = transform(block)
+                # Transpose this block only, so each gene column is
+                # contiguous and wrapped by Arrow without another copy
+                columns = np.ascontiguousarray(block.T, dtype=dtype)
+                arrays = [pa.array(samples[start:start + batch_rows])]
+                arrays += [pa.array(column) for column in columns]
+                writer.write_batch(
+                    pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+
+def matrix_samples(path):
+    """Return the sample names of a count matrix."""
+    table = feather.read_table(path, columns=[sample_column],
+                               memory_map=True)
+    return table.column(sample_column).to_pylist()
+
+
+def matrix_genes(path):
+    """Return the gene IDs of a count matrix without reading data."""
+    return [c for c in read_columns(path) if c != sample_column]
+
+
+def read_matrix(path, genes=None):
+    """Read a count matrix as a samples x genes DataFrame.
+
+    If genes is given only those gene columns are read from disk.
+    """
+    columns = None
+    if genes is not None:
+        columns = [sample_column] + [str(gene) for gene in genes]
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas().set_index(sample_column)
+
+
+def annotation_path(path):
+    """Return the gene annotation table next to a count matrix."""
+    return table_path(os.path.dirname(path), annotation_name)
+
+
+def write_annotation(output_dir, gene_names):
+    """Store the gene names (a Series indexed by Gene ID) of a dataset."""
+    write_table(gene_names.rename(name_column).to_frame(),
+                table_path(output_dir, annotation_name))
+
+
+def read_annotation(path):
+    """Return the gene names of a count matrix as a Series by Gene ID."""
+    return read_table(annotation_path(path))[name_column]
+
+
+def read_gene_table(path, genes=None):
+    """Read (some genes of) a count matrix with genes as rows.
+
+    Returns a DataFrame indexed by Gene ID with one column per sample and
+    the Gene_Name column from the annotation table.
+    """
+    counts = read_matrix(path, genes).T.rename_axis(index_column)
+    counts.columns.name = None
+    names = read_annotation(path)
+    counts[name_column] = names.reindex(counts.index).to_numpy()
+    return counts
+
+
+def iter_row_batches(path, batch_size=5000):
+    """Yield the header and then lists of at most batch_size rows.
+
+    Missing values are returned as None. Mirrors the CSV reader used by the
+    database loaders so both sources can be used interchangeably.
+    """
+    if is_matrix(path):
+        yield from _iter_matrix_rows(path, batch_size)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        yield reader.schema.names
+        for i in range(reader.num_record_batches):
+            record_batch = reader.get_batch(i)
+            for start in range(0, record_batch.num_rows, batch_size):
+                chunk = record_batch.slice(start, batch_size).to_pydict()
+                columns = [
+                    [None if v != v else v for v in values]
+                    for values in chunk.values()
+                ]
+                yield [list(row) for row in zip(*columns)]
+
+
+def shortest_float64(values):
+    """Widen float32 values to the float64 of their shortest decimal text.
+
+    float(np.float32(0.1)) is 0.10000000149011612, which would be written
+    with spurious digits; this gives 0.1, the value str() shows. Each value
+    is rounded to 1, 2, ... 9 significant digits until it converts back to
+    the same float32, a few vectorized passes instead of formatting every
+    value. Arrays of other dtypes are returned unchanged.
+    """
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        return values
+    flat = values.ravel()
+    wide = flat.astype(np.float64)
+    pending = np.flatnonzero(np.isfinite(wide) & (wide != 0))
+    exponents = np.floor(np.log10(np.abs(wide[pending]))).astype(np.int64)
+    # Powers of ten above 1e22 are not exact: such values go through text
+    exact = (exponents >= -14) & (exponents <= 22)
+    text = pending[~exact]
+    pending = pending[exact]
+    exponents = exponents[exact]
+    for digits in range(1, 10):
+        if len(pending) == 0:
+            break
+        shift = digits - 1 - exponents
+        scale = 10.0 ** np.abs(shift)
+        x = wide[pending]
+        candidate = np.where(shift >= 0, np.round(x * scale) / scale,
+                             np.round(x / scale) * scale)
+        done = candidate.astype(np.float32) == flat[pending]
+        wide[pending[done]] = candidate[done]
+        pending = pending[~done]
+        exponents = exponents[~done]
+    text = np.concatenate([text, pending])
+    wide[text] = flat[text].astype(str).astype(np.float64)
+    return wide.reshape(values.shape)
+
+
+def _iter_matrix_rows(path, batch_size):
+    """Yield a count matrix as gene rows, reading batch_size genes at once."""
+    genes = matrix_genes(path)
+    names = read_annotation(path).reindex(genes)
+    yield [index_column] + matrix_samples(path) + [name_column]
+    for start in range(0, len(genes), batch_size):
+        chunk = genes[start:start + batch_size]
+        table = feather.read_table(path, columns=chunk, memory_map=True)
+        block = np.column_stack(
+            [column.to_numpy() for column in table.columns]).T
+        values = shortest_float64(block).tolist()
+        rows = []
+        for gene, name, row in zip(chunk, names[chunk], values):
+            row = [None if v != v else v for v in row]
+            rows.append([gene] + row + [None if name != name else name])
+        yield rows
+
+
+def export_csv(path, csv_path, batch_size=5000):
+    """Write a stored table to a CSV file, batch_size rows at a time."""
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.writer(file)
+        batches = iter_row_batches(path, batch_size)
+        writer.writerow(next(batches))
+        for batch in batches:
+            writer.writerows(batch)
+
+
+def write_manifest(output_dir, contrasts):
+    """Record the contrasts stored in output_dir as name -> contrast."""
+    with open(os.path.join(output_dir, manifest_name), "w") as file:
+        json.dump(contrasts, file, indent=2)
+
+
+def read_manifest(output_dir):
+    """Return the contrasts stored in output_dir as name -> contrast."""
+    with open(os.path.join(output_dir, manifest_name), "r") as file:
+        return json.load(file)
+
+
+def analysis_tables(output_dir):
+    """Return the names of the tables written by the analysis step.
+
+    The results tables are derived from the contrast manifest.
+    """
+    names = [f"{name}_results" for name in read_manifest(output_dir)]
+    return names + ["normalized_counts"]
@@ -1,211 +1,376 @@
 #!/usr/bin/python3
 
 # Import libraries
+import argparse
 import os
+import numpy as np
 import pydeseq2
 from pydeseq2.dds import DeseqDataSet
-from pydeseq2.ds import DeseqStats
 from pydeseq2.default_inference import DefaultInference
 import pandas as pd
-
-# Define input and output paths
-input_dir = "../data"
-output_dir = "../results/deseq_analysis"
-
-# Create output directory
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-    print(f"Directory created!")
-else:
-    print(f"Directory already exists.")
-
-# Read the raw counts data
-raw_counts_path = os.path.join(input_dir, "E-GEOD-52194-raw-counts.tsv")
-raw_counts = pd.read_csv(raw_counts_path, sep="\t")
-
-# Find the number of NaN values in each column
-nan_count_by_column = raw_counts.isna().sum()
-print(nan_count_by_column)
-
-# Set gene id column as index
-raw_counts = raw_counts.set_index("Gene ID")
-
-# Filter out rows with zero values
-raw_counts_filter = raw_counts[raw_counts.sum(axis=1) > 0]
-
-# Remove all rows where 'Gene Name' is NaN
-raw_counts_final = raw_counts_filter[raw_counts_filter["Gene Name"].notna()]
-
-# Save gene names to a variable and drop it
-gene_names = raw_counts_final["Gene Name"]
-counts_numeric = raw_counts_final.drop("Gene Name", axis=1)
-
-# Transpose the raw count data rows for analysis
-transposed_counts = counts_numeric.T
-
-# Load the metadata file and filter out unanalysed samples
-metadata_path = os.path.join(input_dir, "E-GEOD-52194-experiment-design.tsv")
-metadata = pd.read_csv(metadata_path, sep="\t")
-metadata_filter = metadata[metadata["Analysed"] != "No"]
-
-# Select sample IDs and condition columns only for analysis
-metadata_final = metadata_filter[["Run", "Factor Value[clinical information]"]]
-
-# Rename the columns for analysis
-metadata_final = metadata_final.rename(columns={
-    "Run": "Sample_ID",
-    "Factor Value[clinical information]": "Condition"
-})
-
-# Set the sample_id as the index to match the transposed count data
-metadata_final = metadata_final.set_index("Sample_ID")
-
-# Sort both datasets by the sample IDs
-metadata_sorted = metadata_final.sort_index()
-counts_sorted = transposed_counts.sort_index()
-
-############### Differential Analysis #######################################
-
-# Run the differential expression analysis
-inference = DefaultInference(n_cpus=8)
-dds = DeseqDataSet(
-        counts=counts_sorted,
-        metadata=metadata_sorted,
-        design_factors="Condition",
-        refit_cooks=True,
-        inference=inference
-    )
-
-dds.deseq2()
-print(dds)
-print(dds.varm["dispersions"])
-print(dds.varm["LFC"])
-
-# Compare different conditions
-# Compare triple-negative breast cancer vs normal
-tnbc_vs_normal = DeseqStats(
-        dds,
-        inference=inference,
-        contrast=[
-            "Condition",
-            "triple-negative breast cancer",
-            "normal"
-        ]
-)
-tnbc_vs_normal.summary()
-
-# Compare non-triple-negative breast cancer vs normal
-nontnbc_vs_normal = DeseqStats(
-        dds,
-        inference=inference,
-        contrast=[
-            "Condition",
-            "non-triple-negative breast cancer",
-            "normal"
-        ]
-)
-nontnbc_vs_normal.summary()
-
-# Compare HER2 Positive vs normal
-her2_vs_normal = DeseqStats(
-        dds,
-        inference=inference,
-        contrast=[
-            "Condition",
-            "HER2 Positive Breast Carcinoma",
-            "normal"
-        ]
-)
-her2_vs_normal.summary()
-
-# Compare triple-negative vs non-triple-negative
-tnbc_vs_nontnbc = DeseqStats(
-        dds,
-        inference=inference,
-        contrast=[
-            "Condition",
-            "triple-negative breast cancer",
-            "non-triple-negative breast cancer"
-        ]
-)
-tnbc_vs_nontnbc.summary()
-
-# Compare triple-negative vs HER2 Positive
-tnbc_vs_her2 = DeseqStats(
-        dds,
-        inference=inference,
-        contrast=[
-            "Condition",
-            "triple-negative breast cancer",
-            "HER2 Positive Breast Carcinoma"
-        ]
-)
-tnbc_vs_her2.summary()
-
-# Compare non-triple-negative vs HER2 Positive
-nontnbc_vs_her2 = DeseqStats(
-        dds,
-        inference=inference,
-        contrast=[
-            "Condition",
-            "non-triple-negative breast cancer",
-            "HER2 Positive Breast Carcinoma"
-        ]
-)
-nontnbc_vs_her2.summary()
-
-# Extract results dataframes from each comparison
-tnbc_vs_normal_df = tnbc_vs_normal.results_df
-nontnbc_vs_normal_df = nontnbc_vs_normal.results_df
-her2_vs_normal_df = her2_vs_normal.results_df
-tnbc_vs_nontnbc_df = tnbc_vs_nontnbc.results_df
-tnbc_vs_her2_df = tnbc_vs_her2.results_df
-nontnbc_vs_her2_df = nontnbc_vs_her2.results_df
-
-
-# Create a mapping dictionary from Gene ID to Gene Name
-gene_name_dict = gene_names.to_dict()
-
-# Create a function to add gene names to results
+import contrast_runner
+import count_loader
+import deseq_cache
+import gene_prefilter
+import hit_index
+import pipeline_config
+import results_store
+import stage_profiler
 
 
 def add_gene_names(results_df, map_gene_name):
+    """Return a copy of a results table with a Gene_Name column added."""
     results_copy = results_df.copy()
     results_copy['Gene_Name'] = results_copy.index.map(map_gene_name)
     return results_copy
 
 
-# Add gene names to all the results dataframes
-tnbc_vs_normal = add_gene_names(tnbc_vs_normal_df, gene_name_dict)
-nontnbc_vs_normal = add_gene_names(nontnbc_vs_normal_df, gene_name_dict)
-her2_vs_normal = add_gene_names(her2_vs_normal_df, gene_name_dict)
-tnbc_vs_nontnbc = add_gene_names(tnbc_vs_nontnbc_df, gene_name_dict)
-tnbc_vs_her2 = add_gene_names(tnbc_vs_her2_df, gene_name_dict)
-nontnbc_vs_her2 = add_gene_names(nontnbc_vs_her2_df, gene_name_dict)
-
-# Save the results to a csv file
-tnbc_vs_normal.to_csv(os.path.join(output_dir, "tnbc_vs_normal_results.csv"))
-nontnbc_vs_normal.to_csv(os.path.join(output_dir, "nontnbc_vs_normal_results.csv"))
-her2_vs_normal.to_csv(os.path.join(output_dir, "her2_vs_normal_results.csv"))
-tnbc_vs_nontnbc.to_csv(os.path.join(output_dir, "tnbc_vs_nontnbc_results.csv"))
-tnbc_vs_her2.to_csv(os.path.join(output_dir, "tnbc_vs_her2_results.csv"))
-nontnbc_vs_her2.to_csv(os.path.join(output_dir, "nontnbc_vs_her2_results.csv"))
-
-# Access the normalized counts from the analysis layers
-normalized_counts = dds.layers["normed_counts"]
-
-# Create a dataFrame with the normalized counts
-normalized_counts_df = pd.DataFrame(
-        normalized_counts,
-        index=dds.obs.index,
-        columns=dds.var.index
-)
-
-# Transpose the data to get the gene as rows
-normalized_counts_t = normalized_counts_df.T
-
-# Add gene names to the dataframe and save to a file
-normalized_counts_t['Gene_Name'] = gene_names
-normalized_counts_t.to_csv(os.path.join(output_dir, "normalized_counts.csv"))
-
-print("All processed successfully")
+def fit_model(dds):
+    """Fit the model like dds.deseq2(), timing each step as a stage."""
+    with stage_profiler.stage("size_factors", rows=dds.n_obs):
+        dds.fit_size_factors()
+    with stage_profiler.stage("dispersions", rows=dds.n_vars):
+        dds.fit_genewise_dispersions()
+        dds.fit_dispersion_trend()
+        dds.fit_dispersion_prior()
+        dds.fit_MAP_dispersions()
+    with stage_profiler.stage("lfc", rows=dds.n_vars):
+        dds.fit_LFC()
+    with stage_profiler.stage("cooks_refit", rows=dds.n_vars):
+        dds.calculate_cooks()
+        if dds.refit_cooks:
+            dds.refit()
+
+
+def write_outputs(output_dir, results, contrasts, dds, gene_names,
+                  csv=False, dtype="float64", compression="uncompressed",
+                  transformed=None):
+    """Write the results tables, manifest and normalized counts.
+
+    The normalized counts are stored as PyDESeq2 holds them, samples x
+    genes, in the given dtype; gene names go to a separate annotation
+    table. transformed may be "log2" or "vst" to also store
+    log2(count + 1) or variance stabilized counts.
+    """
+    # Save the results to the columnar store (and optionally to csv files)
+    for name, results_df in results.items():
+        results_store.write_table(
+            results_df, results_store.table_path(output_dir, name)
+        )
+        if csv:
+            results_df.to_csv(
+                os.path.join(output_dir, f"{name}.csv"), index_label="Gene ID"
+            )
+    results_store.write_manifest(output_dir, contrasts)
+
+    # Store the normalized counts straight from the analysis layers, without
+    # building a transposed float64 DataFrame
+    samples = list(dds.obs.index)
+    genes = list(dds.var.index)
+    counts_path = results_store.table_path(output_dir, "normalized_counts")
+    results_store.write_matrix(
+        counts_path, dds.layers["normed_counts"], samples, genes,
+        dtype=dtype, compression=compression
+    )
+    results_store.write_annotation(output_dir, gene_names.reindex(genes))
+    if csv:
+        results_store.export_csv(
+            counts_path, os.path.join(output_dir, "normalized_counts.csv"))
+
+    if transformed == "log2":
+        results_store.write_matrix(
+            results_store.table_path(output_dir, "log2_counts"),
+            dds.layers["normed_counts"], samples, genes, dtype=dtype,
+            compression=compression, transform=lambda block: np.log2(block + 1)
+        )
+    elif transformed == "vst":
+        dds.vst()
+        results_store.write_matrix(
+            results_store.table_path(output_dir, "vst_counts"),
+            dds.layers["vst_counts"], samples, genes, dtype=dtype,
+            compression=compression
+        )
+
+
+def load_inputs(settings):
+    """Read the counts and metadata of a dataset for the analysis.
+
+    Returns the samples x genes counts, the gene names indexed by Gene ID
+    and the metadata of the analysed samples, both sorted by sample ID.
+    """
+    # Read the raw counts data in chunks as a samples x genes matrix,
+    # removing genes with zero counts or without a gene name on the way
+    with stage_profiler.stage("load_counts") as record:
+        counts_sorted, gene_names, load_stats = count_loader.load_counts(
+            settings["raw_counts"],
+            gene_id_column=settings["gene_id_column"],
+            gene_name_column=settings["gene_name_column"],
+            chunksize=settings["count_chunksize"]
+        )
+        record["rows"] = load_stats["genes_read"]
+    print(
+        f"Read {load_stats['genes_read']} genes: removed "
+        f"{load_stats['zero_counts']} with zero counts and "
+        f"{load_stats['missing_name']} without a gene name, "
+        f"{load_stats['genes_kept']} kept"
+    )
+
+    # Load the metadata file and filter out unanalysed samples
+    metadata = pd.read_csv(settings["design"], sep="\t")
+    metadata_filter = metadata[metadata["Analysed"] != "No"]
+
+    # Select sample IDs and condition columns only for analysis
+    metadata_final = metadata_filter[
+        [settings["sample_column"], settings["factor_column"]]
+    ]
+
+    # Rename the columns for analysis
+    metadata_final = metadata_final.rename(columns={
+        settings["sample_column"]: "Sample_ID",
+        settings["factor_column"]: settings["design_factor"]
+    })
+
+    # Set the sample_id as the index to match the transposed count data
+    metadata_final = metadata_final.set_index("Sample_ID")
+
+    # Sort the metadata by the sample IDs, like the counts
+    metadata_sorted = metadata_final.sort_index()
+    return counts_sorted, gene_names, metadata_sorted
+
+
+def run_analysis(settings, csv=False, use_cache=True,
+                 cache_dir=deseq_cache.default_cache_dir,
+                 cache_size=deseq_cache.default_max_bytes,
+                 all_pairwise=False, inputs=None):
+    """Run the differential expression analysis for one dataset.
+
+    settings are the resolved dataset settings from pipeline_config. The
+    results tables, the normalized counts and the contrast manifest are
+    written to settings["deseq_dir"]. inputs may hold the counts, gene
+    names and metadata as returned by load_inputs, e.g. a resampled copy.
+    Returns the results DataFrames keyed by table name.
+    """
+    # Define input and output paths
+    output_dir = settings["deseq_dir"]
+    design_factor = settings["design_factor"]
+
+    # Create output directory
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        print(f"Directory created!")
+    else:
+        print(f"Directory already exists.")
+
+    # Read the counts and metadata unless they were given
+    if inputs is None:
+        inputs = load_inputs(settings)
+    counts_sorted, gene_names, metadata_sorted = inputs
+
+    # Drop the genes with too few reads to be tested before fitting
+    if settings["prefilter"]:
+        with stage_profiler.stage(
+                "prefilter", rows=counts_sorted.shape[1]) as record:
+            counts_sorted, filter_stats = gene_prefilter.prefilter(
+                counts_sorted, metadata_sorted, design_factor,
+                settings["prefilter"])
+            record.update(filter_stats)
+        gene_names = gene_names.reindex(counts_sorted.columns)
+        removed = ", ".join(
+            f"{value} by {key[len('removed_'):]}"
+            for key, value in filter_stats.items()
+            if key.startswith("removed_"))
+        print(f"Prefilter kept {filter_stats['genes_kept']} of "
+              f"{filter_stats['genes_in']} genes (removed {removed})")
+
+    ############### Differential Analysis ###################################
+
+    # Reuse a cached fit when the counts, metadata and design are unchanged
+    inference = DefaultInference(
+        n_cpus=settings["n_cpus"] or os.cpu_count() or 1)
+    cache_key = deseq_cache.fingerprint(
+        counts_sorted, metadata_sorted, design_factor, refit_cooks=True
+    )
+    dds = None
+    if use_cache:
+        with stage_profiler.stage("cache_lookup"):
+            dds = deseq_cache.load(cache_dir, cache_key)
+
+    if dds is not None:
+        print(f"Loaded DESeq2 fit from cache ({cache_key[:12]})")
+        dds.inference = inference
+    else:
+        # Run the differential expression analysis
+        dds = DeseqDataSet(
+                counts=counts_sorted,
+                metadata=metadata_sorted,
+                design_factors=design_factor,
+                refit_cooks=True,
+                inference=inference
+            )
+
+        fit_model(dds)
+        if use_cache:
+            with stage_profiler.stage("cache_store"):
+                deseq_cache.store(
+                    cache_dir, cache_key, dds, max_bytes=cache_size)
+    print(dds)
+    print(dds.varm["dispersions"])
+    print(dds.varm["LFC"])
+
+    # Compare the conditions listed in the configuration, or every pair of
+    # levels of the design factor when none are given
+    contrasts = settings["contrasts"]
+    if contrasts is None or all_pairwise:
+        contrasts = contrast_runner.all_pairwise_contrasts(
+            metadata_sorted, design_factor, settings["reference_level"])
+        contrasts = {
+            contrast_runner.contrast_name(c): c for c in contrasts
+        }
+
+    # Run all comparisons concurrently on the fitted dataset
+    with stage_profiler.stage("contrasts", rows=len(contrasts)):
+        results_dfs, contrast_times = contrast_runner.run_contrasts(
+            dds, contrasts, n_workers=settings["contrast_workers"]
+        )
+    for name, elapsed in contrast_times.items():
+        stage_profiler.add_record({
+            "stage": f"contrast:{name}",
+            "wall_s": round(elapsed, 6),
+            "rows": len(results_dfs[name])
+        })
+    print(f"All contrasts finished in {sum(contrast_times.values()):.2f}s "
+          f"of worker time")
+
+    # Create a mapping dictionary from Gene ID to Gene Name
+    gene_name_dict = gene_names.to_dict()
+
+    # Add gene names to all the results dataframes
+    results = {
+        f"{name}_results": add_gene_names(results_df, gene_name_dict)
+        for name, results_df in results_dfs.items()
+    }
+
+    # Save the results and normalized counts
+    with stage_profiler.stage("write_results", rows=dds.n_vars):
+        write_outputs(
+            output_dir, results, contrasts, dds, gene_names, csv,
+            dtype=settings["count_dtype"],
+            compression=settings["count_compression"],
+            transformed=settings["transformed_counts"]
+        )
+
+    # Index the results for top gene and significance lookups
+    with stage_profiler.stage("hit_index", rows=dds.n_vars):
+        hit_index.build_index(output_dir, {
+            name: results[f"{name}_results"] for name in contrasts
+        })
+
+    print("All processed successfully")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run the differential expression analysis with PyDESeq2."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--csv",
+        action="store_true",
+        help="Also write the results as CSV files for compatibility"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always refit the model instead of using the DESeq2 fit cache"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=deseq_cache.default_cache_dir,
+        help="Directory of the DESeq2 fit cache"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=deseq_cache.default_max_bytes / 1024 ** 3,
+        help="Maximum size of the DESeq2 fit cache in GB (default: 2)"
+    )
+    parser.add_argument(
+        "--all-pairwise",
+        action="store_true",
+        help="Test every pairwise combination of the design factor levels "
+             "instead of the contrasts listed in the configuration"
+    )
+    parser.add_argument(
+        "--contrast-workers",
+        type=int,
+        default=None,
+        help="Number of processes used to run the contrasts "
+             "(default: one per contrast, up to the number of CPUs)"
+    )
+    prefilter = parser.add_mutually_exclusive_group()
+    prefilter.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Drop low-count genes before the fit (default rules unless "
+             "the configuration sets them)"
+    )
+    prefilter.add_argument(
+        "--no-prefilter",
+        action="store_true",
+        help="Fit every gene with a nonzero count"
+    )
+    parser.add_argument(
+        "--count-dtype",
+        choices=["float32", "float64"],
+        default=None,
+        help="Type of the stored normalized counts "
+             "(default: from the configuration, float64; float32 halves "
+             "the size but rounds the values)"
+    )
+    parser.add_argument(
+        "--count-compression",
+        choices=["uncompressed", "lz4", "zstd"],
+        default=None,
+        help="Compression of the stored count matrices; compressed files "
+             "are smaller but cannot be memory mapped "
+             "(default: from the configuration, uncompressed)"
+    )
+    parser.add_argument(
+        "--transformed-counts",
+        choices=["log2", "vst"],
+        default=None,
+        help="Also store log2(count + 1) or variance stabilized counts"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    if args.contrast_workers is not None:
+        settings["contrast_workers"] = args.contrast_workers
+    if args.prefilter:
+        settings["prefilter"] = settings["prefilter"] or True
+    elif args.no_prefilter:
+        settings["prefilter"] = None
+    for key in ("count_dtype", "count_compression", "transformed_counts"):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    stage_profiler.context["dataset"] = settings["name"]
+    try:
+        run_analysis(
+            settings,
+            csv=args.csv,
+            use_cache=not args.no_cache,
+            cache_dir=args.cache_dir,
+            cache_size=int(args.cache_size * 1024 ** 3),
+            all_pairwise=args.all_pairwise
+        )
+    finally:
+        stage_profiler.write_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,159 +1,464 @@
 #!/usr/bin/python3
 
-import pymysql
-
-# Establish a connection to the database
-connection = pymysql.connect(
-    host="localhost",
-    user="eugwueke",
-    database="eugwueke",
-    cursorclass=pymysql.cursors.DictCursor,
-    unix_socket="/run/mysqld/mysqld.sock"
-)
-
-# Set path to the input sql files
-input_dir = "../results/sql_outputs"
-
-# Define the paths to the .sql files
-raw_counts_sql_path = f"{input_dir}/raw_counts.sql"
-metadata_sql_path = f"{input_dir}/metadata.sql"
-normalized_counts_sql_path = f"{input_dir}/normalized_counts.sql"
-tnbc_vs_normal_sql_path = f"{input_dir}/tnbc_vs_normal_results.sql"
-nontnbc_vs_normal_sql_path = f"{input_dir}/nontnbc_vs_normal_results.sql"
-her2_vs_normal_sql_path = f"{input_dir}/her2_vs_normal_results.sql"
-tnbc_vs_nontnbc_sql_path = f"{input_dir}/tnbc_vs_nontnbc_results.sql"
-tnbc_vs_her2_sql_path = f"{input_dir}/tnbc_vs_her2_results.sql"
-nontnbc_vs_her2_sql_path = f"{input_dir}/nontnbc_vs_her2_results.sql"
-
-# Drop any existing tables and create new tables
-with connection:
-    with connection.cursor() as cursor:
-        # Dropping any existing tables with the same name
-        cursor.execute("DROP TABLE IF EXISTS raw_counts;")
-        cursor.execute("DROP TABLE IF EXISTS experiment_metadata;")
-        cursor.execute("DROP TABLE IF EXISTS normalized_counts;")
-        cursor.execute("DROP TABLE IF EXISTS tnbc_vs_normal_results;")
-        cursor.execute("DROP TABLE IF EXISTS nontnbc_vs_normal_results;")
-        cursor.execute("DROP TABLE IF EXISTS her2_vs_normal_results;")
-        cursor.execute("DROP TABLE IF EXISTS tnbc_vs_nontnbc_results;")
-        cursor.execute("DROP TABLE IF EXISTS tnbc_vs_her2_results;")
-        cursor.execute("DROP TABLE IF EXISTS nontnbc_vs_her2_results;")
-        print("Existing tables dropped successfully.")
-
-        # Create the raw_counts table
-        create_table_query_raw_counts = """
-        CREATE TABLE raw_counts (
-            `Gene ID` VARCHAR(30),
-            `Gene Name` VARCHAR(30),
-            `SRR1027182` INTEGER,
-            `SRR1027186` INTEGER,
-            `SRR1027185` INTEGER,
-            `SRR1027177` INTEGER,
-            `SRR1027181` INTEGER,
-            `SRR1027175` INTEGER,
-            `SRR1027180` INTEGER,
-            `SRR1027184` INTEGER,
-            `SRR1027190` INTEGER,
-            `SRR1027188` INTEGER,
-            `SRR1027176` INTEGER,
-            `SRR1027189` INTEGER,
-            `SRR1027174` INTEGER,
-            `SRR1027179` INTEGER,
-            `SRR1027178` INTEGER,
-            `SRR1027187` INTEGER,
-            `SRR1027171` INTEGER,
-            `SRR1027173` INTEGER,
-            `SRR1027183` INTEGER
-        );
-        """
-        cursor.execute(create_table_query_raw_counts)
-
-        # Create the experiment_metadata table
-        create_table_query_experiment_metadata = """
-        CREATE TABLE experiment_metadata (
-            `Sample_ID` VARCHAR(10),
-            `Condition` VARCHAR(50),
-            `Disease` VARCHAR(50)
-        );
-        """
-        cursor.execute(create_table_query_experiment_metadata)
-
-        # Create the normalized_counts table
-        create_table_query_normalized_counts = """
-        CREATE TABLE normalized_counts (
-            `Gene ID` VARCHAR(30),
-            `SRR1027171` INTEGER,
-            `SRR1027173` INTEGER,
-            `SRR1027174` INTEGER,
-            `SRR1027175` INTEGER,
-            `SRR1027176` INTEGER,
-            `SRR1027177` INTEGER,
-            `SRR1027178` INTEGER,
-            `SRR1027179` INTEGER,
-            `SRR1027180` INTEGER,
-            `SRR1027181` INTEGER,
-            `SRR1027182` INTEGER,
-            `SRR1027183` INTEGER,
-            `SRR1027184` INTEGER,
-            `SRR1027185` INTEGER,
-            `SRR1027186` INTEGER,
-            `SRR1027187` INTEGER,
-            `SRR1027188` INTEGER,
-            `SRR1027189` INTEGER,
-            `SRR1027190` INTEGER,
-            `Gene_Name` VARCHAR(50)
-        );
-        """
-        cursor.execute(create_table_query_normalized_counts)
-
-        # Create tables for comparison results
-        create_table_query_comparison = """
-        CREATE TABLE {} (
-            `Gene ID` VARCHAR(30),
-            `baseMean` FLOAT NULL,
-            `log2FoldChange` FLOAT NULL,
-            `lfcSE` FLOAT NULL,
-            `stat` FLOAT NULL,
-            `pvalue` FLOAT NULL,
-            `padj` FLOAT NULL,
-            `Gene_Name` VARCHAR(50)
-        );
-        """
-        comparison_tables = [
-            "tnbc_vs_normal_results",
-            "nontnbc_vs_normal_results",
-            "her2_vs_normal_results",
-            "tnbc_vs_nontnbc_results",
-            "tnbc_vs_her2_results",
-            "nontnbc_vs_her2_results"
+import argparse
+import contextlib
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import acquire_data
+import db_access
+import db_sync
+import normalized_schema
+import pipeline_config
+import results_store
+import stage_profiler
+
+# Column type of the sample columns of the raw counts table
+count_type = "INTEGER"
+
+# SQL column types of the Arrow types written by run_deseq_analysis.py.
+# Floating point columns keep their full precision and every numeric
+# column accepts NULL for missing values.
+sql_types = {
+    "double": "DOUBLE NULL",
+    "float": "FLOAT NULL",
+    "halffloat": "FLOAT NULL",
+    "int64": "BIGINT NULL",
+    "int32": "INTEGER NULL",
+    "int16": "SMALLINT NULL",
+    "int8": "SMALLINT NULL",
+    "uint64": "BIGINT UNSIGNED NULL",
+    "uint32": "INTEGER UNSIGNED NULL",
+    "uint16": "INTEGER NULL",
+    "uint8": "SMALLINT NULL",
+    "bool": "BOOLEAN NULL"
+}
+
+
+def sql_type(column, arrow_type):
+    """Return the SQL column type for a stored column."""
+    if column == results_store.index_column:
+        return "VARCHAR(30)"
+    if arrow_type in sql_types:
+        return sql_types[arrow_type]
+    if arrow_type.startswith("decimal"):
+        return arrow_type.upper().replace("DECIMAL128", "DECIMAL") + " NULL"
+    return "VARCHAR(50)"
+
+
+def read_header(file_path, delimiter):
+    """Return the column names of a TSV/CSV file."""
+    with acquire_data.open_text(file_path, newline='') as file:
+        return next(csv.reader(file, delimiter=delimiter))
+
+
+def table_sources(settings):
+    """Return table name -> (.sql file, source file, delimiter) for a dataset.
+
+    The analysis tables are listed from the contrast manifest. Their source
+    file is the CSV export used by LOAD DATA, while bulk mode reads them
+    from the columnar store.
+    """
+    sql_dir = settings["sql_dir"]
+    deseq_dir = settings["deseq_dir"]
+    sources = {
+        "raw_counts": (
+            f"{sql_dir}/raw_counts.sql", settings["raw_counts"], "\t"
+        ),
+        "experiment_metadata": (
+            f"{sql_dir}/metadata.sql", settings["filtered_design"], "\t"
+        )
+    }
+    for table_name in results_store.analysis_tables(deseq_dir):
+        sources[table_name] = (
+            f"{sql_dir}/{table_name}.sql",
+            f"{deseq_dir}/{table_name}.csv",
+            ","
+        )
+    return sources
+
+
+def table_schemas(settings):
+    """Derive the column definitions of every table from the data.
+
+    Sample columns come from the raw counts header, and the analysis
+    tables (one results table per stored contrast and the normalized
+    counts) are typed from the dtypes saved in the columnar store.
+    Returns table name -> list of (column, type).
+    """
+    gene_id = settings["gene_id_column"]
+    gene_name = settings["gene_name_column"]
+    deseq_dir = settings["deseq_dir"]
+    schemas = {}
+
+    # Raw counts: gene columns then one count column per sample
+    raw_header = read_header(settings["raw_counts"], "\t")
+    schemas["raw_counts"] = [
+        (column, "VARCHAR(30)" if column in (gene_id, gene_name)
+         else count_type)
+        for column in raw_header
+    ]
+
+    # Experiment metadata: the selected design columns
+    schemas["experiment_metadata"] = [
+        (column, "VARCHAR(50)")
+        for column in settings["metadata_columns"].values()
+    ]
+
+    # Analysis tables: column types follow the stored DataFrame dtypes
+    for table_name in results_store.analysis_tables(deseq_dir):
+        schema = results_store.read_schema(
+            results_store.table_path(deseq_dir, table_name))
+        schemas[table_name] = [
+            (column, sql_type(column, arrow_type))
+            for column, arrow_type in schema
         ]
-        for table_name in comparison_tables:
-            cursor.execute(create_table_query_comparison.format(table_name))
-
-        print("Tables created successfully.")
-
-        # Insert data from the sql files to the database
-        sql_files = {
-            "raw_counts": raw_counts_sql_path,
-            "experiment_metadata": metadata_sql_path,
-            "normalized_counts": normalized_counts_sql_path,
-            "tnbc_vs_normal_results": tnbc_vs_normal_sql_path,
-            "nontnbc_vs_normal_results": nontnbc_vs_normal_sql_path,
-            "her2_vs_normal_results": her2_vs_normal_sql_path,
-            "tnbc_vs_nontnbc_results": tnbc_vs_nontnbc_sql_path,
-            "tnbc_vs_her2_results": tnbc_vs_her2_sql_path,
-            "nontnbc_vs_her2_results": nontnbc_vs_her2_sql_path
-        }
-
-        for table_name, sql_file_path in sql_files.items():
-            with open(sql_file_path, 'r') as sql_file:
-                sql_statements = sql_file.read()
-                sql_statements = sql_statements.replace("''", "NULL")
-                for statement in sql_statements.split(";"):
-                    if statement.strip():
-                        cursor.execute(statement)
-            print(f"Data inserted into table '{table_name}' successfully.")
-
-    # Commit the changes and close connection
-    connection.commit()
+    return schemas
+
+
+def create_tables(cursor, schemas, prefix=""):
+    """Drop any existing tables and create new empty ones."""
+    # Dropping any existing tables with the same name
+    for table_name in schemas:
+        cursor.execute(f"DROP TABLE IF EXISTS {prefix}{table_name};")
+    print("Existing tables dropped successfully.")
+
+    # Create each table from its column definitions
+    for table_name, columns in schemas.items():
+        definitions = ",\n    ".join(
+            "`{}` {}".format(column, column_type)
+            for column, column_type in columns
+        )
+        cursor.execute(
+            f"CREATE TABLE {prefix}{table_name} (\n    {definitions}\n);")
+
+    print("Tables created successfully.")
+
+
+def load_sql_file(cursor, sql_file_path, table=None, target=None):
+    """Run every statement of a generated .sql file, one at a time.
+
+    generate_insert_statements.py writes one statement per line, so the
+    file is streamed line by line. If target is given, rows written for
+    table are inserted into target instead.
+    """
+    prefix = f"INSERT INTO {table}("
+    with open(sql_file_path, 'r') as sql_file:
+        for statement in sql_file:
+            statement = statement.strip()
+            if target is not None and statement.startswith(prefix):
+                statement = f"INSERT INTO {target}(" + statement[len(prefix):]
+            if statement:
+                cursor.execute(statement.rstrip(";"))
+
+
+def read_batches(file_path, delimiter, batch_size):
+    """Yield the header and then lists of at most batch_size rows.
+
+    Empty fields are returned as None so they are stored as NULL.
+    """
+    with acquire_data.open_text(file_path, newline='') as file:
+        reader = csv.reader(file, delimiter=delimiter)
+        yield next(reader)
+        batch = []
+        for row in reader:
+            batch.append([value if value != '' else None for value in row])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def bulk_insert_table(connection, table, batches):
+    """Insert rows into a table with batched executemany calls.
+
+    batches yields the column names first and then lists of rows, as
+    produced by read_batches or results_store.iter_row_batches. The whole
+    table is loaded in a single transaction. Returns the number of rows
+    inserted.
+    """
+    header = next(batches)
+    columns = ",".join("`{}`".format(column) for column in header)
+    values = ",".join([db_access.placeholder(connection)] * len(header))
+    insert_query = "INSERT INTO {}({}) VALUES({})".format(
+        table, columns, values)
+    row_count = 0
+    cursor = connection.cursor()
+    try:
+        for batch in batches:
+            cursor.executemany(insert_query, batch)
+            row_count += len(batch)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return row_count
+
+
+def load_data_infile(connection, table, file_path, delimiter=','):
+    """Load a TSV/CSV file with LOAD DATA LOCAL INFILE (MySQL/MariaDB only).
+
+    Empty fields are mapped to NULL through user variables, matching the
+    other load paths. Returns the number of rows inserted.
+    """
+    if db_access.is_sqlite(connection):
+        raise ValueError("LOAD DATA INFILE needs a MySQL/MariaDB database")
+    if file_path.endswith(".gz"):
+        # The server reads plain text only, so decompress to a temporary file
+        with tempfile.NamedTemporaryFile(suffix=".tsv", delete=False) as tmp:
+            with gzip.open(file_path, "rb") as source:
+                shutil.copyfileobj(source, tmp)
+        try:
+            return load_data_infile(connection, table, tmp.name, delimiter)
+        finally:
+            os.remove(tmp.name)
+    header = read_header(file_path, delimiter)
+    variables = ",".join("@v{}".format(i) for i in range(len(header)))
+    assignments = ",".join(
+        "`{}` = NULLIF(@v{}, '')".format(column, i)
+        for i, column in enumerate(header)
+    )
+    terminator = "\\t" if delimiter == "\t" else delimiter
+    load_query = (
+        "LOAD DATA LOCAL INFILE %s INTO TABLE {} "
+        "FIELDS TERMINATED BY '{}' OPTIONALLY ENCLOSED BY '\"' "
+        "LINES TERMINATED BY '\\n' IGNORE 1 LINES ({}) SET {}"
+    ).format(table, terminator, variables, assignments)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(load_query, (file_path,))
+        row_count = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return row_count
+
+
+def report_rate(table_name, row_count, elapsed):
+    """Print the load throughput for a table."""
+    rate = row_count / elapsed if elapsed > 0 else float('inf')
+    print(
+        f"Data inserted into table '{table_name}' successfully: "
+        f"{row_count} rows in {elapsed:.2f}s ({rate:,.0f} rows/sec)"
+    )
+
+
+@contextlib.contextmanager
+def table_load_stage(table_name, target):
+    """Record the load of one table as a stage and print its throughput.
+
+    Yields the stage record; set record["rows"] to the rows loaded.
+    """
+    start = time.perf_counter()
+    with stage_profiler.stage(f"db_load:{table_name}") as record:
+        yield record
+    report_rate(target, record["rows"] or 0, time.perf_counter() - start)
+
+
+def connect(settings=None, local_infile=False):
+    """Open a connection to the database configured for a dataset.
+
+    See db_access.db_settings for the configuration and environment
+    variables used.
+    """
+    return db_access.connect(db_access.db_settings(settings), local_infile)
+
+
+def table_keys(settings):
+    """Return table name -> column identifying its rows."""
+    sample_id = settings["metadata_columns"][settings["sample_column"]]
+    keys = {
+        "raw_counts": settings["gene_id_column"],
+        "experiment_metadata": sample_id
+    }
+    for table_name in results_store.analysis_tables(settings["deseq_dir"]):
+        keys[table_name] = results_store.index_column
+    return keys
+
+
+def table_batches(settings, table_name, batch_size=5000):
+    """Return the header and row batches of a table's source data."""
+    deseq_dir = settings["deseq_dir"]
+    if table_name in results_store.analysis_tables(deseq_dir):
+        return results_store.iter_row_batches(
+            results_store.table_path(deseq_dir, table_name), batch_size)
+    _, file_path, delimiter = table_sources(settings)[table_name]
+    return read_batches(file_path, delimiter, batch_size)
+
+
+def load_table(connection, settings, table_name, target, mode="bulk",
+               batch_size=5000):
+    """Fill table target with the data of table_name using a load path.
+
+    Returns the number of rows inserted, or None for the sql path.
+    """
+    sql_file_path, file_path, delimiter = table_sources(settings)[table_name]
+    start = time.perf_counter()
+    with stage_profiler.stage(f"db_load:{table_name}") as record:
+        if mode == "sql":
+            cursor = connection.cursor()
+            try:
+                load_sql_file(cursor, sql_file_path,
+                              f"{settings['table_prefix']}{table_name}",
+                              target)
+            finally:
+                cursor.close()
+            connection.commit()
+            row_count = None
+        elif mode == "bulk":
+            row_count = bulk_insert_table(
+                connection, target,
+                table_batches(settings, table_name, batch_size))
+        else:
+            row_count = load_data_infile(
+                connection, target, file_path, delimiter)
+        record["rows"] = row_count
+    elapsed = time.perf_counter() - start
+    if row_count is None:
+        print(
+            f"Data inserted into table '{target}' successfully "
+            f"in {elapsed:.2f}s."
+        )
+    else:
+        report_rate(target, row_count, elapsed)
+    return row_count
+
+
+def load_database(connection, settings, mode="bulk", batch_size=5000,
+                  sync=None):
+    """Create and populate the tables of one dataset.
+
+    mode selects the load path: "sql" runs the generated .sql files,
+    "bulk" streams the source files with batched inserts and "infile" uses
+    LOAD DATA LOCAL INFILE. sync selects how existing tables are replaced:
+    "recreate" drops them and loads each table in its own transaction,
+    "swap" loads shadow tables and renames them all at once, and "upsert"
+    (bulk mode only) rewrites just the rows whose hash changed in a
+    single transaction. By default bulk loads are upserted and the other
+    paths swapped, so readers never see a partly loaded database.
+    """
+    prefix = settings["table_prefix"]
+    schemas = table_schemas(settings)
+    if sync is None:
+        sync = "upsert" if mode == "bulk" else "swap"
+
+    if sync == "upsert":
+        if mode != "bulk":
+            raise ValueError("The upsert sync needs the bulk load mode")
+        with stage_profiler.stage("db_sync") as record:
+            stats = db_sync.upsert_tables(
+                connection, schemas, table_keys(settings),
+                lambda name: table_batches(settings, name, batch_size),
+                prefix,
+                table_stage=lambda name: table_load_stage(
+                    name, f"{prefix}{name}")
+            )
+            record["rows"] = sum(written for written, _, _ in stats.values())
+    elif sync == "swap":
+        def load(connection, table_name, target):
+            return load_table(connection, settings, table_name, target,
+                              mode, batch_size), None
+
+        db_sync.swap_tables(
+            connection, schemas, table_keys(settings), load, prefix)
+    else:
+        # Drop any existing tables and create new tables
+        cursor = connection.cursor()
+        try:
+            create_tables(cursor, schemas, prefix)
+        finally:
+            cursor.close()
+        connection.commit()
+        for table_name in schemas:
+            load_table(connection, settings, table_name,
+                       f"{prefix}{table_name}", mode, batch_size)
+
+    print("All changes committed successfully.")
+
+
+def load_normalized_database(connection, settings, batch_size=5000):
+    """Create and populate the normalized tables of one dataset."""
+    def insert_rows(connection, table, batches):
+        start = time.perf_counter()
+        with stage_profiler.stage(f"db_load:{table}") as record:
+            row_count = bulk_insert_table(connection, table, batches)
+            record["rows"] = row_count
+        report_rate(table, row_count, time.perf_counter() - start)
+        return row_count
+
+    normalized_schema.load_normalized(
+        connection, settings, insert_rows, batch_size)
     print("All changes committed successfully.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Create the database tables and load the pipeline data."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--mode",
+        choices=["sql", "bulk", "infile"],
+        default="bulk",
+        help="sql: run the generated .sql files statement by statement; "
+             "bulk: stream the TSV files and the columnar results store "
+             "with batched multi-row inserts; infile: use LOAD DATA LOCAL "
+             "INFILE on the TSV/CSV files (needs run_deseq_analysis.py "
+             "--csv)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=5000,
+        help="Rows per executemany batch in bulk mode (default: 5000)"
+    )
+    parser.add_argument(
+        "--sync",
+        choices=["recreate", "swap", "upsert"],
+        default=None,
+        help="recreate: drop and reload every table; swap: load shadow "
+             "tables and rename them in one step; upsert: only rewrite "
+             "rows whose hash changed, in one transaction "
+             "(default: upsert in bulk mode, swap otherwise)"
+    )
+    parser.add_argument(
+        "--schema",
+        choices=["wide", "normalized"],
+        default="wide",
+        help="wide: one table per contrast and one column per sample; "
+             "normalized: genes/samples/contrasts tables with long, indexed "
+             "counts and de_results tables (always loaded in bulk)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+
+    stage_profiler.context["dataset"] = settings["name"]
+    # Establish a connection to the database
+    connection = connect(settings, local_infile=args.mode == "infile")
+    try:
+        if args.schema == "normalized":
+            load_normalized_database(connection, settings, args.batch_size)
+        else:
+            load_database(connection, settings, args.mode, args.batch_size,
+                          args.sync)
+    finally:
+        connection.close()
+        stage_profiler.write_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+# Vectorized significance calls across contrasts.
+# significant_calls is the one rule deciding whether a gene is significant;
+# hit_index applies it to build the genes x contrasts boolean matrix, so
+# overlaps between any number of contrasts are column reductions instead of
+# Python set lookups.
+
+import numpy as np
+import pandas as pd
+
+
+def significant_calls(values, log2_fold_changes, alpha=0.05,
+                      lfc_threshold=0.5):
+    """Return the significance calls of arrays of genes.
+
+    A gene is significant when its value (pvalue or padj) is below alpha
+    and its absolute log2FoldChange is above lfc_threshold. Missing values
+    count as not significant.
+    """
+    with np.errstate(invalid="ignore"):
+        return (
+            (np.asarray(values) < alpha)
+            & (np.abs(np.asarray(log2_fold_changes)) > lfc_threshold)
+        )
+
+
+def genes_in_min_contrasts(matrix, min_comparisons=2):
+    """Return the Gene IDs significant in at least min_comparisons."""
+    counts = matrix.to_numpy().sum(axis=1)
+    return matrix.index[counts >= min_comparisons]
+
+
+def overlap_counts(matrix):
+    """Return an UpSet-style table of significance patterns.
+
+    Each row is one combination of contrasts (True where the genes are
+    significant), with the number of genes showing exactly that pattern
+    and the size of the combination. Genes significant nowhere are left
+    out. Rows are sorted by decreasing number of genes.
+    """
+    significant = matrix[matrix.to_numpy().any(axis=1)]
+    if significant.empty:
+        return pd.DataFrame(
+            columns=list(matrix.columns) + ["n_contrasts", "genes"])
+    # Pack each row into bytes so identical patterns can be counted at once
+    packed = np.packbits(significant.to_numpy(), axis=1)
+    _, first, counts = np.unique(
+        packed, axis=0, return_index=True, return_counts=True)
+    table = significant.iloc[first].reset_index(drop=True)
+    table["n_contrasts"] = table.to_numpy().sum(axis=1)
+    table["genes"] = counts
+    return table.sort_values(
+        ["genes", "n_contrasts"], ascending=False, ignore_index=True)
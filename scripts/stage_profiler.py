@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+# Stage-level timing and memory instrumentation for the pipeline.
+# Wrap each step in stage() (or decorate it with profiled()) to record its
+# wall time, CPU time, peak RSS and row count. On Linux the peak RSS is the
+# stage's own: the kernel's high-water mark is reset when a stage starts.
+# Elsewhere it is the peak of the process so far. Records are appended to a
+# per-run JSON lines file and summarized as JSON and CSV, so several
+# scripts (or worker processes) of one pipeline run share a report.
+#
+# Environment variables:
+#   BRCA_RUN_ID         identifies the pipeline run (default: time and pid)
+#   BRCA_REPORT_DIR     directory of the run reports
+#   BRCA_PROFILE_STAGE  stage to profile with pyinstrument, or cProfile if
+#                       pyinstrument is not installed
+#   BRCA_NO_PROFILE     set to 1 to turn reporting off
+
+import contextlib
+import cProfile
+import csv
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+# Default directory of the run reports
+default_report_dir = "../results/run_reports"
+
+# Columns of the CSV report
+report_columns = ["run_id", "dataset", "stage", "pid", "start", "wall_s",
+                  "cpu_s", "children_cpu_s", "peak_rss_mb", "rows"]
+
+# Records not written yet and values added to every record
+records = []
+context = {}
+
+# Peak RSS (kB) seen so far by each open stage, innermost last
+_open_peaks = []
+
+
+def run_id():
+    """Return the identifier of the current pipeline run."""
+    if "BRCA_RUN_ID" not in os.environ:
+        os.environ["BRCA_RUN_ID"] = "{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+    return os.environ["BRCA_RUN_ID"]
+
+
+def report_dir():
+    """Return the directory the run reports are written to."""
+    return os.environ.get("BRCA_REPORT_DIR", default_report_dir)
+
+
+def enabled():
+    """Check whether reporting is turned on."""
+    return os.environ.get("BRCA_NO_PROFILE", "0") != "1"
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def _high_water_kb():
+    """Return the RSS high-water mark (VmHWM) in kB, None if unknown."""
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_high_water():
+    """Reset VmHWM to the current RSS; returns False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _update_open_peaks():
+    """Fold the high-water mark into every open stage, then reset it.
+
+    Returns False when the mark cannot be read or reset, in which case
+    stages fall back to the process peak.
+    """
+    peak = _high_water_kb()
+    if peak is None:
+        return False
+    for i, open_peak in enumerate(_open_peaks):
+        _open_peaks[i] = max(open_peak, peak)
+    return _reset_high_water()
+
+
+def children_cpu_s():
+    """Return the CPU time used by finished child processes."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextlib.contextmanager
+def _profile(name):
+    """Profile a block if it is the stage chosen by BRCA_PROFILE_STAGE."""
+    if os.environ.get("BRCA_PROFILE_STAGE") != name:
+        yield
+        return
+    os.makedirs(report_dir(), exist_ok=True)
+    base = os.path.join(report_dir(), "{}-{}".format(
+        run_id(), name.replace("/", "_").replace(":", "_")))
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(base + ".prof")
+            print(f"cProfile output for '{name}' saved to {base}.prof")
+        return
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        with open(base + ".html", "w") as file:
+            file.write(profiler.output_html())
+        print(f"pyinstrument output for '{name}' saved to {base}.html")
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """Record the cost of the enclosed block as a pipeline stage.
+
+    Yields the record dict; set record["rows"] inside the block when the
+    number of rows is only known at the end.
+    """
+    record = {"stage": name, "rows": rows}
+    # Nested stages keep the peaks of their enclosing stages up to date
+    per_stage = _update_open_peaks()
+    _open_peaks.append(_high_water_kb() or 0)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_start = children_cpu_s()
+    record["start"] = time.time()
+    try:
+        with _profile(name):
+            yield record
+    finally:
+        record["wall_s"] = round(time.perf_counter() - wall_start, 6)
+        record["cpu_s"] = round(time.process_time() - cpu_start, 6)
+        record["children_cpu_s"] = round(
+            children_cpu_s() - children_start, 6)
+        if per_stage and _update_open_peaks():
+            record["peak_rss_mb"] = round(_open_peaks[-1] / 1024, 1)
+        else:
+            record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        _open_peaks.pop()
+        add_record(record)
+
+
+def profiled(name=None, rows=None):
+    """Decorator recording every call of a function as a stage."""
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, rows):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_record(record):
+    """Add a finished stage record, e.g. one measured in a worker."""
+    record = dict(record)
+    record.update(context)
+    record["run_id"] = run_id()
+    record["pid"] = os.getpid()
+    records.append(record)
+
+
+def write_report():
+    """Append the pending records to the run report and summarize it.
+
+    The report of a run is <run_id>.jsonl, with <run_id>.json and
+    <run_id>.csv regenerated from it. Returns the JSON path, or None when
+    reporting is off or nothing was recorded.
+    """
+    if not enabled() or not records:
+        records.clear()
+        return None
+    directory = report_dir()
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, run_id())
+
+    # Append in one write so concurrent processes do not interleave lines
+    lines = "".join(json.dumps(record) + "\n" for record in records)
+    with open(base + ".jsonl", "a") as file:
+        file.write(lines)
+    records.clear()
+
+    with open(base + ".jsonl", "r") as file:
+        all_records = [json.loads(line) for line in file if line.strip()]
+    with open(base + ".json", "w") as file:
+        json.dump({"run_id": run_id(), "stages": all_records}, file,
+                  indent=2)
+    with open(base + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=report_columns,
+                                extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(all_records)
+    return base + ".json"
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# Generate synthetic RNA-Seq datasets laid out like the EBI Expression Atlas
+# download of E-GEOD-52194, so the pipeline can be run and benchmarked
+# without network access. Counts are drawn from a negative binomial with a
+# mean-dependent dispersion, per-sample size factors and a share of
+# differentially expressed genes for each condition.
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Conditions of E-GEOD-52194, the first one is the reference
+default_levels = [
+    "normal",
+    "triple-negative breast cancer",
+    "non-triple-negative breast cancer",
+    "HER2 Positive Breast Carcinoma"
+]
+
+# Share of genes that are never expressed, lack a gene name, or are
+# differentially expressed in each non-reference condition
+zero_fraction = 0.05
+unnamed_fraction = 0.02
+de_fraction = 0.1
+
+# First run accession of the synthetic samples
+first_run = 1027171
+
+
+def sample_ids(n_samples):
+    """Return SRR run accessions for the samples."""
+    return [f"SRR{first_run + i}" for i in range(n_samples)]
+
+
+def sample_levels(n_samples, levels=default_levels):
+    """Assign the samples to the conditions as evenly as possible."""
+    return [levels[i % len(levels)] for i in range(n_samples)]
+
+
+def design_table(n_samples, levels=default_levels):
+    """Return the experiment design in the Expression Atlas layout."""
+    conditions = sample_levels(n_samples, levels)
+    disease = [
+        "normal" if level == levels[0] else "breast cancer"
+        for level in conditions
+    ]
+    return pd.DataFrame({
+        "Run": sample_ids(n_samples),
+        "Sample Characteristic[organism]": "Homo sapiens",
+        "Sample Characteristic[clinical information]": conditions,
+        "Sample Characteristic[disease]": disease,
+        "Factor Value[clinical information]": conditions,
+        "Analysed": "Yes"
+    })
+
+
+def gene_parameters(n_genes, n_levels, rng):
+    """Draw the mean, dispersion and log2 fold changes of every gene."""
+    # Log-normal base means spanning the usual RNA-Seq range
+    base_mean = rng.lognormal(mean=5.0, sigma=2.0, size=n_genes)
+    base_mean[rng.random(n_genes) < zero_fraction] = 0.0
+
+    # Dispersion trend alpha = a0 + a1 / mean with log-normal scatter
+    dispersion = (0.05 + 2.0 / np.maximum(base_mean, 1.0)) * rng.lognormal(
+        mean=0.0, sigma=0.5, size=n_genes)
+
+    # Fold changes against the reference for the other conditions
+    lfc = np.zeros((n_genes, n_levels))
+    for level in range(1, n_levels):
+        de = rng.random(n_genes) < de_fraction
+        lfc[de, level] = rng.normal(0.0, 2.0, size=de.sum())
+    return base_mean, dispersion, lfc
+
+
+def write_dataset(data_dir, name, n_samples=19, n_genes=40000,
+                  levels=default_levels, seed=0, chunksize=10000):
+    """Write <name>-raw-counts.tsv and <name>-experiment-design.tsv.
+
+    Counts are generated and written chunksize genes at a time, so large
+    matrices never have to fit in memory. Returns the two file paths.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    counts_path = os.path.join(data_dir, f"{name}-raw-counts.tsv")
+    design_path = os.path.join(data_dir, f"{name}-experiment-design.tsv")
+
+    design = design_table(n_samples, levels)
+    design.to_csv(design_path, sep="\t", index=False)
+
+    samples = design["Run"].tolist()
+    level_index = np.array([
+        levels.index(level)
+        for level in design["Factor Value[clinical information]"]
+    ])
+    size_factors = rng.lognormal(mean=0.0, sigma=0.3, size=n_samples)
+    base_mean, dispersion, lfc = gene_parameters(
+        n_genes, len(levels), rng)
+
+    with open(counts_path, "w", newline="") as file:
+        for start in range(0, n_genes, chunksize):
+            stop = min(start + chunksize, n_genes)
+            genes = np.arange(start, stop)
+
+            # Negative binomial with mean mu and variance mu + alpha mu^2
+            mu = (base_mean[genes, None] * size_factors[None, :]
+                  * np.exp2(lfc[genes][:, level_index]))
+            size = 1.0 / dispersion[genes, None]
+            counts = rng.negative_binomial(size, size / (size + mu))
+
+            names = pd.Series([f"GENE{i + 1}" for i in genes], dtype=object)
+            names[rng.random(len(genes)) < unnamed_fraction] = None
+            chunk = pd.DataFrame(counts.astype(np.uint32), columns=samples)
+            chunk.insert(0, "Gene Name", names)
+            chunk.insert(0, "Gene ID", [f"ENSG{i + 1:011d}" for i in genes])
+            chunk.to_csv(file, sep="\t", index=False, header=start == 0)
+    return counts_path, design_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic dataset in the Expression Atlas "
+                    "layout."
+    )
+    parser.add_argument(
+        "--name",
+        default="synthetic",
+        help="Dataset name used in the file names (default: synthetic)"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default="../data",
+        help="Directory the files are written to (default: ../data)"
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=19,
+        help="Number of samples (default: 19)"
+    )
+    parser.add_argument(
+        "--genes",
+        type=int,
+        default=40000,
+        help="Number of genes (default: 40000)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed (default: 0)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    counts_path, design_path = write_dataset(
+        args.data_dir, args.name, args.samples, args.genes, seed=args.seed)
+    print(f"Synthetic counts saved to {counts_path}")
+    print(f"Synthetic design saved to {design_path}")
+
+
+if __name__ == "__main__":
+    main()
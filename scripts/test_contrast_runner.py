@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+# Tests of the contrasts derived from the design: run with pytest from the
+# scripts directory.
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pydeseq2")
+
+import contrast_runner
+import synthetic_counts
+
+
+def design(seed=None):
+    """Return a design with three samples per level, optionally shuffled."""
+    metadata = pd.DataFrame({
+        "Condition": [level for level in synthetic_counts.default_levels
+                      for _ in range(3)]
+    })
+    if seed is not None:
+        metadata = metadata.sample(frac=1, random_state=seed)
+    return metadata
+
+
+@pytest.mark.parametrize("reference", [None, "normal"])
+def test_contrasts_do_not_depend_on_row_order(reference):
+    expected = contrast_runner.all_pairwise_contrasts(
+        design(), reference=reference)
+    for seed in range(5):
+        assert contrast_runner.all_pairwise_contrasts(
+            design(seed), reference=reference) == expected
+
+
+def test_reference_level_is_tested_against():
+    contrasts = contrast_runner.all_pairwise_contrasts(
+        design(seed=1), reference="normal")
+    names = [contrast_runner.contrast_name(c) for c in contrasts]
+    assert len(names) == 6
+    assert not any(name.startswith("normal_vs_") for name in names)
+    assert sum(name.endswith("_vs_normal") for name in names) == 3
+
+
+def test_unknown_reference_level():
+    with pytest.raises(ValueError):
+        contrast_runner.all_pairwise_contrasts(design(), reference="healthy")
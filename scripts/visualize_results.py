@@ -1,40 +1,51 @@
 #!/usr/bin/python3
 
 # Import libraries
+import argparse
+import hashlib
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+# Render without a display; must be selected before pyplot is imported
+matplotlib.use("Agg")
 import pandas as pd
 from bioinfokit import analys, visuz
+import fast_heatmap
+import hit_index
+import pipeline_config
+import results_store
+import significance
+import stage_profiler
 
-# Create an output directory to save results
-output_dir = "../results/plots"
-os.makedirs(output_dir, exist_ok=True)
-
-# Set the variable for different comparisons
-comparisons = [
-    "tnbc_vs_normal",
-    "nontnbc_vs_normal",
-    "her2_vs_normal",
-    "tnbc_vs_nontnbc",
-    "tnbc_vs_her2",
-    "nontnbc_vs_her2"
-]
-
-# Loop through each file and drop NAN values
-for comp in comparisons:
-    file_path = f"../results/deseq_analysis/{comp}_results.csv"
-    df = pd.read_csv(file_path)
-    print(f"Processing {file_path}...")
-    df = df.dropna(subset=["log2FoldChange", "pvalue"])
-    # Set volcano plotting for all comparisons
+# Volcano plot thresholds
+volcano_lfc_thr = (0.5, -0.5)
+volcano_pv_thr = (0.05, 0.05)
+
+# File type written by bioinfokit and suffix of the input hash sidecars
+figure_ext = ".png"
+hash_ext = ".inputhash"
+
+# Heatmap modes: the top genes drawn by bioinfokit, or every selected gene
+# drawn by fast_heatmap
+heatmap_modes = ["top", "all"]
+heatmap_top_genes = 50
+
+# Directory of the cached heatmap row orders, inside the plots directory
+order_cache_dirname = "heatmap_order"
+
+
+def render_volcano(df, genenames, figname):
+    """Draw one volcano plot."""
     visuz.GeneExpression.volcano(
         df=df,
         lfc='log2FoldChange',
         pv='pvalue',
         geneid='Gene_Name',
-        genenames=tuple(df.sort_values("pvalue").head(10)['Gene_Name']),
+        genenames=genenames,
         gstyle=2,
-        lfc_thr=(0.5, -0.5),
-        pv_thr=(0.05, 0.05),
+        lfc_thr=volcano_lfc_thr,
+        pv_thr=volcano_pv_thr,
         markerdot='*',
         dotsize=20,
         valpha=0.5,
@@ -49,78 +60,354 @@ for comp in comparisons:
         axtickfontsize=10,
         r=300,
         sign_line=True,
-        figname=os.path.join(output_dir, f"volcano_{comp}")
+        figname=figname
     )
-print("Volcano plots created")
-
-# Read the data and select significant genes by pvalue and log2FoldChange
-significant_genes = {}
-for comp in comparisons:
-    file_path = f"../results/deseq_analysis/{comp}_results.csv"
-    df = pd.read_csv(file_path)
-    sig_df = df[(df['pvalue'] < 0.05) & (abs(df['log2FoldChange']) > 0.5)]
-    significant_genes[comp] = set(sig_df['Gene_Name'].tolist())
-    print(f"{comp}: {len(significant_genes[comp])} significant genes")
-
-# Find genes significant in at least two comparisons
-min_comparisons = 2
-genes_to_keep = set()
-for gene_set in significant_genes.values():
-    for gene in gene_set:
-        count = sum(1 for genes in significant_genes.values() if gene in genes)
-        if count >= min_comparisons:
-            genes_to_keep.add(gene)
-
-print(
-    f"Found {len(genes_to_keep)} genes significant in at least "
-    f"{min_comparisons} comparisons"
-)
-
-# Load the data for normalized counts
-norm_counts = pd.read_csv("../results/deseq_analysis/normalized_counts.csv")
-
-# Set Gene_Name as index and select genes in two comparisons
-normalized_counts = norm_counts.set_index("Gene_Name")
-normalized_counts = normalized_counts.drop("Gene ID", axis=1)
-sig_counts = normalized_counts[normalized_counts.index.isin(genes_to_keep)]
-
-# Select top 50 genes to plot based on their variance
-if len(sig_counts) > 50:
-    gene_variance = sig_counts.var(axis=1)
-    top_genes = gene_variance.sort_values(ascending=False).head(50).index
-    sig_counts = sig_counts.loc[top_genes]
-
-print(f"Creating heatmap with {len(sig_counts)} genes")
-
-# Create general heatmap for significant genes for all comparisons
-visuz.gene_exp.hmap(
-        df=sig_counts,
+
+
+def render_heatmap(df, figname):
+    """Draw one clustered heatmap of normalized counts."""
+    visuz.gene_exp.hmap(
+        df=df,
         cmap="RdYlGn",
         zscore=0,
         dim=(6, 6),
         tickfont=(6, 4),
-        figname=os.path.join(output_dir, "significant_genes_heatmap")
+        figname=figname
     )
 
-# Create a separate heatmap for each comparison
-for comp in comparisons:
-    comp_genes = list(significant_genes[comp])
-    if len(comp_genes) > 50:
-        comp_df = pd.read_csv(f"../results/deseq_analysis/{comp}_results.csv")
-        comp_df = comp_df[comp_df['Gene_Name'].isin(comp_genes)]
-        comp_df = comp_df.sort_values('pvalue').head(50)
-        comp_genes = comp_df['Gene_Name'].tolist()
-    comp_counts = normalized_counts[normalized_counts.index.isin(comp_genes)]
-    if len(comp_counts) > 0:
-        visuz.gene_exp.hmap(
-            df=comp_counts,
-            cmap="RdYlGn",
-            zscore=0,
-            dim=(6, 6),
-            tickfont=(6, 4),
-            figname=os.path.join(output_dir, f"heatmap_{comp}")
-        )
+
+def render_large_heatmap(df, cache_dir, figname):
+    """Draw one heatmap of any number of genes as a single image."""
+    fast_heatmap.draw_heatmap(df, figname + figure_ext, cache_dir=cache_dir)
+
+
+# Figure kinds and the function drawing them
+renderers = {
+    "volcano": render_volcano,
+    "heatmap": render_heatmap,
+    "large_heatmap": render_large_heatmap
+}
+
+
+def input_hash(kind, df, *params):
+    """Return a digest of everything a figure is drawn from."""
+    digest = hashlib.sha256(kind.encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).values)
+    digest.update(repr(list(df.columns)).encode())
+    digest.update(repr(params).encode())
+    return digest.hexdigest()
+
+
+def is_up_to_date(figname, digest):
+    """Check whether a figure exists and was drawn from the same inputs."""
+    if not os.path.exists(figname + figure_ext):
+        return False
+    try:
+        with open(figname + hash_ext, "r") as file:
+            return file.read().strip() == digest
+    except FileNotFoundError:
+        return False
+
+
+def downsample_background(df, max_points, seed=0):
+    """Keep every significant point and at most max_points of the rest.
+
+    Points below the volcano thresholds are drawn as one grey cloud, so a
+    random subset looks the same while rendering faster and giving smaller
+    files.
+    """
+    significant = (
+        (df["pvalue"] < volcano_pv_thr[0])
+        & ((df["log2FoldChange"] >= volcano_lfc_thr[0])
+           | (df["log2FoldChange"] <= volcano_lfc_thr[1]))
+    )
+    background = df[~significant]
+    if len(background) <= max_points:
+        return df
+    background = background.sample(n=max_points, random_state=seed)
+    return pd.concat([df[significant], background])
+
+
+def _render_job(job):
+    """Draw one figure and record its input hash."""
+    kind, figname, digest, args = job
+    start = time.perf_counter()
+    renderers[kind](*args, figname=figname)
+    with open(figname + hash_ext, "w") as file:
+        file.write(digest)
+    return figname, time.perf_counter() - start
+
+
+def render_figures(jobs, workers=None):
+    """Draw the figures that are missing or whose inputs changed.
+
+    jobs is a list of (kind, figname, args) tuples where args are the
+    positional arguments of the renderer. Figures are drawn concurrently
+    in a process pool. Returns the number of figures drawn.
+    """
+    pending = []
+    for kind, figname, args in jobs:
+        digest = input_hash(kind, args[0], *args[1:])
+        if is_up_to_date(figname, digest):
+            print(f"Skipping {figname}, inputs unchanged")
+        else:
+            pending.append((kind, figname, digest, args))
+    if not pending:
+        return 0
+    if workers is None:
+        workers = min(len(pending), os.cpu_count() or 1)
+    if workers <= 1:
+        for figname, elapsed in map(_render_job, pending):
+            print(f"Created {figname} in {elapsed:.2f}s")
+        return len(pending)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for figname, elapsed in pool.map(_render_job, pending):
+            print(f"Created {figname} in {elapsed:.2f}s")
+    return len(pending)
+
+
+def plot_results(settings, min_comparisons=2, significance_column="pvalue",
+                 alpha=0.05, lfc_threshold=0.5, workers=None,
+                 max_background_points=None, results=None,
+                 heatmap_mode="top"):
+    """Create the volcano plots and heatmaps for one dataset.
+
+    settings are the resolved dataset settings from pipeline_config.
+    Results are read from settings["deseq_dir"] and the figures are saved
+    to settings["plots_dir"]. Genes are significant when
+    significance_column (pvalue or padj) is below alpha and the absolute
+    log2FoldChange is above lfc_threshold; the combined heatmap shows genes
+    significant in at least min_comparisons contrasts.
+
+    Figures are drawn by worker processes and skipped when their inputs
+    are unchanged. max_background_points limits the number of
+    non-significant points drawn in each volcano plot. results may map
+    contrast names to their results tables already in memory, which are
+    then used instead of reading the stored tables.
+
+    heatmap_mode "top" draws the heatmaps of the 50 most variable (combined)
+    or significant (per contrast) genes with bioinfokit; "all" draws every
+    selected significant gene with fast_heatmap.
+    """
+    # Set the directory with the differential analysis results
+    results_dir = settings["deseq_dir"]
+
+    # Create an output directory to save results
+    output_dir = settings["plots_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Set the variable for different comparisons from the stored contrasts
+    comparisons = list(results_store.read_manifest(results_dir))
+    if not comparisons:
+        print(f"No contrasts stored in {results_dir}, nothing to plot")
+        return
+
+    # Load only the columns needed for plotting from each results table, once
+    plot_columns = ["log2FoldChange", "pvalue", "Gene_Name"]
+    loaded = results or {}
+    results = {}
+    with stage_profiler.stage("plot_load") as record:
+        for comp in comparisons:
+            if comp in loaded:
+                results[comp] = loaded[comp][plot_columns]
+                continue
+            file_path = results_store.table_path(
+                results_dir, f"{comp}_results")
+            print(f"Loading {file_path}...")
+            results[comp] = results_store.read_table(
+                file_path, columns=plot_columns)
+        record["rows"] = sum(len(df) for df in results.values())
+
+    # Top genes and significance calls come from the precomputed index
+    index = hit_index.open_index(results_dir, build=True)
+    threshold = (significance_column, alpha, lfc_threshold)
+
+    # Set volcano plotting for all comparisons, dropping NAN values
+    figures = []
+    for comp in comparisons:
+        df = results[comp].dropna(subset=["log2FoldChange", "pvalue"])
+        genenames = tuple(hit_index.top_genes(index, comp, 10)['Gene_Name'])
+        if max_background_points is not None:
+            df = downsample_background(df, max_background_points)
+        figures.append((
+            "volcano",
+            os.path.join(output_dir, f"volcano_{comp}"),
+            (df[["log2FoldChange", "pvalue", "Gene_Name"]], genenames)
+        ))
+
+    # Select significant genes by pvalue/padj and log2FoldChange
+    sig_matrix = hit_index.significance_matrix(index, *threshold)
+    # All contrasts come from the same fit and share the gene annotation
+    gene_names = results[comparisons[0]]["Gene_Name"]
+    gene_names = gene_names.reindex(sig_matrix.index)
+    significant_genes = {}
+    for comp in comparisons:
+        significant_genes[comp] = set(gene_names[sig_matrix[comp]].dropna())
+        print(f"{comp}: {len(significant_genes[comp])} significant genes")
+
+    # Export the counts of genes shared by each combination of comparisons
+    overlap = significance.overlap_counts(sig_matrix)
+    overlap.to_csv(os.path.join(output_dir, "significant_overlap.csv"),
+                   index=False)
+
+    # Find genes significant in at least min_comparisons comparisons
+    genes_to_keep = set(gene_names[
+        significance.genes_in_min_contrasts(sig_matrix, min_comparisons)
+    ].dropna())
+
+    print(
+        f"Found {len(genes_to_keep)} genes significant in at least "
+        f"{min_comparisons} comparisons"
+    )
+
+    # Pick the genes of each comparison heatmap: its top 50 significant
+    # genes by pvalue, or all of them
+    heatmap_genes = {}
+    for comp in comparisons:
+        if heatmap_mode == "all":
+            heatmap_genes[comp] = significant_genes[comp]
+            continue
+        top = hit_index.top_genes(
+            index, comp, heatmap_top_genes, threshold=threshold)
+        heatmap_genes[comp] = set(top['Gene_Name'])
+
+    # Load the normalized counts of the selected genes only, with genes as
+    # rows, and index them by gene name
+    selected = genes_to_keep.union(*heatmap_genes.values())
+    selected_ids = gene_names.index[gene_names.isin(selected)]
+    normalized_counts = results_store.read_gene_table(
+        results_store.table_path(results_dir, "normalized_counts"),
+        genes=selected_ids
+    ).set_index("Gene_Name")
+
+    # Select genes in two comparisons
+    sig_counts = normalized_counts[normalized_counts.index.isin(genes_to_keep)]
+
+    # Select top 50 genes to plot based on their variance
+    if heatmap_mode == "top" and len(sig_counts) > heatmap_top_genes:
+        gene_variance = sig_counts.var(axis=1)
+        top_genes = gene_variance.sort_values(ascending=False).head(
+            heatmap_top_genes).index
+        sig_counts = sig_counts.loc[top_genes]
+
+    print(f"Creating heatmap with {len(sig_counts)} genes")
+
+    # Large heatmaps are drawn as one image, reusing cached row orders
+    if heatmap_mode == "all":
+        order_cache = os.path.join(output_dir, order_cache_dirname)
+
+        def heatmap_figure(counts, figname):
+            return ("large_heatmap", figname, (counts, order_cache))
     else:
-        print(f"No genes to plot for {comp}")
+        def heatmap_figure(counts, figname):
+            return ("heatmap", figname, (counts,))
+
+    # Create general heatmap for significant genes for all comparisons
+    figures.append(heatmap_figure(
+        sig_counts, os.path.join(output_dir, "significant_genes_heatmap")))
+
+    # Create a separate heatmap for each comparison
+    for comp in comparisons:
+        comp_counts = normalized_counts[
+            normalized_counts.index.isin(heatmap_genes[comp])]
+        if len(comp_counts) > 0:
+            figures.append(heatmap_figure(
+                comp_counts, os.path.join(output_dir, f"heatmap_{comp}")))
+        else:
+            print(f"No genes to plot for {comp}")
+
+    # Draw all volcano plots and heatmaps
+    with stage_profiler.stage("plot_render") as record:
+        drawn = render_figures(figures, workers)
+        record["rows"] = drawn
+    print(f"Volcano plots and heatmaps created ({drawn} of "
+          f"{len(figures)} figures redrawn)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Plot the differential expression results."
+    )
+    pipeline_config.add_config_arguments(parser)
+    parser.add_argument(
+        "--min-comparisons",
+        type=int,
+        default=None,
+        help="Minimum number of comparisons a gene must be significant in "
+             "to appear in the combined heatmap "
+             "(default: from the configuration, 2)"
+    )
+    parser.add_argument(
+        "--significance-column",
+        choices=["pvalue", "padj"],
+        default=None,
+        help="Column compared against --alpha "
+             "(default: from the configuration, pvalue)"
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=None,
+        help="Significance threshold (default: from the configuration, "
+             "0.05)"
+    )
+    parser.add_argument(
+        "--lfc-threshold",
+        type=float,
+        default=None,
+        help="Minimum absolute log2 fold change "
+             "(default: from the configuration, 0.5)"
+    )
+    parser.add_argument(
+        "--plot-workers",
+        type=int,
+        default=None,
+        help="Number of processes drawing figures "
+             "(default: from the configuration, one per CPU)"
+    )
+    parser.add_argument(
+        "--max-background-points",
+        type=int,
+        default=None,
+        help="Draw at most this many non-significant points per volcano "
+             "plot (default: from the configuration, all)"
+    )
+    parser.add_argument(
+        "--heatmap-mode",
+        choices=heatmap_modes,
+        default=None,
+        help="Draw the top 50 genes per heatmap, or all selected significant "
+             "genes as a fast raster heatmap "
+             "(default: from the configuration, top)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = pipeline_config.load_config(args.config)
+    settings = pipeline_config.dataset_settings(config, args.dataset)
+    # Options given on the command line override the configuration
+    for key in ("min_comparisons", "significance_column", "alpha",
+                "lfc_threshold", "plot_workers", "max_background_points",
+                "heatmap_mode"):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    stage_profiler.context["dataset"] = settings["name"]
+    try:
+        plot_results(
+            settings,
+            min_comparisons=settings["min_comparisons"],
+            significance_column=settings["significance_column"],
+            alpha=settings["alpha"],
+            lfc_threshold=settings["lfc_threshold"],
+            workers=settings["plot_workers"],
+            max_background_points=settings["max_background_points"],
+            heatmap_mode=settings["heatmap_mode"]
+        )
+    finally:
+        stage_profiler.write_report()
+
 
-print("Heatmaps created for each comparison")
+if __name__ == "__main__":
+    main()